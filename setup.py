@@ -48,7 +48,7 @@ setup(
         CTypesExtension(
             'wboxkit.libfastcircuit',
             sources=['src/wboxkit/fastcircuit.c'],
-            depends=['src/wboxkit/fastcircuit.h'],
+            depends=['src/wboxkit/fastcircuit.h', 'src/wboxkit/fastcircuit_engine.h'],
         )
     ],
     cmdclass={'build_ext': build_ext},
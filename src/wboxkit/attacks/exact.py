@@ -79,7 +79,7 @@ def main():
 
         vectors_rev = defaultdict(list)
         for off, v in enumerate(vectors):
-            vectors_rev[v].append(R.offset + off)
+            vectors_rev[v].append(R.offset*8 + off)
 
         print( "   ", len(vectors_rev), "unique vectors" )
         print( "   ", len(targets), "target vectors" )
@@ -102,6 +102,7 @@ def main():
                 # linear combination indexes (may be non-unique)
                 inds = vectors_rev[target][:10]
                 print( "indexes", "(%d total)" % len(vectors_rev[target]), inds, )
+                R.print_symbols(inds)
                 print( )
 
                 candidates[si].add(k)
@@ -125,6 +126,7 @@ def main():
                         inds1 = vectors_rev[v1][:5]
                         inds2 = vectors_rev[v2][:5]
                         print( "indexes", "(%d and %d total)" % (len(vectors_rev[v1]), len(vectors_rev[v2])), inds1, inds2 )
+                        R.print_symbols(inds1 + inds2)
                         print( )
 
                         g_candidates[si].add(k)
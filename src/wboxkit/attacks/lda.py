@@ -142,8 +142,9 @@ def main():
             print( "key 0x%02x=%r," % (k, chr(k)),)
             print( "negated? %s," % bool(const1),)
             # linear combination indexes (may be non-unique)
-            inds = [R.offset + i for i, take in enumerate(sol) if take]
+            inds = [R.offset*8 + i for i, take in enumerate(sol) if take]
             print( "indexes", "%d...%d (distance %d)" % (min(inds), max(inds), max(inds)-min(inds)), inds,)
+            R.print_symbols(inds)
             print()
 
             candidates[si].add(k)
@@ -1,15 +1,27 @@
 import os
+import random
+import threading
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from queue import Queue, Full
 
 from bitarray import frozenbitarray, bitarray
 
+from wboxkit.fastcircuit import DEFAULT_BATCH, FastCircuit, trace_item_bytes, transpose_bits
+from wboxkit.regions import RegionRuns
+from wboxkit.symbols import SymbolTable
+from wboxkit.tracing import read_trace_index
+from wboxkit.tracestore import TraceStore, FILENAME as TRACE_STORE_FILENAME
 
 
 class Reader(object):
     TRACE_FILENAME_FORMAT = "%04d.bin"
     PLAINTEXT_FILENAME_FORMAT = "%04d.pt"
     CIPHERTEXT_FILENAME_FORMAT = "%04d.ct"
+    TRACE_INDEX_FILENAME = "trace.idx"
+    REGIONS_FILENAME = "trace.regions"
+    TRACE_STORE_FILENAME = TRACE_STORE_FILENAME
 
     @classmethod
     def add_arguments(
@@ -19,8 +31,41 @@ class Reader(object):
         default_window=2048,
     ):
         parser.add_argument(
-            'trace_dir', type=Path,
-            help="path to directory with trace/plaintext/ciphertext files")
+            'trace_dir', type=Path, nargs="?",
+            help=(
+                "path to directory with trace/plaintext/ciphertext files"
+                " or a trace store (see wboxkit.tracestore)"
+            )
+        )
+        parser.add_argument(
+            '--circuit', type=Path,
+            help=(
+                "trace the serialized circuit on random plaintexts"
+                " before attacking (as wboxkit.trace), instead of reading trace_dir"
+            )
+        )
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help="seed to generate plaintexts and the randomness of the circuit (with --circuit)"
+        )
+        parser.add_argument(
+            '--batch', type=int, default=DEFAULT_BATCH,
+            help="traces per circuit pass (with --circuit, as -b of wboxkit.trace)"
+        )
+        parser.add_argument(
+            '--symbols', type=Path,
+            help=(
+                "symbol table of the circuit (see RawSerializer.serialize_to_file),"
+                " to print the gates at matching trace positions"
+            )
+        )
+        parser.add_argument(
+            '--region', action="append", metavar="PATTERN",
+            help=(
+                "only open windows in regions matching the pattern, e.g. r1:sb"
+                " (can be repeated, see wboxkit.regions)"
+            )
+        )
 
         parser.add_argument(
             '-t', '-T', '--n-traces', type=int, default=default_n_traces,
@@ -50,15 +95,47 @@ class Reader(object):
         args.step = max(1, args.step)
 
         REVERSE=False
-        return cls(
-            ntraces=args.n_traces,
-            window=args.window,
-            step=args.step,
-            packed=True,
-            reverse=REVERSE,
-            dir=args.trace_dir,
-            as_vectors=as_vectors,
-        )
+        if args.circuit is not None:
+            reader = CircuitReader(
+                circuit=args.circuit,
+                ntraces=args.n_traces,
+                window=args.window,
+                step=args.step,
+                seed=args.seed,
+                batch_size=args.batch,
+                as_vectors=as_vectors,
+            )
+        elif args.trace_dir is None:
+            raise SystemExit("error: either trace_dir or --circuit is required")
+        elif (args.trace_dir / cls.TRACE_STORE_FILENAME).exists():
+            reader = StoreReader(
+                ntraces=args.n_traces,
+                window=args.window,
+                step=args.step,
+                dir=args.trace_dir,
+                as_vectors=as_vectors,
+            )
+        else:
+            reader = cls(
+                ntraces=args.n_traces,
+                window=args.window,
+                step=args.step,
+                packed=True,
+                reverse=REVERSE,
+                dir=args.trace_dir,
+                as_vectors=as_vectors,
+            )
+        if args.symbols is not None:
+            reader.symbols = SymbolTable(args.symbols, nodes=reader.traced_nodes())
+        if args.region:
+            regions = reader.regions()
+            if regions is None:
+                raise SystemExit("error: the traces have no region table (see wboxkit.regions)")
+            ranges = regions.select(args.region)
+            if not ranges:
+                raise SystemExit("error: no trace nodes in regions %s" % ", ".join(args.region))
+            reader.set_ranges(ranges)
+        return reader
 
     def __init__(
         self,
@@ -72,7 +149,9 @@ class Reader(object):
     ):
 
         dir = Path(dir)
+        self.dir = dir
         self.packed = packed
+        self.symbols = None
 
         self.pts = []
         self.cts = []
@@ -102,6 +181,31 @@ class Reader(object):
         if reverse:
             raise NotImplementedError("Not supported yet")
 
+        self.setup_windows(window, step, as_vectors)
+
+    def traced_nodes(self):
+        """Nodes in the traces (None: all, see wboxkit.tracing.write_trace_index)"""
+        path = self.dir / self.TRACE_INDEX_FILENAME
+        if path.exists():
+            return read_trace_index(path)
+
+    def regions(self):
+        """Regions of the trace positions (RegionRuns), None if unknown"""
+        path = self.dir / self.REGIONS_FILENAME
+        if path.exists():
+            return RegionRuns.from_file(path)
+
+    def print_symbols(self, positions):
+        """Print the gates at the trace positions, if a symbol table is given"""
+        if self.symbols is None:
+            return
+        for position in positions:
+            if position < len(self.symbols):
+                print("   ", position, self.symbols[position])
+            else:
+                print("   ", position, "(padding)")
+
+    def setup_windows(self, window, step, as_vectors):
         if step is None:
             step = window
         assert 0 < step <= window
@@ -118,9 +222,7 @@ class Reader(object):
 
         self.window_bytes = min(self.window_bytes, self.trace_bytes)
         self.step_bytes = min(self.step_bytes, self.trace_bytes)
-
-        # may be ceil? not accurate!
-        self.num_windows = (self.trace_bytes - self.window_bytes + self.step_bytes - 1) // self.step_bytes + 1
+        self.set_ranges(None)
 
         if as_vectors:
             from sage.all import vector, GF
@@ -131,29 +233,72 @@ class Reader(object):
             self.cls_array = bitarray
             self.cls_array_freeze = frozenbitarray
 
+    def set_ranges(self, ranges):
+        """Only open windows in the given (start, stop) ranges of trace positions
+        (e.g. from RegionRuns.select), None: the whole trace.
+        Ranges are extended to whole bytes of packed traces."""
+        per_byte = 8 if self.packed else 1
+        self.byte_ranges = []
+        for start, stop in sorted(ranges or [(0, self.trace_bytes * per_byte)]):
+            start = start // per_byte
+            stop = min(self.trace_bytes, -(-stop // per_byte))
+            if self.byte_ranges and start <= self.byte_ranges[-1][1]:
+                self.byte_ranges[-1] = self.byte_ranges[-1][0], max(stop, self.byte_ranges[-1][1])
+            elif start < stop:
+                self.byte_ranges.append((start, stop))
+
+        self.num_windows = 0
+        for start, stop in self.byte_ranges:
+            window = min(self.window_bytes, stop - start)
+            self.num_windows += (stop - start - window + self.step_bytes - 1) // self.step_bytes + 1
+
     def __iter__(self):
+        for start, stop in self.byte_ranges:
+            yield from self.iter_range(start, stop)
+
+    def iter_range(self, start, stop):
+        self.seek(start)
+        window = min(self.window_bytes, stop - start)
         self.vectors = deque()
-        self.offset = 0
-        self.advance(self.window_bytes)
+        self.offset = start
+        self.advance(window)
         for v in self.new_vectors:
             self.vectors.append(v)
         yield self.vectors
 
-        while True:
-            if self.offset + self.window_bytes >= self.trace_bytes:
-                # already covered the whole trace
-                return
-
-            self.advance(self.step_bytes)
+        while self.offset + window < stop:
+            step = min(self.step_bytes, stop - self.offset - window)
+            self.advance(step)
             for v in self.new_vectors:
                 self.vectors.append(v)
                 self.vectors.popleft()
-            self.offset += self.step_bytes
+            self.offset += step
 
             yield self.vectors
 
+    def seek(self, offset):
+        for fd in self.fds:
+            fd.seek(offset)
+
 
     def advance(self, num_bytes):
+        if self.packed:
+            datas = [fd.read(num_bytes) for fd in self.fds]
+            l = len(datas[0])
+            assert all(l == len(data) for data in datas)
+            # traces x nodes -> nodes x traces
+            rows = transpose_bits(b"".join(datas), self.ntraces, l * 8)
+            row_bytes = (self.ntraces + 7) // 8
+            self.new_vectors = []
+            for i in range(l * 8):
+                vec = bitarray()
+                vec.frombytes(rows[i*row_bytes:(i+1)*row_bytes])
+                del vec[self.ntraces:]
+                if self.cls_array is not bitarray:
+                    vec = self.cls_array(vec)
+                self.new_vectors.append(self.cls_array_freeze(vec))
+            return
+
         self.new_vectors = [
             self.cls_array(self.ntraces)
             for _ in range(num_bytes * 8)
@@ -185,3 +330,214 @@ class Reader(object):
                 for j in range(8):
                     id = (i << 3) | j
                     vectors[id][itrace] = (b >> (7 - j)) & 1
+
+
+class StoreReader(Reader):
+    """
+    Same as Reader, but the traces are read from a trace store
+    (see wboxkit.tracestore): its rows are the node vectors, no transposition.
+    """
+    def __init__(
+        self,
+        ntraces,
+        window,
+        step=None,
+        dir="./traces",
+        as_vectors=False,
+    ):
+        self.dir = Path(dir)
+        self.store = TraceStore(self.dir / self.TRACE_STORE_FILENAME)
+        self.packed = True
+        self.symbols = None
+        self.reverse = False
+        self.ntraces = int(ntraces)
+        self.window = int(window)
+        assert 1 <= self.ntraces <= self.store.ntraces, \
+            "the store has %d traces" % self.store.ntraces
+
+        self.pts = self.store.plaintexts()[:self.ntraces]
+        self.cts = self.store.ciphertexts()[:self.ntraces]
+        self.trace_bytes = (self.store.num_nodes + 7) // 8
+        self.setup_windows(window, step, as_vectors)
+
+    def seek(self, offset):
+        self.position = offset * 8
+
+    def advance(self, num_bytes):
+        start = self.position
+        stop = start + num_bytes * 8
+        rows = self.store.rows(start, stop)
+        row_bytes = self.store.row_bytes
+        self.new_vectors = []
+        for i in range(stop - start):
+            if i * row_bytes < len(rows):
+                vec = bitarray()
+                vec.frombytes(rows[i*row_bytes:(i+1)*row_bytes])
+                del vec[self.ntraces:]
+                if self.cls_array is not bitarray:
+                    vec = self.cls_array(vec)
+            else:
+                # zero padding to full bytes, as in trace files
+                vec = self.cls_array(self.ntraces)
+            self.new_vectors.append(self.cls_array_freeze(vec))
+        self.position = stop
+
+
+class CircuitReader(Reader):
+    """
+    Same as Reader, but the circuit is traced on random plaintexts
+    (generated as in wboxkit.trace) while the windows are consumed:
+    the batches run in background threads (one context each), streaming
+    their traces (see FastCircuit.compute_batch_stream) through bounded queues,
+    nothing is written to disk. The windows need the nodes of all traces,
+    so all batches run at once, in lockstep with the windows.
+    Batches are recorded as by wboxkit.trace (the batch starting at the trace t
+    uses the random stream (seed, t)), so that with the same seed and batch size
+    the windows are those of the recorded traces, also for circuits with RANDOM gates.
+    The ciphertexts (cts) are known once the traces are read.
+    """
+    # trace blocks buffered per batch (see set_trace_buffer_size)
+    QUEUE_SIZE = 2
+
+    def __init__(
+        self,
+        circuit,
+        ntraces,
+        window,
+        step=None,
+        seed=0,
+        batch_size=DEFAULT_BATCH,
+        as_vectors=False,
+    ):
+        if not isinstance(circuit, FastCircuit):
+            circuit = FastCircuit(str(circuit))
+        self.circuit = circuit
+        self.packed = True
+        self.symbols = None
+        self.reverse = False
+        self.ntraces = int(ntraces)
+        self.window = int(window)
+        self.seed = seed
+        self.batch_size = batch_size
+        assert self.ntraces >= 1
+
+        rand = random.Random(seed)
+        n_input_bytes = (circuit.info.input_size + 7) // 8
+        self.pts = [
+            bytes([rand.getrandbits(8) for _ in range(n_input_bytes)])
+            for _ in range(self.ntraces)
+        ]
+        # from the tracing pass
+        self.cts = [None] * self.ntraces
+
+        self.trace_bytes = (circuit.num_traced() + 7) // 8
+        self.setup_windows(window, step, as_vectors)
+
+    def __iter__(self):
+        self.start()
+        try:
+            yield from super().__iter__()
+            # trace the nodes after the ranges, for the ciphertexts
+            for _ in self.nodes:
+                pass
+        finally:
+            self.stop()
+
+    def start(self):
+        self.stopped = threading.Event()
+        self.batches = []
+        for start in range(0, self.ntraces, self.batch_size):
+            chunk = self.pts[start:start + self.batch_size]
+            self.batches.append((start, chunk, Queue(self.QUEUE_SIZE)))
+        self.pool = ThreadPoolExecutor(max_workers=len(self.batches))
+        for batch in self.batches:
+            self.pool.submit(self.produce, *batch)
+        self.nodes = self.read_nodes()
+        self.position = 0
+
+    def stop(self):
+        self.stopped.set()
+        self.pool.shutdown(wait=True)
+
+    def produce(self, start, chunk, queue):
+        def put(item):
+            while True:
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Full:
+                    if self.stopped.is_set():
+                        raise StopTracing()
+
+        circuit = self.circuit
+        context = circuit.new_context()
+        if circuit.trace_nodes is not None:
+            circuit.set_trace_filter(circuit.trace_nodes, context=context)
+        circuit.set_seed(self.seed, start, context=context)
+        try:
+            cts = circuit.compute_batch_stream(chunk, put, context=context)
+            self.cts[start:start + len(chunk)] = cts
+            put(None)
+        except StopTracing:
+            pass
+        except Exception as err:
+            try:
+                put(err)
+            except StopTracing:
+                pass
+
+    def read_nodes(self):
+        """Node vectors (over all traces), zero-padded to full bytes as in trace files"""
+        item_bytes = [trace_item_bytes(len(chunk)) for _, chunk, _ in self.batches]
+        pending = [b"" for _ in self.batches]
+        n_read = 0
+        while True:
+            # whole nodes available in all batches
+            for i, (_, _, queue) in enumerate(self.batches):
+                if len(pending[i]) < item_bytes[i]:
+                    data = queue.get()
+                    if isinstance(data, Exception):
+                        raise data
+                    if data is None:
+                        assert not pending[i], "truncated trace"
+                        for _ in range((8 - n_read % 8) % 8):
+                            yield self.cls_array(self.ntraces)
+                        return
+                    pending[i] += data
+            n_nodes = min(len(data) // size for data, size in zip(pending, item_bytes))
+            for j in range(n_nodes):
+                vec = bitarray()
+                for data, size, (_, chunk, _) in zip(pending, item_bytes, self.batches):
+                    row = bitarray()
+                    row.frombytes(data[j*size:(j+1)*size])
+                    vec += row[:len(chunk)]
+                yield vec if self.cls_array is bitarray else self.cls_array(vec)
+            pending = [data[n_nodes*size:] for data, size in zip(pending, item_bytes)]
+            n_read += n_nodes
+
+    def seek(self, offset):
+        # the traces are only read forward (ranges are sorted)
+        assert offset * 8 >= self.position, "cannot seek back in streamed traces"
+        for _ in zip(range(offset * 8 - self.position), self.nodes):
+            pass
+        self.position = offset * 8
+
+    def advance(self, num_bytes):
+        self.new_vectors = [
+            self.cls_array_freeze(vec)
+            for _, vec in zip(range(num_bytes * 8), self.nodes)
+        ]
+        self.position += num_bytes * 8
+
+    def traced_nodes(self):
+        return self.circuit.trace_nodes
+
+    def regions(self):
+        regions = self.circuit.regions
+        if regions is not None and self.circuit.trace_nodes is not None:
+            regions = regions.filtered(self.circuit.trace_nodes)
+        return regions
+
+
+class StopTracing(Exception):
+    pass
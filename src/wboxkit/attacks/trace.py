@@ -2,18 +2,33 @@
 
 import sys, os
 import argparse
+import json
 import random
+import time
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from pathlib import Path
 
-from wboxkit.fastcircuit import FastCircuit, chunks
-from wboxkit.tracing import trace_split_batch
+from wboxkit.fastcircuit import FastCircuit, chunks, max_batch, DEFAULT_BATCH, MAX_BATCH
+from wboxkit.tracing import trace_split_batch, write_trace_index
+from wboxkit.tracestore import TraceStore, TraceStoreWriter, FILENAME as PATH_TRACE_STORE
 from wboxkit.attacks.reader import Reader
 
 PATH_FORMAT_TRACE = "%04d.bin"
 PATH_FORMAT_TMP = ".chunk%04d.bin"
 PATH_FORMAT_PT = "%04d.pt"
 PATH_FORMAT_CT = "%04d.ct"
+PATH_TRACE_INDEX = "trace.idx"
+PATH_REGIONS = "trace.regions"
+# settings, batches and recorded traces of the trace set (see --resume)
+PATH_MANIFEST = "trace.json"
+
+
+def node_range(s):
+    start, stop = s.split(":")
+    return int(start or 0), int(stop) if stop else float("inf")
 
 
 def main():
@@ -41,7 +56,67 @@ def main():
 
     parser.add_argument(
         '--seed', type=int, default=0,
-        help="seed to generate plaintexts"
+        help="seed to generate plaintexts and the randomness of the circuit"
+    )
+
+    parser.add_argument(
+        '-b', '--batch', type=int, default=DEFAULT_BATCH,
+        help=(
+            "traces per circuit pass (up to %d, %d is the fastest on this CPU),"
+            " the traces depend on it, see --seed" % (MAX_BATCH, max_batch())
+        )
+    )
+
+    parser.add_argument(
+        '--trace-range', type=node_range, action="append", metavar="START:STOP",
+        help="only trace nodes (gates) with indices in [START, STOP) (can be repeated)"
+    )
+    parser.add_argument(
+        '--trace-ops', type=lambda s: s.upper().split(","), metavar="OP,OP,...",
+        help="only trace outputs of given gate types (XOR, AND, OR, NOT, RANDOM)"
+    )
+    parser.add_argument(
+        '--trace-stride', type=int, default=1,
+        help="only trace every n-th of the selected nodes"
+    )
+    parser.add_argument(
+        '--trace-fused-outputs', action="store_true",
+        help="do not trace intermediate gates of fused opcodes"
+    )
+    parser.add_argument(
+        '--trace-region', action="append", metavar="PATTERN",
+        help=(
+            "only trace nodes in regions matching the pattern, e.g. r1:sb"
+            " (can be repeated, needs a circuit serialized with regions=True)"
+        )
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help=(
+            "number of processes recording batches"
+            " (traces do not depend on it, see --seed)"
+        )
+    )
+    parser.add_argument(
+        '--resume', action="store_true",
+        help=(
+            "record the batches missing from the existing trace set (e.g. after a crash),"
+            " the settings (--seed, -b, trace filters, --store) must be those of the trace set"
+        )
+    )
+    parser.add_argument(
+        '--append', action="store_true",
+        help=(
+            "add N traces to the existing trace set (continuing its plaintexts),"
+            " recording missing batches as with --resume"
+        )
+    )
+    parser.add_argument(
+        '--store', action="store_true",
+        help=(
+            "save the traces to a single node-major trace store (%s)"
+            " instead of per-trace files, see wboxkit.tracestore" % PATH_TRACE_STORE
+        )
     )
 
 
@@ -57,39 +132,271 @@ def main():
     PREFIX = TRACE_FOLDER / NAME
     assert "%" not in str(PREFIX)
 
-    print("Tracing", args.circuit, "on", N, "traces")
+    print("Tracing", args.circuit)
     print("Saving to", PREFIX)
 
     PREFIX.mkdir(exist_ok=True)
 
+    if args.trace_region and FC.regions is None:
+        raise SystemExit("error: the circuit has no region table (serialize it with regions=True)")
+
+    nodes = None
+    if (args.trace_range or args.trace_ops or args.trace_stride != 1
+            or args.trace_fused_outputs or args.trace_region):
+        nodes = FC.select_nodes(
+            ranges=args.trace_range,
+            ops=args.trace_ops,
+            stride=args.trace_stride,
+            fused_outputs=args.trace_fused_outputs,
+            regions=args.trace_region,
+        )
+        print("Tracing", len(nodes), "of", FC.num_nodes, "nodes")
+        FC.set_trace_filter(nodes)
+
+    # the trace set (see PATH_MANIFEST) must have been recorded with the same settings
+    settings = dict(
+        circuit=args.circuit.name,
+        circuit_size=os.stat(args.circuit).st_size,
+        num_nodes=FC.num_traced(),
+        trace_filter=None if nodes is None else zlib.crc32(array("Q", nodes).tobytes()),
+        format="store" if args.store else "files",
+        seed=args.seed,
+        # the batches and their random streams
+        batch=args.batch,
+    )
+    B = args.batch
+    if args.resume or args.append:
+        if not (PREFIX / PATH_MANIFEST).exists():
+            raise SystemExit("error: no trace set to continue in %s" % PREFIX)
+        manifest = load_manifest(PREFIX / PATH_MANIFEST)
+        for key, value in settings.items():
+            if manifest.get(key) != value:
+                raise SystemExit(
+                    "error: %s differs from the trace set (%r, not %r)" % (key, manifest.get(key), value)
+                )
+        old = manifest["ntraces"]
+        N = old + N if args.append else old
+        if N > old:
+            manifest["segments"].append([old, N, B])
+        manifest["ntraces"] = N
+    else:
+        manifest = dict(settings, ntraces=N, segments=[[0, N, B]], done=[])
+    # checkpoint: batches are only marked done once recorded
+    save_manifest(PREFIX / PATH_MANIFEST, manifest)
+
+    if nodes is not None:
+        # trace position -> node index
+        write_trace_index(PREFIX / PATH_TRACE_INDEX, nodes)
+    elif (PREFIX / PATH_TRACE_INDEX).exists():
+        os.unlink(PREFIX / PATH_TRACE_INDEX)
+
+    if FC.regions is not None:
+        # regions over trace positions (see Reader)
+        regions = FC.regions if nodes is None else FC.regions.filtered(nodes)
+        regions.to_file(PREFIX / PATH_REGIONS)
+    elif (PREFIX / PATH_REGIONS).exists():
+        os.unlink(PREFIX / PATH_REGIONS)
+
+    todo = [
+        (start, stop)
+        for segment in manifest["segments"]
+        for start, stop in plan_batches(*segment)
+        if not covered(manifest["done"], start, stop)
+    ]
+    print("Recording", sum(stop - start for start, stop in todo), "of", N, "traces")
+
     random.seed(args.seed)
 
+    # the plaintexts of all traces, the existing ones are generated again
     n_input_bytes = (FC.info.input_size + 7) // 8
     pts = [
         bytes([random.getrandbits(8) for _ in range(n_input_bytes)])
         for _ in range(N)
     ]
 
-    cts = FC.compute_batches(
-        inputs=pts,
-        trace_filename_format=str(PREFIX / PATH_FORMAT_TMP)
+    if args.jobs < 1:
+        raise SystemExit("error: --jobs must be at least 1")
+    # concurrent batches must not share bytes of the rows of a store
+    shared = {stop for _, stop in todo} & {start for start, _ in todo}
+    if args.jobs > 1 and args.store and any(t % 8 for t in shared):
+        raise SystemExit("error: --jobs with --store needs a batch size multiple of 8")
+    path = PREFIX / PATH_TRACE_STORE
+    if args.store:
+        if not manifest["done"] or not path.exists():
+            n_output_bytes = (FC.info.output_size + 7) // 8
+            TraceStoreWriter.create(
+                path, N, FC.num_traced(), n_input_bytes, n_output_bytes,
+            ).close()
+        else:
+            store = TraceStore(path)
+            recorded = store.ntraces
+            store.close()
+            if recorded < N:
+                # the rows get longer: copy the recorded traces, do not compute them again
+                TraceStoreWriter.grow(path, N)
+    elif path.exists():
+        # the attacks would read it instead of the new files
+        os.unlink(path)
+
+    checkpoint = Checkpoint(PREFIX / PATH_MANIFEST, manifest, store=path if args.store else None)
+    tracer = BatchTracer(
+        circuit=args.circuit,
+        prefix=PREFIX,
+        seed=args.seed,
+        nodes=nodes,
+        store=args.store,
     )
-    for i in range((N+63)//64):
-        print("splitting", i)
-        filename = PREFIX / (PATH_FORMAT_TMP % i)
+    try:
+        if args.jobs == 1:
+            tracer.setup(FC)
+            for start, stop in todo:
+                tracer.trace(start, pts[start:stop])
+                checkpoint.done(start, stop)
+            if tracer.writer is not None:
+                tracer.writer.close()
+        else:
+            with ProcessPoolExecutor(
+                    max_workers=args.jobs, initializer=init_worker, initargs=(tracer,)) as pool:
+                futures = {
+                    pool.submit(trace_batch, start, pts[start:stop]): (start, stop)
+                    for start, stop in todo
+                }
+                for future in as_completed(futures):
+                    future.result()
+                    checkpoint.done(*futures[future])
+    finally:
+        # keep the batches recorded so far (e.g. interrupted by Ctrl-C)
+        checkpoint.save()
+
+
+def plan_batches(start, stop, batch_size):
+    """Batches (start, stop) of the traces start..stop-1,
+    aligned to multiples of batch_size (as if the traces were recorded from 0)"""
+    bounds = [start] + list(range(start - start % batch_size + batch_size, stop, batch_size)) + [stop]
+    return [[a, b] for a, b in zip(bounds, bounds[1:]) if a < b]
+
+
+def covered(ranges, start, stop):
+    """Whether the traces start..stop-1 are in one of the ranges"""
+    return any(a <= start and stop <= b for a, b in ranges)
+
+
+def add_range(ranges, start, stop):
+    """Add the range [start, stop) to the ranges (merged in place)"""
+    merged = []
+    for a, b in sorted(ranges + [[start, stop]]):
+        if merged and a <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], b)
+        else:
+            merged.append([a, b])
+    ranges[:] = merged
+
+
+class Checkpoint(object):
+    """
+    Records the progress of the trace set in its manifest (see PATH_MANIFEST):
+    recorded batches are merged into ranges of traces ("done"),
+    the manifest is saved at most every `interval` seconds (and by save()),
+    after syncing the trace store, so that it never lists traces not on disk.
+    """
+    interval = 5.0
+
+    def __init__(self, path, manifest, store=None):
+        self.path = path
+        self.manifest = manifest
+        self.store = store
+        self.last = time.monotonic()
+
+    def done(self, start, stop):
+        add_range(self.manifest["done"], start, stop)
+        if time.monotonic() - self.last >= self.interval:
+            self.save()
+
+    def save(self):
+        if self.store is not None:
+            # the batches were written through mappings of the store (in any process)
+            with open(self.store, "rb") as f:
+                os.fsync(f.fileno())
+        save_manifest(self.path, self.manifest)
+        self.last = time.monotonic()
+
+
+def load_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    # replaced at once: a crash leaves the previous checkpoint
+    tmp = str(path) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+
+class BatchTracer(object):
+    """
+    Records a batch of the traces (starting at the trace t)
+    with the random stream (seed, t) of the circuit (see FastCircuit.set_seed),
+    so that traces do not depend on the process recording the batch.
+    Batches are written to the trace store, or split to per-trace files
+    (with their plaintext/ciphertext files).
+    """
+    def __init__(self, circuit, prefix, seed, nodes=None, store=False):
+        self.circuit = circuit
+        self.prefix = prefix
+        self.seed = seed
+        self.nodes = nodes
+        self.store = store
+
+    def setup(self, FC=None):
+        """Load the circuit (in the recording process)"""
+        if FC is None:
+            FC = FastCircuit(str(self.circuit))
+            if self.nodes is not None:
+                FC.set_trace_filter(self.nodes)
+        self.FC = FC
+        self.writer = None
+        if self.store:
+            self.writer = TraceStoreWriter(self.prefix / PATH_TRACE_STORE)
+
+    def trace(self, start, pts):
+        """Record the batch of the traces start, start+1, ..."""
+        if self.writer is not None:
+            self.writer.record(self.FC, pts, batch_size=len(pts), start=start, seed=self.seed)
+            return
+
+        filename = self.prefix / (PATH_FORMAT_TMP % start)
+        self.FC.set_seed(self.seed, start)
+        cts = self.FC.compute_batch(pts, str(filename))
+        print("splitting", start)
         trace_split_batch(
             filename=filename,
             make_output_filename=
-                lambda j: PREFIX / (PATH_FORMAT_TRACE % (i * 64 + j)),
-            ntraces=64,
+                lambda j: self.prefix / (PATH_FORMAT_TRACE % (start + j)),
+            ntraces=len(pts),
             packed=True)
         os.unlink(filename)
 
-    for i, (pt, ct) in enumerate(zip(pts, cts)):
-        with open(PREFIX / (PATH_FORMAT_PT % i), "wb") as f:
-            f.write(pt)
-        with open(PREFIX / (PATH_FORMAT_CT % i), "wb") as f:
-            f.write(ct)
+        for i, (pt, ct) in enumerate(zip(pts, cts), start):
+            with open(self.prefix / (PATH_FORMAT_PT % i), "wb") as f:
+                f.write(pt)
+            with open(self.prefix / (PATH_FORMAT_CT % i), "wb") as f:
+                f.write(ct)
+
+
+# tracer of the worker process (see --jobs)
+worker = None
+
+
+def init_worker(tracer):
+    global worker
+    worker = tracer
+    worker.setup()
+
+
+def trace_batch(start, pts):
+    worker.trace(start, pts)
 
 
 if __name__ == '__main__':
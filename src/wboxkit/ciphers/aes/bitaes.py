@@ -4,8 +4,16 @@ from .sbox import bitSbox
 from .linear import ShiftRow, MixColumn
 from .keyschedule import KS_round
 
+from wboxkit.regions import region
+
 
 def BitAES(plaintext, key, rounds=10):
+    """
+    Nodes are tagged with their region (see wboxkit.regions): "r1", "r2", ... for rounds,
+    then "ak", "sb" (and "s0".."s15" by byte index), "mc" and "ks",
+    the final key addition is "ak_last" in the last round.
+    """
+    plaintext = list(plaintext)
     bx = Vector(plaintext).split(16)
     bk = Vector(key).split(16)
 
@@ -13,13 +21,19 @@ def BitAES(plaintext, key, rounds=10):
     kstate = Rect(bk, w=4, h=4).transpose()
 
     for rno in range(rounds):
+        with region(plaintext, "r%d" % (rno + 1)):
+            with region(plaintext, "ak"):
+                state = AK(state, kstate)
+            with region(plaintext, "sb"):
+                state = SB(state)
+            state = SR(state)
+            if rno < rounds-1:
+                with region(plaintext, "mc"):
+                    state = MC(state)
+            with region(plaintext, "ks"):
+                kstate = KS(kstate, rno)
+    with region(plaintext, "r%d" % rounds), region(plaintext, "ak_last"):
         state = AK(state, kstate)
-        state = SB(state)
-        state = SR(state)
-        if rno < rounds-1:
-            state = MC(state)
-        kstate = KS(kstate, rno)
-    state = AK(state, kstate)
 
     state = state.transpose()
     kstate = kstate.transpose()
@@ -31,7 +45,11 @@ def AK(state, kstate):
     return state.zipwith(lambda a, b: a ^ b, kstate)
 
 def SB(state, inverse=False):
-    return state.apply(lambda v: Vector(bitSbox(v, inverse=inverse)))
+    def sbox(y, x, v):
+        # state is column-major: byte 4x+y
+        with region(v, "s%d" % (4*x + y)):
+            return Vector(bitSbox(v, inverse=inverse))
+    return state.apply(sbox, with_coord=True)
 
 def SR(state, inverse=False):
     for y in range(4):
@@ -92,15 +92,16 @@ class AESTargets:
         for si, lin, k in product(self.indexes, self.masks, self.charset):
             target = self.cls_array(reader.ntraces)
             scalar_lin = scalar_map[lin]
-            for itrace, (p, c) in enumerate(zip(reader.pts, reader.cts)):
+            # ciphertexts only for ct_side (a CircuitReader knows them once the traces are read)
+            for itrace, p in enumerate(reader.pts):
                 if k is None:
                     if ct_side:
-                        x = c[si]
+                        x = reader.cts[itrace][si]
                     else:
                         x = p[si]
                 else:
                     if ct_side:
-                        x = c[si]
+                        x = reader.cts[itrace][si]
                         x = isbox[x ^ k]
                     else:
                         x = p[si]
@@ -0,0 +1,213 @@
+import os
+import ctypes
+import hashlib
+import subprocess
+import tempfile
+
+from pathlib import Path
+
+from wboxkit.fastcircuit import (
+    FastCircuit, lib, max_batch,
+    OP_XOR, OP_AND, OP_OR, OP_NOT, OP_RANDOM,
+    OP_XOR3, OP_ANDXOR, OP_ANDNOT, OP_MUX, OP_XORN,
+)
+
+
+# bump when the generated code changes (invalidates cached builds)
+GENERATOR_VERSION = 2
+
+DEFAULT_CACHE_DIR = Path(
+    os.environ.get("WBOXKIT_CACHE", Path.home() / ".cache" / "wboxkit")
+)
+
+CC = os.environ.get("CC", "gcc")
+CFLAGS = ("-O2", "-fPIC", "-shared")
+ARCH_FLAGS = {
+    # words per wire -> instruction set for the vector type
+    1: (),
+    2: ("-msse2",),
+    4: ("-mavx2",),
+    8: ("-mavx512f",),
+}
+
+BINARY = {
+    OP_XOR: "^",
+    OP_AND: "&",
+    OP_OR: "|",
+}
+
+
+class CompiledCircuit(FastCircuit):
+    """
+    FastCircuit backed by the circuit compiled to straight-line C code
+    (one statement per gate, wires in local variables),
+    built with the local C compiler and cached on disk by the circuit hash.
+
+    circuit: serialized circuit file (see RawSerializer) or a circkit circuit
+    lanes: number of parallel executions per pass (64, 128, 256 or 512)
+    """
+    def __init__(self, circuit, lanes=None, cache_dir=None, chunk_size=4096):
+        if lanes is None:
+            lanes = max_batch()
+        assert lanes in (64, 128, 256, 512), "unsupported number of lanes"
+        self.lanes = lanes
+        self.words = lanes // 64
+
+        self.cache_dir = Path(cache_dir or DEFAULT_CACHE_DIR)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        if isinstance(circuit, (str, Path)):
+            data = Path(circuit).read_bytes()
+        else:
+            from wboxkit.serialize import RawSerializer
+            header, opcodes = RawSerializer().serialize(circuit)
+            data = b"".join(header) + b"".join(opcodes)
+
+        flags = CFLAGS
+        if lanes <= max_batch():
+            # otherwise the CPU lacks the instructions, use generic code
+            flags += ARCH_FLAGS[self.words]
+        h = hashlib.sha256()
+        h.update(b"wboxkit.compiler %d %d %s %s\n" % (
+            GENERATOR_VERSION, lanes, CC.encode(), " ".join(flags).encode()
+        ))
+        h.update(data)
+        self.hash = h.hexdigest()
+
+        super().__init__(data)
+        self.max_batch = lanes
+
+        self.so_path = self.cache_dir / (self.hash + ".so")
+        if not self.so_path.is_file():
+            source = self.generate(chunk_size=chunk_size)
+            self.build(source, flags)
+
+        self.so = ctypes.cdll.LoadLibrary(str(self.so_path))
+        run = ctypes.cast(self.so.wboxkit_run, ctypes.c_void_p)
+        ret = lib.circuit_set_compiled(self.circuit, run, self.words)
+        assert ret
+
+    def build(self, source, flags):
+        with tempfile.TemporaryDirectory(dir=self.cache_dir) as tmp:
+            c_path = Path(tmp) / "circuit.c"
+            c_path.write_text(source)
+            so_path = Path(tmp) / "circuit.so"
+            subprocess.run(
+                [CC, *flags, str(c_path), "-o", str(so_path)],
+                check=True,
+            )
+            # atomic: concurrent workers may build the same circuit
+            os.replace(so_path, self.so_path)
+
+    def generate(self, chunk_size=4096):
+        """
+        Generate C source for the circuit.
+        The code is split into functions of chunk_size opcodes
+        (compilers choke on huge functions),
+        wires live in local variables and go through ram only between chunks.
+        """
+        ops, dst = self.decoded()[:2]
+        n = len(ops)
+        args = self.operands()
+        # first trace node of each opcode
+        nodes = [0] + [node + 1 for node in self.output_nodes()]
+
+        bounds = list(range(0, n, chunk_size)) + [n]
+        starts = set(bounds)
+
+        # backward liveness: cells needed from each chunk boundary on
+        live = set(self.output_addr)
+        live_at = {n: set(live)}
+        for i in reversed(range(n)):
+            live.discard(dst[i])
+            live.update(args[i])
+            if i in starts:
+                live_at[i] = set(live)
+
+        vec = "WORD" if self.words == 1 else "VEC"
+        out = []
+        out.append(SOURCE_PREFIX % dict(words=self.words, vec=vec))
+
+        for ichunk, (start, stop) in enumerate(zip(bounds, bounds[1:])):
+            written = set(dst[start:stop])
+            used = written.union(*args[start:stop])
+            live_in = sorted(live_at[start] & used)
+            live_out = sorted(live_at[stop] & written)
+
+            out.append(
+                "static __attribute__ ((noinline)) void chunk%d(%s *ram, %s NOTMASK, %s *trace, RandomFill rnd, void *X) {"
+                % (ichunk, vec, vec, vec)
+            )
+            if used:
+                out.append("    %s %s;" % (vec, ", ".join("m%d" % m for m in sorted(used))))
+            for m in live_in:
+                out.append("    m%d = ram[%d];" % (m, m))
+            for i in range(start, stop):
+                out.extend(self.generate_opcode(ops[i], dst[i], args[i], nodes[i], vec))
+            for m in live_out:
+                out.append("    ram[%d] = m%d;" % (m, m))
+            out.append("}")
+            out.append("")
+
+        out.append(SOURCE_RUN % dict(vec=vec))
+        for ichunk in range(len(bounds) - 1):
+            out.append("    chunk%d(ram, NOTMASK, trace, rnd, X);" % ichunk)
+        out.append("}")
+        out.append("")
+        return "\n".join(out)
+
+    def generate_opcode(self, op, dst, args, node, vec):
+        """Statements computing one opcode and tracing its gates from the given node on
+        (intermediates of fused opcodes in block-local variables)"""
+        m = ["m%d" % x for x in args]
+        if op in BINARY:
+            steps = ["%s %s %s" % (m[0], BINARY[op], m[1])]
+        elif op == OP_NOT:
+            steps = ["NOTMASK ^ %s" % m[0]]
+        elif op == OP_RANDOM:
+            steps = [None]
+        elif op == OP_XOR3 or op == OP_XORN:
+            steps = ["%s ^ %s" % (m[0], m[1])]
+            steps += ["t%d ^ %s" % (j, x) for j, x in enumerate(m[2:])]
+        elif op == OP_ANDXOR:
+            steps = ["%s & %s" % (m[1], m[2]), "%s ^ t0" % m[0]]
+        elif op == OP_ANDNOT:
+            steps = ["NOTMASK ^ %s" % m[0], "t0 & %s" % m[1]]
+        elif op == OP_MUX:
+            steps = ["%s ^ %s" % (m[0], m[1]), "%s & t0" % m[2], "%s ^ t1" % m[0]]
+        else:
+            raise ValueError(f"unknown opcode {op}")
+
+        res = []
+        if len(steps) > 1:
+            res.append("    {")
+        for j, expr in enumerate(steps):
+            var = "m%d" % dst if j == len(steps) - 1 else "t%d" % j
+            if expr is None:
+                res.append("    rnd(X, (WORD *)&%s, %d);" % (var, self.words))
+            elif var == "m%d" % dst:
+                res.append("    %s = %s;" % (var, expr))
+            else:
+                res.append("    %s %s = %s;" % (vec, var, expr))
+            res.append("    if (trace) trace[%d] = %s;" % (node + j, var))
+        if len(steps) > 1:
+            res.append("    }")
+        return res
+
+
+SOURCE_PREFIX = """\
+// generated by wboxkit.compiler
+#include <stdint.h>
+
+typedef uint64_t WORD;
+typedef uint64_t VEC __attribute__ ((vector_size (8 * %(words)d)));
+typedef void (*RandomFill)(void *X, WORD *dst, int n);
+"""
+
+SOURCE_RUN = """\
+void wboxkit_run(WORD *ram_words, const WORD *notmask, WORD *trace_words, RandomFill rnd, void *X) {
+    %(vec)s *ram = (%(vec)s *)ram_words;
+    %(vec)s *trace = (%(vec)s *)trace_words;
+    %(vec)s NOTMASK;
+    __builtin_memcpy(&NOTMASK, notmask, sizeof(NOTMASK));"""
+
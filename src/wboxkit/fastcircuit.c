@@ -4,99 +4,546 @@
 #include <string.h>
 #include <assert.h>
 #include <time.h>
+#ifndef _WIN32
+#include <sys/mman.h>
+#include <sys/stat.h>
+#endif
 #include "fastcircuit.h"
 
 
 EXPORT int RANDOM_ENABLED = 1;
 
-// Randomness
+/*
+Randomness: each context has its own counter-based generator
+(no shared state between threads): the i-th word of a stream is mix64(key + i * GAMMA),
+where the key is derived from a seed and a stream index.
+By default, the stream of a context is (global seed, context id);
+contexts pick up a new global seed lazily, on their next computation.
+context_set_seed selects the stream (seed, batch index) explicitly,
+so that any batch can be recomputed independently of the others.
+*/
+static uint64_t SEED = 0;
+static uint64_t SEED_EPOCH = 0;
+
+#define GAMMA 0x9e3779b97f4a7c15ull
+
 EXPORT void __attribute__ ((constructor)) set_seed_time() {
     struct timespec spec;
     clock_gettime(CLOCK_REALTIME, &spec);
-    srandom(spec.tv_sec);
-    srandom(random() ^ spec.tv_nsec);
+    set_seed(((uint64_t)spec.tv_sec << 32) ^ spec.tv_nsec);
 }
 EXPORT void set_seed(uint64_t seed) {
-    srandom(seed);
+    SEED = seed;
+    SEED_EPOCH++;
+}
+
+// splitmix64 finalizer
+static inline uint64_t mix64(uint64_t z) {
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ull;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebull;
+    return z ^ (z >> 31);
+}
+
+static inline uint64_t stream_key(uint64_t seed, uint64_t stream) {
+    return mix64(mix64(seed + GAMMA) ^ (stream * 0xd1342543de82ef95ull));
+}
+
+static void context_reseed(Context *X) {
+    X->rng_key = stream_key(SEED, X->id);
+    X->rng_counter = 0;
+    X->seed_epoch = SEED_EPOCH;
+}
+
+EXPORT void context_set_seed(Context *X, uint64_t seed, uint64_t batch_index) {
+    X->rng_key = stream_key(seed, batch_index);
+    X->rng_counter = 0;
+    // do not switch back to the global seed until it changes
+    X->seed_epoch = SEED_EPOCH;
+}
+
+EXPORT void circuit_set_seed(Circuit *C, uint64_t seed, uint64_t batch_index) {
+    context_set_seed(C->context, seed, batch_index);
+}
+
+static inline void fill_random(Context *X, WORD *dst, int n) {
+    if (!RANDOM_ENABLED) {
+        memset(dst, 0, sizeof(WORD) * n);
+        return;
+    }
+    const uint64_t key = X->rng_key;
+    const uint64_t counter = X->rng_counter;
+    for (int i = 0; i < n; i++)
+        dst[i] = mix64(key + (counter + i + 1) * GAMMA);
+    X->rng_counter = counter + n;
+}
+
+
+#define ALIGNMENT (sizeof(WORD) * MAX_LANE_WORDS)
+
+static void *malloc_aligned(size_t size) {
+    // aligned_alloc requires the size to be a multiple of the alignment
+    size = (size + ALIGNMENT - 1) / ALIGNMENT * ALIGNMENT;
+    if (!size) size = ALIGNMENT;
+    return aligned_alloc(ALIGNMENT, size);
+}
+
+/*
+Decoded code arrays are allocated in shared anonymous mappings (read-only once decoded):
+processes forked after loading a circuit keep sharing one physical copy,
+whereas malloc'ed pages may be duplicated on writes to neighbouring heap data.
+*/
+static void *alloc_code(size_t size) {
+#ifdef _WIN32
+    return malloc_aligned(size);
+#else
+    if (!size) size = 1;
+    void *p = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED | MAP_ANONYMOUS, -1, 0);
+    return p == MAP_FAILED ? NULL : p;
+#endif
+}
+
+static void seal_code(void *p, size_t size) {
+#ifndef _WIN32
+    if (!size) size = 1;
+    mprotect(p, size, PROT_READ);
+#endif
+}
+
+static void release_code(void *p, size_t size) {
+    if (!p) return;
+#ifdef _WIN32
+    free(p);
+#else
+    if (!size) size = 1;
+    munmap(p, size);
+#endif
 }
 
-static inline WORD randbit() {
-    if (RANDOM_ENABLED)
-        return random() ^ (((uint64_t)random()) << 32);
+static void free_code(Circuit *C) {
+    Code *code = &C->code;
+    uint64_t n = C->info.num_opcodes;
+    release_code(code->op, sizeof(BYTE) * n);
+    release_code(code->dst, code->addr_bytes * n);
+    release_code(code->a, code->addr_bytes * n);
+    release_code(code->b, code->addr_bytes * n);
+    release_code(code->c, code->addr_bytes * n);
+    release_code(code->args, code->addr_bytes * code->num_args);
+}
+
+static inline ADDR read_addr(const BYTE *p, int addr_bytes) {
+    if (addr_bytes == 2) {
+        ADDR16 addr;
+        memcpy(&addr, p, sizeof(addr));
+        return addr;
+    }
+    ADDR32 addr;
+    memcpy(&addr, p, sizeof(addr));
+    return addr;
+}
+
+static inline void store_addr(void *arr, uint64_t i, ADDR addr, int addr_bytes) {
+    if (addr_bytes == 2)
+        ((ADDR16 *)arr)[i] = addr;
     else
+        ((ADDR32 *)arr)[i] = addr;
+}
+
+/*
+Opcode stream reader, for both encodings:
+raw:     op (1 byte), dst, operands (A bytes each)
+compact: LEB128 varints; the first one holds the op in its low 4 bits
+         and the zigzag delta of dst from the previous dst above them,
+         operands are zigzag deltas from dst (the number of XORN operands is a plain varint)
+Addresses are not checked here (wrapped deltas give large values).
+*/
+typedef struct {
+    const BYTE *p, *end;
+    int A;
+    int compact;
+    uint64_t dst;  // previous destination (compact)
+    int error;  // set on truncated data
+} OpReader;
+
+static inline uint64_t read_varint(OpReader *R) {
+    uint64_t value = 0;
+    for (int shift = 0; shift < 64 && R->p < R->end; shift += 7) {
+        BYTE b = *R->p++;
+        value |= (uint64_t)(b & 0x7f) << shift;
+        if (!(b & 0x80))
+            return value;
+    }
+    R->error = 1;
+    return 0;
+}
+
+static inline uint64_t unzigzag(uint64_t v) {
+    return (v >> 1) ^ -(v & 1);
+}
+
+static inline uint64_t read_raw(OpReader *R, int size) {
+    if (R->end - R->p < size) {
+        R->error = 1;
         return 0;
+    }
+    uint64_t value = size == 1 ? *R->p : read_addr(R->p, size);
+    R->p += size;
+    return value;
 }
 
+static inline BYTE read_op(OpReader *R, uint64_t *dst) {
+    if (R->compact) {
+        uint64_t token = read_varint(R);
+        R->dst += unzigzag(token >> 4);
+        *dst = R->dst;
+        return token & 0xf;
+    }
+    BYTE op = read_raw(R, 1);
+    *dst = read_raw(R, R->A);
+    return op;
+}
 
-EXPORT Circuit *load_circuit(char *fname) {
-    if (!fname) {
-        fprintf(stderr, "no filename provided\n");
-        return NULL;
+static inline uint64_t read_operand(OpReader *R, uint64_t dst) {
+    if (R->compact)
+        return dst + unzigzag(read_varint(R));
+    return read_raw(R, R->A);
+}
+
+// number of operands of an opcode (after op and dst), -1 if unknown
+static inline int64_t num_operands(BYTE op, OpReader *R) {
+    switch (op) {
+    case RANDOM:
+        return 0;
+    case NOT:
+        return 1;
+    case XOR:
+    case AND:
+    case OR:
+    case ANDNOT:
+        return 2;
+    case XOR3:
+    case ANDXOR:
+    case MUX:
+        return 3;
+    case XORN: {
+        uint64_t n = R->compact ? read_varint(R) : read_raw(R, R->A);
+        return n >= 2 && n < (1ull << 8 * R->A) ? (int64_t)n : -1;
     }
-    FILE * fd = fopen(fname, "r");
-    if (!fd) {
-        fprintf(stderr, "can not open file %s\n", fname);
-        return NULL;
     }
+    return -1;
+}
+
+// number of gates (trace nodes) of an opcode with n operands
+static inline uint64_t num_gates(BYTE op, uint64_t n) {
+    switch (op) {
+    case XOR3:
+    case ANDXOR:
+    case ANDNOT:
+        return 2;
+    case MUX:
+        return 3;
+    case XORN:
+        return n - 1;
+    }
+    return 1;
+}
 
-    Circuit *C = malloc(sizeof(Circuit));
+/*
+Decode the variable-length opcode stream into the arrays of C->code,
+checking opcodes and addresses once instead of on every execution.
+The first pass checks the structure and counts the XORN operands,
+the second one fills the arrays.
+*/
+static int decode_opcodes(Circuit *C, const BYTE *start, uint64_t size, int compact) {
     CircuitInfo *I = &C->info;
+    Code *code = &C->code;
+    int A = code->addr_bytes;
+    OpReader R = {start, start + size, A, compact, 0, 0};
+
+    code->num_args = 0;
+    code->num_nodes = 0;
+    for (uint64_t i = 0; i < I->num_opcodes; i++) {
+        uint64_t dst;
+        BYTE op = read_op(&R, &dst);
+        int64_t n = num_operands(op, &R);
+        if (R.error) goto malformed;
+        if (n < 0) {
+            fprintf(stderr, "unknown opcode %d at %lu\n", op, (unsigned long)i);
+            return 0;
+        }
+        if (op == XORN)
+            code->num_args += n - 2;
+        for (int64_t j = 0; j < n && !R.error; j++)
+            read_operand(&R, dst);
+        if (R.error) goto malformed;
+        code->num_nodes += num_gates(op, n);
+    }
+    if (R.p != R.end) goto malformed;
+
+    code->op = alloc_code(sizeof(BYTE) * I->num_opcodes);
+    code->dst = alloc_code(A * I->num_opcodes);
+    code->a = alloc_code(A * I->num_opcodes);
+    code->b = alloc_code(A * I->num_opcodes);
+    code->c = alloc_code(A * I->num_opcodes);
+    code->args = alloc_code(A * code->num_args);
+    if (!(code->op && code->dst && code->a && code->b && code->c && code->args)) {
+        fprintf(stderr, "malloc failed\n");
+        return 0;
+    }
+
+    R = (OpReader){start, start + size, A, compact, 0, 0};
+    uint64_t k = 0;
+    for (uint64_t i = 0; i < I->num_opcodes; i++) {
+        uint64_t dst;
+        BYTE op = read_op(&R, &dst);
+        int64_t n = num_operands(op, &R);
+        ADDR operands[3] = {0, 0, 0};
+        int bad = dst >= I->memory;
+        for (int64_t j = 0; j < n; j++) {
+            uint64_t addr = read_operand(&R, dst);
+            bad |= addr >= I->memory;
+            if (j < 2 || op != XORN)
+                operands[j] = addr;
+            else
+                store_addr(code->args, k++, addr, A);
+        }
+        if (bad) {
+            fprintf(stderr, "address out of memory at opcode %lu\n", (unsigned long)i);
+            return 0;
+        }
+        if (op == XORN)
+            operands[2] = n - 2;
+        code->op[i] = op;
+        store_addr(code->dst, i, dst, A);
+        store_addr(code->a, i, operands[0], A);
+        store_addr(code->b, i, operands[1], A);
+        store_addr(code->c, i, operands[2], A);
+    }
+    seal_code(code->op, sizeof(BYTE) * I->num_opcodes);
+    seal_code(code->dst, A * I->num_opcodes);
+    seal_code(code->a, A * I->num_opcodes);
+    seal_code(code->b, A * I->num_opcodes);
+    seal_code(code->c, A * I->num_opcodes);
+    seal_code(code->args, A * code->num_args);
+    return 1;
+
+malformed:
+    fprintf(stderr, "malformed circuit file\n");
+    return 0;
+}
+
+static int read_addrs(const BYTE **p, const BYTE *end, ADDR *dst, uint64_t n, int addr_bytes) {
+    if ((uint64_t)(end - *p) / addr_bytes < n)
+        return 0;
+    for (uint64_t i = 0; i < n; i++) {
+        dst[i] = read_addr(*p, addr_bytes);
+        *p += addr_bytes;
+    }
+    return 1;
+}
+
+/*
+Load a serialized circuit (header, input/output addresses, opcodes) from memory,
+e.g. the output of RawSerializer.serialize; the data is not referenced afterwards.
+*/
+EXPORT Circuit *load_circuit_bytes(const uint8_t *data, uint64_t size) {
+    if (!data) {
+        fprintf(stderr, "no circuit data provided\n");
+        return NULL;
+    }
+    const BYTE *p = data, *end = data + size;
+
+    Circuit *C = calloc(1, sizeof(Circuit));
     if (!C) {
         fprintf(stderr, "malloc failed\n");
-        goto fail;
+        return NULL;
     }
+    CircuitInfo *I = &C->info;
 
-    if (sizeof(CircuitInfo) != fread(I, 1, sizeof(CircuitInfo), fd)) {
-        fprintf(stderr, "malformed circuit file\n");
+    if (size < sizeof(CircuitInfo)) goto malformed;
+    memcpy(I, p, sizeof(CircuitInfo));
+    p += sizeof(CircuitInfo);
+
+    int compact = (I->memory >> MEMORY_BITS) & COMPACT_OPCODES;
+    int regions = (I->memory >> MEMORY_BITS) & REGION_TABLE;
+    C->code.addr_bytes = (I->memory >> MEMORY_BITS) & ~(COMPACT_OPCODES | REGION_TABLE);
+    I->memory &= (1ull << MEMORY_BITS) - 1;
+    if (C->code.addr_bytes == 0)
+        C->code.addr_bytes = 2;
+    if (C->code.addr_bytes != 2 && C->code.addr_bytes != 4) {
+        fprintf(stderr, "unsupported address size %d\n", C->code.addr_bytes);
         goto fail;
     }
+    if (C->code.addr_bytes == 2 && I->memory > (1ull << 16)) goto malformed;
+    if (I->memory > (1ull << 32)) goto malformed;
+    // bounds before allocating anything
+    uint64_t n_addrs = (uint64_t)(end - p) / C->code.addr_bytes;
+    if (I->input_size > n_addrs || I->output_size > n_addrs - I->input_size) goto malformed;
 
     C->input_addr = malloc(sizeof(ADDR) * I->input_size);
     C->output_addr = malloc(sizeof(ADDR) * I->output_size);
     if (!(C->input_addr)) goto fail;
     if (!(C->output_addr)) goto fail;
 
-    if(I->input_size != fread(C->input_addr, sizeof(ADDR), I->input_size, fd)) {
-        fprintf(stderr, "malformed circuit file\n");
-        goto fail;
-    }
-    if(I->output_size != fread(C->output_addr, sizeof(ADDR), I->output_size, fd)) {
-        fprintf(stderr, "malformed circuit file\n");
-        goto fail;
-    }
+    if (!read_addrs(&p, end, C->input_addr, I->input_size, C->code.addr_bytes)) goto malformed;
+    if (!read_addrs(&p, end, C->output_addr, I->output_size, C->code.addr_bytes)) goto malformed;
+    for (uint64_t i = 0; i < I->input_size; i++)
+        if (C->input_addr[i] >= I->memory) goto malformed;
+    for (uint64_t i = 0; i < I->output_size; i++)
+        if (C->output_addr[i] >= I->memory) goto malformed;
 
-    C->opcodes = malloc(sizeof(BYTE) * I->opcodes_size);
-    if (!(C->opcodes)) {
-        fprintf(stderr, "malformed circuit file\n");
-        goto fail;
-    }
+    if (regions ? I->opcodes_size > (uint64_t)(end - p) : I->opcodes_size != (uint64_t)(end - p))
+        goto malformed;
+    // each opcode takes at least an op byte and a destination (one byte for both if compact)
+    if (I->num_opcodes > I->opcodes_size / (compact ? 1 : 1 + C->code.addr_bytes)) goto malformed;
 
-    if (I->opcodes_size != fread(C->opcodes, sizeof(BYTE), I->opcodes_size, fd)) {
-        fprintf(stderr, "malformed circuit file\n");
+    if (!decode_opcodes(C, p, I->opcodes_size, compact))
         goto fail;
-    }
 
-    C->ram = malloc(sizeof(WORD) * I->memory);
-    if (!(C->ram)) {
+    C->num_contexts = 0;
+    C->context = new_context(C);
+    if (!(C->context)) {
         fprintf(stderr, "malloc failed\n");
         goto fail;
     }
-    fclose(fd);
     return C;
 
+malformed:
+    fprintf(stderr, "malformed circuit file\n");
 fail:
-    fclose(fd);
+    free_circuit(C);
     return NULL;
 }
 
+/*
+The file is mapped rather than read: its pages come from the page cache,
+shared by all processes loading the same circuit.
+*/
+EXPORT Circuit *load_circuit(char *fname) {
+    if (!fname) {
+        fprintf(stderr, "no filename provided\n");
+        return NULL;
+    }
+    FILE * fd = fopen(fname, "rb");
+    if (!fd) {
+        fprintf(stderr, "can not open file %s\n", fname);
+        return NULL;
+    }
+
+    Circuit *C = NULL;
+#ifdef _WIN32
+    BYTE *data = NULL;
+    long size;
+    if (fseek(fd, 0, SEEK_END) || (size = ftell(fd)) < 0 || fseek(fd, 0, SEEK_SET)) {
+        fprintf(stderr, "can not read file %s\n", fname);
+        goto done;
+    }
+    data = malloc(size ? size : 1);
+    if (!data) {
+        fprintf(stderr, "malloc failed\n");
+        goto done;
+    }
+    if ((size_t)size != fread(data, 1, size, fd)) {
+        fprintf(stderr, "can not read file %s\n", fname);
+        goto done;
+    }
+    C = load_circuit_bytes(data, size);
+done:
+    free(data);
+#else
+    struct stat st;
+    if (fstat(fileno(fd), &st)) {
+        fprintf(stderr, "can not read file %s\n", fname);
+        goto done;
+    }
+    if (st.st_size == 0) {
+        fprintf(stderr, "malformed circuit file\n");
+        goto done;
+    }
+    void *data = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fileno(fd), 0);
+    if (data == MAP_FAILED) {
+        fprintf(stderr, "can not map file %s\n", fname);
+        goto done;
+    }
+    madvise(data, st.st_size, MADV_SEQUENTIAL);
+    C = load_circuit_bytes(data, st.st_size);
+    munmap(data, st.st_size);
+done:
+#endif
+    fclose(fd);
+    return C;
+}
+
 EXPORT void free_circuit(Circuit *C) {
+    if (!C) return;
+    free_context(C->context);
     free(C->input_addr);
     free(C->output_addr);
-    free(C->opcodes);
-    free(C->ram);
+    free_code(C);
     free(C);
 }
 
+EXPORT int circuit_set_compiled(Circuit *C, CompiledRun run, int words) {
+    if (run && !(words == 1 || words == 2 || words == 4 || words == MAX_LANE_WORDS)) {
+        fprintf(stderr, "unsupported number of words per wire %d\n", words);
+        return 0;
+    }
+    C->compiled.run = run;
+    C->compiled.words = run ? words : 0;
+    return 1;
+}
+
+/*
+Trace only nodes i with select[i] = 1 (select has code.num_nodes entries, 0 or 1).
+The filter is copied, NULL removes it.
+*/
+EXPORT int context_set_trace_filter(Context *X, const uint8_t *select) {
+    uint64_t n = X->circuit->code.num_nodes;
+    uint8_t *copy = NULL;
+    if (select) {
+        copy = malloc(n ? n : 1);
+        if (!copy) {
+            fprintf(stderr, "malloc failed\n");
+            return 0;
+        }
+        for (uint64_t i = 0; i < n; i++)
+            copy[i] = select[i] ? 1 : 0;
+    }
+    free(X->trace_select);
+    X->trace_select = copy;
+    return 1;
+}
+
+EXPORT int circuit_set_trace_filter(Circuit *C, const uint8_t *select) {
+    return context_set_trace_filter(C->context, select);
+}
+
+EXPORT Context *new_context(Circuit *C) {
+    Context *X = malloc(sizeof(Context));
+    if (!X) return NULL;
+    X->circuit = C;
+    X->trace = NULL;
+    X->trace_buf = NULL;
+    X->trace_buf_size = 0;
+    X->trace_select = NULL;
+    X->ram = malloc_aligned(sizeof(WORD) * MAX_LANE_WORDS * C->info.memory);
+    if (!(X->ram)) {
+        free(X);
+        return NULL;
+    }
+    X->id = __atomic_fetch_add(&C->num_contexts, 1, __ATOMIC_RELAXED);
+    context_reseed(X);
+    return X;
+}
+
+EXPORT void free_context(Context *X) {
+    if (!X) return;
+    free(X->ram);
+    free(X->trace);
+    free(X->trace_buf);
+    free(X->trace_select);
+    free(X);
+}
+
 /*
 Bits in bytes: MSB to LSB
 Bytes in word: LSB to MSB, because will be packed as Little Endian
@@ -107,102 +554,477 @@ static inline WORD io_bit(int bit) {
     bit += 7 - lo;
     return bit;
 }
-EXPORT int circuit_compute(Circuit *C, uint8_t *inp, uint8_t *out, char *trace_filename, int batch) {
-    CircuitInfo *I = &C->info;
-    WORD *ram = C->ram;
-    bzero(ram, I->memory);
 
-    WORD NOTMASK = 0;
-    for (int j = 0; j < batch; j++)
-        NOTMASK |= 1 << io_bit(j);
+/*
+Bit matrices (inputs, outputs, traces) have rows of bits packed MSB first.
+They are converted in 64x64 blocks: a block is an array of 64 words,
+row r in A[r] with column c at bit 63 - c (big-endian load of the row's bytes).
+A wire word (lane j at bit io_bit(j)) is the byte-swapped column of such a block.
+*/
+static inline uint64_t load_be64(const uint8_t *p, uint64_t n) {
+    uint64_t res = 0;
+    if (n >= 8) {
+        memcpy(&res, p, 8);
+        return __builtin_bswap64(res);
+    }
+    for (uint64_t k = 0; k < 8; k++)
+        res = (res << 8) | (k < n ? p[k] : 0);
+    return res;
+}
 
-    FILE * ftrace = NULL;
-    if (trace_filename) {
-        ftrace = fopen(trace_filename, "w");
-        if (!ftrace) {
-            fprintf(stderr, "can not open the trace file %s\n", trace_filename);
+static inline void store_be64(uint8_t *p, uint64_t v, uint64_t n) {
+    if (n >= 8) {
+        v = __builtin_bswap64(v);
+        memcpy(p, &v, 8);
+        return;
+    }
+    for (uint64_t k = 0; k < n; k++)
+        p[k] = v >> (56 - 8 * k);
+}
+
+// Hacker's Delight, 7-3 (extended to 64 bits)
+static void transpose64(uint64_t A[64]) {
+    uint64_t m = 0x00000000ffffffffull;
+    for (int j = 32; j; j >>= 1, m ^= m << j) {
+        for (int k = 0; k < 64; k = ((k | j) + 1) & ~j) {
+            uint64_t t = (A[k] ^ (A[k | j] >> j)) & m;
+            A[k] ^= t;
+            A[k | j] ^= t << j;
+        }
+    }
+}
+
+/*
+Transpose a bit matrix of rows x cols (rows of (cols + 7) / 8 bytes)
+into cols x rows (rows of (rows + 7) / 8 bytes).
+*/
+EXPORT void transpose_bits(const uint8_t *in, uint8_t *out, uint64_t rows, uint64_t cols) {
+    uint64_t in_bytes = (cols + 7) / 8;
+    uint64_t out_bytes = (rows + 7) / 8;
+    uint64_t A[64];
+    for (uint64_t r0 = 0; r0 < rows; r0 += 64) {
+        uint64_t nrows = rows - r0 < 64 ? rows - r0 : 64;
+        for (uint64_t c0 = 0; c0 < cols; c0 += 64) {
+            uint64_t ncols = cols - c0 < 64 ? cols - c0 : 64;
+            for (uint64_t r = 0; r < 64; r++)
+                A[r] = r < nrows ? load_be64(in + (r0 + r) * in_bytes + c0 / 8, in_bytes - c0 / 8) : 0;
+            transpose64(A);
+            for (uint64_t c = 0; c < ncols; c++)
+                store_be64(out + (c0 + c) * out_bytes + r0 / 8, A[c], out_bytes - r0 / 8);
+        }
+    }
+}
+
+// one byte (0 or 1) per bit, bits packed MSB first
+EXPORT void unpack_bits(const uint8_t *in, uint8_t *out, uint64_t nbits) {
+    for (uint64_t i = 0; i < nbits / 8; i++) {
+        uint8_t b = in[i];
+        for (int k = 0; k < 8; k++)
+            out[8 * i + k] = (b >> (7 - k)) & 1;
+    }
+    for (uint64_t i = nbits & ~7ull; i < nbits; i++)
+        out[i] = (in[i / 8] >> (7 - i % 8)) & 1;
+}
+
+// copy the first nbits of each row of in into the rows of out from the bit offset
+// (bits packed MSB first), keeping the other bits of out
+EXPORT void copy_bit_rows(const uint8_t *in, uint8_t *out, uint64_t rows,
+    uint64_t in_stride, uint64_t out_stride, uint64_t offset, uint64_t nbits)
+{
+    unsigned shift = offset % 8;
+    for (uint64_t r = 0; r < rows; r++) {
+        const uint8_t *src = in + r * in_stride;
+        uint8_t *dst = out + r * out_stride + offset / 8;
+        for (uint64_t i = 0; i < nbits; i += 8) {
+            unsigned n = nbits - i < 8 ? nbits - i : 8;
+            uint8_t mask = 0xff << (8 - n);
+            uint8_t b = src[i / 8] & mask;
+            uint8_t *d = dst + i / 8;
+            d[0] = (d[0] & ~(mask >> shift)) | (b >> shift);
+            uint8_t low = mask << (8 - shift);
+            if (shift && low)
+                d[1] = (d[1] & ~low) | (uint8_t)(b << (8 - shift));
+        }
+    }
+}
+
+/*
+Tracing: instead of one fwrite per node (often a single byte),
+node values are collected in a per-context buffer of TRACE_BUFFER_SIZE bytes
+and written out in large blocks (to a file or passed to a callback).
+*/
+static uint64_t TRACE_BUFFER_SIZE = 4 << 20;
+
+EXPORT void set_trace_buffer_size(uint64_t size) {
+    if (size < MAX_LANE_WORDS * sizeof(WORD))
+        size = MAX_LANE_WORDS * sizeof(WORD);
+    TRACE_BUFFER_SIZE = size;
+}
+
+static int trace_flush(TraceSink *T) {
+    if (T->callback) {
+        // aborted by the callback
+        if (T->pos && !T->callback(T->buf, T->pos, T->callback_arg))
+            return 0;
+        T->pos = 0;
+        return 1;
+    }
+    if (!T->file) {
+        // in-memory trace, sized for the whole computation
+        fprintf(stderr, "trace buffer overflow\n");
+        return 0;
+    }
+    if (T->pos && T->pos != fwrite(T->buf, 1, T->pos, T->file)) {
+        fprintf(stderr, "error writing the trace file\n");
+        return 0;
+    }
+    T->pos = 0;
+    return 1;
+}
+
+static inline int trace_write(TraceSink *T, const void *data, int n) {
+    if (T->pos + n > T->size && !trace_flush(T))
+        return 0;
+    memcpy(T->buf + T->pos, data, n);
+    T->pos += n;
+    return 1;
+}
+
+// write the value of the i-th node (gate) if it is selected
+static inline int trace_node(TraceSink *T, uint64_t i, const void *data, int n) {
+    if (T->select && !T->select[i])
+        return 1;
+    return trace_write(T, data, n);
+}
+
+// sink using the context's buffer, with no output set
+static int trace_init(Context *X, TraceSink *T) {
+    if (X->trace_buf_size != TRACE_BUFFER_SIZE) {
+        free(X->trace_buf);
+        X->trace_buf = malloc(TRACE_BUFFER_SIZE);
+        X->trace_buf_size = X->trace_buf ? TRACE_BUFFER_SIZE : 0;
+        if (!X->trace_buf) {
+            fprintf(stderr, "malloc failed\n");
             return 0;
         }
     }
-    int trace_item_bytes = 1;
-    if (batch > 8) trace_item_bytes = 2;
-    if (batch > 16) trace_item_bytes = 4;
-    if (batch > 32) trace_item_bytes = 8;
+    T->select = X->trace_select;
+    T->file = NULL;
+    T->callback = NULL;
+    T->callback_arg = NULL;
+    T->buf = X->trace_buf;
+    T->size = X->trace_buf_size;
+    T->pos = 0;
+    return 1;
+}
 
-    if (!(1 <= batch && batch <= 64)) {
-        goto fail;
+static int trace_open(Context *X, TraceSink *T, char *filename) {
+    if (!trace_init(X, T))
+        return 0;
+    T->file = fopen(filename, "w");
+    if (!T->file) {
+        fprintf(stderr, "can not open the trace file %s\n", filename);
+        return 0;
     }
-    int bytes_per_input = (I->input_size + 7) / 8;
-    int bytes_per_output = (I->output_size + 7) / 8;
+    // buffering is done by the sink
+    setvbuf(T->file, NULL, _IONBF, 0);
+    return 1;
+}
+
+static int trace_close(TraceSink *T) {
+    int ok = trace_flush(T);
+    if (T->file && fclose(T->file)) {
+        fprintf(stderr, "error writing the trace file\n");
+        ok = 0;
+    }
+    return ok;
+}
+
+// bytes per node in a trace of a batch
+static int trace_item_size(int batch) {
+    int res = 1;
+    while (res * 8 < batch)
+        res *= 2;
+    return res;
+}
+
+// for compiled circuits: as many words as the interpreter draws for the batch,
+// so that the random stream does not depend on the lanes of the compiled code
+static void randwords(Context *X, WORD *dst, int n) {
+    fill_random(X, dst, X->rng_words);
+    memset(dst + X->rng_words, 0, sizeof(WORD) * (n - X->rng_words));
+}
+
+/*
+Evaluation engines: the same interpreter loop instantiated for several
+lane widths (see fastcircuit_engine.h). Wider ones are compiled for the
+corresponding instruction set and picked at runtime by CPU detection,
+the generic versions (GCC vector extensions) are the portable fallback.
+*/
+typedef int (*Engine)(Context *X, const WORD *notmask, TraceSink *trace, int trace_item_bytes);
+
+typedef uint64_t V128 __attribute__ ((vector_size (16)));
+typedef uint64_t V256 __attribute__ ((vector_size (32)));
+typedef uint64_t V512 __attribute__ ((vector_size (64)));
+
+#define ENGINE_NAME run_64
+#define ENGINE_VEC WORD
+#define ENGINE_ATTRS
+#include "fastcircuit_engine.h"
+
+#define ENGINE_NAME run_128
+#define ENGINE_VEC V128
+#define ENGINE_ATTRS
+#include "fastcircuit_engine.h"
+
+#define ENGINE_NAME run_256
+#define ENGINE_VEC V256
+#define ENGINE_ATTRS
+#include "fastcircuit_engine.h"
+
+#define ENGINE_NAME run_512
+#define ENGINE_VEC V512
+#define ENGINE_ATTRS
+#include "fastcircuit_engine.h"
 
-    // load input
-    for (int j = 0; j < batch; j++) {
-        for (int i = 0; i < I->input_size; i++) {
-            int byte = i >> 3;
-            int bit = 7 - (i & 7);
-            WORD value = (inp[byte]>>bit) & 1;
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define HAVE_X86_ENGINES
 
-            if (j == 0) ram[C->input_addr[i]] = 0;
-            ram[C->input_addr[i]] |= value << io_bit(j);
+#define ENGINE_NAME run_128_sse2
+#define ENGINE_VEC V128
+#define ENGINE_ATTRS __attribute__ ((target ("sse2")))
+#include "fastcircuit_engine.h"
+
+#define ENGINE_NAME run_256_avx2
+#define ENGINE_VEC V256
+#define ENGINE_ATTRS __attribute__ ((target ("avx2")))
+#include "fastcircuit_engine.h"
+
+#define ENGINE_NAME run_512_avx512
+#define ENGINE_VEC V512
+#define ENGINE_ATTRS __attribute__ ((target ("avx512f")))
+#include "fastcircuit_engine.h"
+#endif
+
+static int run_compiled(Context *X, const WORD *notmask, TraceSink *trace, int trace_item_bytes) {
+    Circuit *C = X->circuit;
+    int W = C->compiled.words;
+    WORD *values = NULL;
+    if (trace) {
+        if (!X->trace)
+            X->trace = malloc_aligned(sizeof(WORD) * W * C->code.num_nodes);
+        if (!X->trace) {
+            fprintf(stderr, "malloc failed\n");
+            return 0;
         }
-        inp += bytes_per_input;
+        values = X->trace;
     }
 
-    // compute circuit
-    BYTE *p = C->opcodes;
-    for(int i = 0; i < I->num_opcodes; i++) {
-        BYTE op = *p++;
-        ADDR dst = *((ADDR *)p); p+=2;
-        ADDR a, b;
-        switch (op) {
-        case XOR:
-            a = *((ADDR *)p); p+=2;
-            b = *((ADDR *)p); p+=2;
-            ram[dst] = ram[a] ^ ram[b];
-            break;
-        case AND:
-            a = *((ADDR *)p); p+=2;
-            b = *((ADDR *)p); p+=2;
-            ram[dst] = ram[a] & ram[b];
-            break;
-        case OR:
-            a = *((ADDR *)p); p+=2;
-            b = *((ADDR *)p); p+=2;
-            ram[dst] = ram[a] | ram[b];
-            break;
-        case NOT:
-            a = *((ADDR *)p); p+=2;
-            ram[dst] = NOTMASK ^ ram[a];
-            break;
-        case RANDOM:
-            ram[dst] = randbit();
-            break;
-        default:
-            fprintf(stderr, "unknown opcode %d\n", op);
-            goto fail;
+    C->compiled.run(X->ram, notmask, values, randwords, X);
+
+    if (trace) {
+        for (uint64_t i = 0; i < C->code.num_nodes; i++)
+            if (!trace_node(trace, i, values + i * W, trace_item_bytes))
+                return 0;
+    }
+    return 1;
+}
+
+// indexed by log2 of the number of words per wire
+#define NUM_ENGINES 4
+static Engine ENGINES[NUM_ENGINES] = {run_64, run_128, run_256, run_512};
+static const char *ENGINE_NAMES[NUM_ENGINES] = {"64", "128", "256", "512"};
+// widest engine backed by native vector instructions
+static int NATIVE_BATCH = 64;
+
+static void __attribute__ ((constructor)) select_engines() {
+#ifdef HAVE_X86_ENGINES
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("sse2")) {
+        ENGINES[1] = run_128_sse2;
+        ENGINE_NAMES[1] = "128-sse2";
+        NATIVE_BATCH = 128;
+    }
+    if (__builtin_cpu_supports("avx2")) {
+        ENGINES[2] = run_256_avx2;
+        ENGINE_NAMES[2] = "256-avx2";
+        NATIVE_BATCH = 256;
+    }
+    if (__builtin_cpu_supports("avx512f")) {
+        ENGINES[3] = run_512_avx512;
+        ENGINE_NAMES[3] = "512-avx512";
+        NATIVE_BATCH = 512;
+    }
+#endif
+}
+
+static int engine_index(int batch) {
+    int index = 0;
+    while ((64 << index) < batch)
+        index++;
+    return index;
+}
+
+EXPORT int max_batch() {
+    return NATIVE_BATCH;
+}
+
+EXPORT const char *engine_name(int batch) {
+    if (!(1 <= batch && batch <= MAX_BATCH))
+        return NULL;
+    return ENGINE_NAMES[engine_index(batch)];
+}
+
+EXPORT int circuit_compute(Circuit *C, uint8_t *inp, uint8_t *out, char *trace_filename, int batch) {
+    return context_compute(C->context, inp, out, trace_filename, batch);
+}
+
+EXPORT int circuit_compute_mem(Circuit *C, uint8_t *inp, uint8_t *out, uint8_t *trace, int batch) {
+    return context_compute_mem(C->context, inp, out, trace, batch);
+}
+
+EXPORT int circuit_compute_stream(Circuit *C, uint8_t *inp, uint8_t *out, TraceCallback callback, void *arg, int batch) {
+    return context_compute_stream(C->context, inp, out, callback, arg, batch);
+}
+
+// number of words per wire used to compute the batch, 0 if not supported
+static int batch_words(Context *X, int batch) {
+    Circuit *C = X->circuit;
+    if (!(1 <= batch && batch <= MAX_BATCH)) {
+        fprintf(stderr, "unsupported batch size %d (max %d)\n", batch, MAX_BATCH);
+        return 0;
+    }
+    if (C->compiled.run) {
+        if (batch > 64 * C->compiled.words) {
+            fprintf(stderr, "batch size %d is too large for the compiled circuit (max %d)\n", batch, 64 * C->compiled.words);
+            return 0;
         }
+        return C->compiled.words;
+    }
+    return 1 << engine_index(batch);
+}
+
+static int compute(Context *X, uint8_t *inp, uint8_t *out, TraceSink *trace, int batch, int W) {
+    Circuit *C = X->circuit;
+    CircuitInfo *I = &C->info;
+    WORD *ram = X->ram;
+
+    bzero(ram, sizeof(WORD) * W * I->memory);
 
-        if (ftrace) {
-            fwrite(ram+dst, 1, trace_item_bytes, ftrace);
+    WORD NOTMASK[MAX_LANE_WORDS] = {0};
+    for (int j = 0; j < batch; j++)
+        NOTMASK[j >> 6] |= 1ull << io_bit(j & 63);
+
+    int trace_item_bytes = trace_item_size(batch);
+
+    int bytes_per_input = (I->input_size + 7) / 8;
+    int bytes_per_output = (I->output_size + 7) / 8;
+
+    // load input (transposed in 64x64 blocks)
+    uint64_t A[64];
+    for (int g = 0; g * 64 < batch; g++) {
+        int rows = batch - g * 64 < 64 ? batch - g * 64 : 64;
+        for (uint64_t i0 = 0; i0 < I->input_size; i0 += 64) {
+            int cols = I->input_size - i0 < 64 ? I->input_size - i0 : 64;
+            for (int r = 0; r < 64; r++)
+                A[r] = r < rows ? load_be64(inp + (g * 64 + r) * bytes_per_input + i0 / 8, bytes_per_input - i0 / 8) : 0;
+            transpose64(A);
+            for (int c = 0; c < cols; c++)
+                ram[C->input_addr[i0 + c] * W + g] |= __builtin_bswap64(A[c]);
         }
     }
 
-    // extract output
-    for (int j = 0; j < batch; j++) {
-        for (int i = 0; i < I->output_size; i++) {
-            int byte = i >> 3;
-            int bit = 7 - (i & 7);
-            WORD value = (ram[C->output_addr[i]] >> io_bit(j)) & 1;
+    // compute circuit
+    if (X->seed_epoch != SEED_EPOCH)
+        context_reseed(X);
 
-            if (bit == 7) out[byte] = 0;
-            out[byte] |= value << bit;
+    if (C->compiled.run) {
+        X->rng_words = 1 << engine_index(batch);
+        if (!run_compiled(X, NOTMASK, trace, trace_item_bytes))
+            return 0;
+    }
+    else if (!ENGINES[engine_index(W * 64)](X, NOTMASK, trace, trace_item_bytes))
+        return 0;
+
+    // extract output (transposed in 64x64 blocks)
+    for (int g = 0; g * 64 < batch; g++) {
+        int rows = batch - g * 64 < 64 ? batch - g * 64 : 64;
+        for (uint64_t i0 = 0; i0 < I->output_size; i0 += 64) {
+            int cols = I->output_size - i0 < 64 ? I->output_size - i0 : 64;
+            for (int c = 0; c < 64; c++)
+                A[c] = c < cols ? __builtin_bswap64(ram[C->output_addr[i0 + c] * W + g]) : 0;
+            transpose64(A);
+            for (int r = 0; r < rows; r++)
+                store_be64(out + (g * 64 + r) * bytes_per_output + i0 / 8, A[r], bytes_per_output - i0 / 8);
         }
-        out += bytes_per_output;
     }
-    if (ftrace) fclose(ftrace);
     return 1;
+}
 
-fail:
-    if (ftrace) fclose(ftrace);
-    return 0;    
+EXPORT int context_compute(Context *X, uint8_t *inp, uint8_t *out, char *trace_filename, int batch) {
+    int W = batch_words(X, batch);
+    if (!W)
+        return 0;
+
+    TraceSink sink;
+    TraceSink *trace = NULL;
+    if (trace_filename) {
+        if (!trace_open(X, &sink, trace_filename))
+            return 0;
+        trace = &sink;
+    }
+
+    int ret = compute(X, inp, out, trace, batch, W);
+    if (trace && !trace_close(trace))
+        return 0;
+    return ret;
+}
+
+/*
+Same as context_compute, but the trace is stored in memory:
+trace must hold (number of traced nodes) * trace_item_bytes bytes (same layout as trace files).
+*/
+EXPORT int context_compute_mem(Context *X, uint8_t *inp, uint8_t *out, uint8_t *trace, int batch) {
+    int W = batch_words(X, batch);
+    if (!W)
+        return 0;
+
+    uint64_t num_traced = X->circuit->code.num_nodes;
+    if (X->trace_select) {
+        num_traced = 0;
+        for (uint64_t i = 0; i < X->circuit->code.num_nodes; i++)
+            num_traced += X->trace_select[i];
+    }
+
+    TraceSink sink;
+    sink.select = X->trace_select;
+    sink.file = NULL;
+    sink.callback = NULL;
+    sink.callback_arg = NULL;
+    sink.buf = trace;
+    sink.size = num_traced * trace_item_size(batch);
+    sink.pos = 0;
+    return compute(X, inp, out, &sink, batch, W);
+}
+
+/*
+Same as context_compute, but the trace is passed to callback(data, size, arg) in blocks
+of up to TRACE_BUFFER_SIZE bytes (whole nodes, same layout as trace files)
+while the circuit is computed; the callback returns 0 to abort.
+*/
+EXPORT int context_compute_stream(Context *X, uint8_t *inp, uint8_t *out, TraceCallback callback, void *arg, int batch) {
+    int W = batch_words(X, batch);
+    if (!W)
+        return 0;
+
+    TraceSink sink;
+    if (!trace_init(X, &sink))
+        return 0;
+    sink.callback = callback;
+    sink.callback_arg = arg;
+
+    int ret = compute(X, inp, out, &sink, batch, W);
+    if (!trace_close(&sink))
+        return 0;
+    return ret;
 }
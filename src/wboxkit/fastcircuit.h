@@ -1,5 +1,6 @@
 #ifndef WBOXKIT_FASTCIRCUIT_H
 #define WBOXKIT_FASTCIRCUIT_H
+#include <stdio.h>
 #include <stdint.h>
 
 #ifdef _WIN32
@@ -8,11 +9,25 @@
 #define EXPORT
 #endif
 
-// depends on the need of batch executions, may be reduced to char (e.g., for challenge submission)
+// one machine word holds 64 lanes (executions) of a single circuit wire
 typedef uint64_t WORD;
 
-// if circuit requires more memory than 2^16 bits, need to change this
-typedef uint16_t ADDR;
+// wider engines process several words per wire at once:
+// 1 word = 64 lanes (scalar), 2 = 128 (SSE2), 4 = 256 (AVX2), 8 = 512 (AVX-512)
+#define MAX_LANE_WORDS 8
+#define MAX_BATCH (64 * MAX_LANE_WORDS)
+
+// addresses are stored in 2 bytes, or in 4 bytes for circuits with more than 2^16 memory cells;
+// the address size is stored in the top byte of CircuitInfo.memory in the file (0 means 2),
+// along with the COMPACT_OPCODES flag (opcodes encoded as varints, see CompactRawSerializer)
+// and the REGION_TABLE flag (the opcodes are followed by a table of node regions,
+// read by wboxkit.regions and skipped here)
+typedef uint32_t ADDR;
+typedef uint16_t ADDR16;
+typedef uint32_t ADDR32;
+#define MEMORY_BITS 56
+#define COMPACT_OPCODES 0x80
+#define REGION_TABLE 0x40
 
 // unlikely that there are more opcodes (and serialization method relies on this structure...)
 typedef uint8_t BYTE;
@@ -25,20 +40,120 @@ typedef struct {
     uint64_t memory;
 } CircuitInfo;
 
+typedef struct Context Context;
+
+// receives a block of the trace, returns 0 on error
+typedef int (*TraceCallback)(const uint8_t *data, uint64_t size, void *arg);
+
+// trace output: node values are accumulated in buf and written to file
+// (or passed to callback) in large blocks
+// (both are NULL for in-memory traces, then buf holds the whole trace)
+typedef struct {
+    const uint8_t *select;  // which nodes are traced (NULL: all)
+    FILE *file;
+    TraceCallback callback;
+    void *callback_arg;
+    uint8_t *buf;
+    uint64_t size;  // capacity of buf
+    uint64_t pos;   // bytes pending in buf
+} TraceSink;
+
+// opcodes decoded once at load time, as aligned arrays (struct of arrays)
+// of ADDR16 or ADDR32 addresses, as in the file (unused operands are set to 0)
+typedef struct {
+    BYTE *op;
+    void *dst;
+    void *a;
+    void *b;
+    void *c;  // third operand of fused opcodes (for XORN: number of operands in args)
+    void *args;  // operands of XORN beyond a and b, consecutively for all XORN opcodes
+    uint64_t num_args;
+    uint64_t num_nodes;  // gates, i.e. nodes in a full trace (fused opcodes trace each of their gates)
+    int addr_bytes;
+} Code;
+
+// fills n words with random bits using the context's generator
+typedef void (*RandomFill)(Context *X, WORD *dst, int n);
+
+// circuit compiled to straight-line native code (see compiler.py),
+// replaces the interpreter when set:
+// wires are kept in ram (words WORDs per wire) only at input/output addresses,
+// trace (if not NULL) receives words WORDs per node (gate)
+typedef void (*CompiledRun)(WORD *ram, const WORD *notmask, WORD *trace, RandomFill rnd, Context *X);
+
+typedef struct {
+    CompiledRun run;
+    int words;
+} Compiled;
+
+// read-only after loading, can be shared by several threads
 typedef struct {
     CircuitInfo info;
     ADDR *input_addr;
     ADDR *output_addr;
-    BYTE *opcodes;
-    WORD *ram;
+    Code code;
+    Compiled compiled;
+    Context *context;  // default context used by circuit_compute
+    uint64_t num_contexts;
 } Circuit;
 
-enum OP {_, XOR, AND, OR, NOT, RANDOM};
+// per-thread execution state
+struct Context {
+    Circuit *circuit;
+    WORD *ram;  // memory * MAX_LANE_WORDS words, aligned for the widest engine
+    WORD *trace;  // trace buffer of compiled circuits, allocated on first use
+    uint8_t *trace_buf;  // buffer of the trace sink, allocated on first use
+    uint64_t trace_buf_size;
+    uint8_t *trace_select;  // trace filter (see context_set_trace_filter), NULL: trace all
+    uint64_t id;
+    uint64_t seed_epoch;
+    uint64_t rng_key;
+    uint64_t rng_counter;
+    int rng_words;  // random words drawn per RANDOM gate by compiled circuits (see randwords)
+};
+
+/*
+Fused opcodes (superinstructions) emitted by RawSerializer for runs of adjacent gates,
+each one still traces all of its gates (intermediates first):
+    XOR3    dst = a ^ b ^ c          traces a ^ b, dst
+    ANDXOR  dst = a ^ (b & c)        traces b & c, dst
+    ANDNOT  dst = ~a & b             traces ~a, dst
+    MUX     dst = a ^ (c & (a ^ b))  traces a ^ b, c & (a ^ b), dst  (c ? b : a)
+    XORN    dst = x0 ^ ... ^ x{n-1}  traces x0 ^ x1, ..., dst
+In the file, XORN is followed by dst, n and the n operands.
+*/
+enum OP {_, XOR, AND, OR, NOT, RANDOM, XOR3, ANDXOR, ANDNOT, MUX, XORN};
 
 EXPORT void __attribute__ ((constructor)) set_seed_time();
 EXPORT void set_seed(uint64_t seed);
+EXPORT void circuit_set_seed(Circuit *C, uint64_t seed, uint64_t batch_index);
+EXPORT void context_set_seed(Context *X, uint64_t seed, uint64_t batch_index);
+
+EXPORT void set_trace_buffer_size(uint64_t size);
+
+EXPORT void transpose_bits(const uint8_t *in, uint8_t *out, uint64_t rows, uint64_t cols);
+EXPORT void unpack_bits(const uint8_t *in, uint8_t *out, uint64_t nbits);
+EXPORT void copy_bit_rows(const uint8_t *in, uint8_t *out, uint64_t rows,
+    uint64_t in_stride, uint64_t out_stride, uint64_t offset, uint64_t nbits);
+
+EXPORT int max_batch();
+EXPORT const char *engine_name(int batch);
 
 EXPORT Circuit *load_circuit(char *fname);
+EXPORT Circuit *load_circuit_bytes(const uint8_t *data, uint64_t size);
 EXPORT void free_circuit(Circuit *C);
 EXPORT int circuit_compute(Circuit *C, uint8_t *inp, uint8_t *out, char *trace_filename, int batch);
-#endif
\ No newline at end of file
+EXPORT int circuit_compute_mem(Circuit *C, uint8_t *inp, uint8_t *out, uint8_t *trace, int batch);
+EXPORT int circuit_compute_stream(Circuit *C, uint8_t *inp, uint8_t *out, TraceCallback callback, void *arg, int batch);
+
+EXPORT int circuit_set_compiled(Circuit *C, CompiledRun run, int words);
+
+EXPORT int circuit_set_trace_filter(Circuit *C, const uint8_t *select);
+
+EXPORT Context *new_context(Circuit *C);
+EXPORT void free_context(Context *X);
+EXPORT int context_compute(Context *X, uint8_t *inp, uint8_t *out, char *trace_filename, int batch);
+EXPORT int context_set_trace_filter(Context *X, const uint8_t *select);
+EXPORT int context_compute_mem(Context *X, uint8_t *inp, uint8_t *out, uint8_t *trace, int batch);
+EXPORT int context_compute_stream(Context *X, uint8_t *inp, uint8_t *out, TraceCallback callback, void *arg, int batch);
+#endif
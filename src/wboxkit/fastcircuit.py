@@ -1,23 +1,64 @@
+import os
 import ctypes
 from ctypes import (
     cdll,
+    CFUNCTYPE,
+    POINTER,
+    c_uint8,
+    c_uint16,
+    c_uint32,
     c_uint64,
     c_void_p,
     c_char_p,
     c_int,
 )
 
+from bisect import bisect_left
 from pathlib import Path
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+
+from wboxkit.regions import read_region_table
 
 path = Path(__file__).resolve().parent / "libfastcircuit.so"
 
 lib = cdll.LoadLibrary(path)
 
 lib.load_circuit.restype = c_void_p
+lib.load_circuit_bytes.argtypes = (c_char_p, c_uint64)
+lib.load_circuit_bytes.restype = c_void_p
+lib.free_circuit.argtypes = c_void_p,
 lib.circuit_compute.argtypes = (c_void_p, c_char_p, c_char_p, c_char_p, c_int)
+lib.circuit_compute_mem.argtypes = (c_void_p, c_char_p, c_char_p, c_void_p, c_int)
+lib.circuit_set_compiled.argtypes = (c_void_p, c_void_p, c_int)
+lib.new_context.argtypes = c_void_p,
+lib.new_context.restype = c_void_p
+lib.free_context.argtypes = c_void_p,
+lib.context_compute.argtypes = (c_void_p, c_char_p, c_char_p, c_char_p, c_int)
+lib.context_compute_mem.argtypes = (c_void_p, c_char_p, c_char_p, c_void_p, c_int)
+# callback(data, size, arg) receiving blocks of a streamed trace
+TRACE_CALLBACK = CFUNCTYPE(c_int, c_void_p, c_uint64, c_void_p)
+lib.circuit_compute_stream.argtypes = (c_void_p, c_char_p, c_char_p, TRACE_CALLBACK, c_void_p, c_int)
+lib.context_compute_stream.argtypes = (c_void_p, c_char_p, c_char_p, TRACE_CALLBACK, c_void_p, c_int)
+lib.circuit_set_trace_filter.argtypes = (c_void_p, c_char_p)
+lib.context_set_trace_filter.argtypes = (c_void_p, c_char_p)
 lib.set_seed.argtypes = c_uint64,
+lib.circuit_set_seed.argtypes = (c_void_p, c_uint64, c_uint64)
+lib.context_set_seed.argtypes = (c_void_p, c_uint64, c_uint64)
+lib.set_trace_buffer_size.argtypes = c_uint64,
+lib.transpose_bits.argtypes = (c_char_p, c_char_p, c_uint64, c_uint64)
+lib.unpack_bits.argtypes = (c_char_p, c_char_p, c_uint64)
+lib.copy_bit_rows.argtypes = (c_char_p, c_void_p, c_uint64, c_uint64, c_uint64, c_uint64, c_uint64)
+lib.engine_name.argtypes = c_int,
+lib.engine_name.restype = c_char_p
+
+# largest batch accepted by circuit_compute
+MAX_BATCH = 512
+# default batch size: batches and their random streams define a trace set,
+# so it must not depend on the CPU (unlike max_batch())
+DEFAULT_BATCH = 64
 
-# lib.RANDOM_ENABLED
+RANDOM_ENABLED = c_int.in_dll(lib, "RANDOM_ENABLED")
 
 
 def set_seed(seed=None):
@@ -29,15 +70,86 @@ def set_seed(seed=None):
 
 def randomness(on):
     if on:
-        lib.RANDOM_ENABLED = 1
+        RANDOM_ENABLED.value = 1
     else:
-        lib.RANDOM_ENABLED = 0
+        RANDOM_ENABLED.value = 0
+
+
+def set_trace_buffer_size(size):
+    """Traces are written to files in blocks of this many bytes (default 4 MiB)"""
+    lib.set_trace_buffer_size(size)
+
+
+def transpose_bits(data, rows, cols):
+    """Transpose a bit matrix: data has rows of (cols + 7) // 8 bytes
+    (bits packed MSB first, as in inputs, outputs and trace files),
+    the result has cols rows of (rows + 7) // 8 bytes"""
+    view = memoryview(data).cast("B")
+    assert len(view) >= rows * ((cols + 7) // 8), "not enough data"
+    out = ctypes.create_string_buffer(cols * ((rows + 7) // 8))
+    lib.transpose_bits(c_buffer(view), out, rows, cols)
+    return out.raw
+
+
+def unpack_bits(data, nbits=None):
+    """Bits of data (packed MSB first) as bytes 0 or 1, the first nbits (default: all)"""
+    view = memoryview(data).cast("B")
+    if nbits is None:
+        nbits = len(view) * 8
+    assert len(view) * 8 >= nbits, "not enough data"
+    out = ctypes.create_string_buffer(nbits)
+    lib.unpack_bits(c_buffer(view), out, nbits)
+    return out.raw
+
+
+def copy_bit_rows(data, out, pos, in_stride, out_stride, offset, nbits):
+    """Copy the first nbits of each row of data (in_stride bytes per row)
+    into the rows of the writable buffer out (out_stride bytes per row, from byte pos),
+    starting at their bit offset (bits packed MSB first), keeping the other bits"""
+    view = memoryview(data).cast("B")
+    assert len(view) % in_stride == 0 and nbits <= in_stride * 8
+    rows = len(view) // in_stride
+    if not rows:
+        return
+    size = (rows - 1) * out_stride + (offset + nbits + 7) // 8
+    out = (ctypes.c_char * size).from_buffer(out, pos)
+    lib.copy_bit_rows(c_buffer(view), out, rows, in_stride, out_stride, offset, nbits)
+
+
+def max_batch():
+    """Widest batch backed by native vector instructions on this CPU"""
+    return lib.max_batch()
+
+
+def engine_name(batch):
+    name = lib.engine_name(batch)
+    assert name is not None, f"unsupported batch size {batch}"
+    return name.decode()
+
+
+def trace_item_bytes(batch):
+    """Bytes per node in a batched trace (as written by circuit_compute)"""
+    assert 1 <= batch <= MAX_BATCH
+    res = 1
+    while res * 8 < batch:
+        res *= 2
+    return res
 
 
 def chunks(s, n):
     return [s[i:i+n] for i in range(0, len(s), n)]
 
 
+def c_buffer(view):
+    """Contiguous byte memoryview as an argument for the C side, without copying
+    (read-only views are copied unless they cover a whole bytes object)"""
+    if not view.readonly:
+        return (ctypes.c_char * len(view)).from_buffer(view)
+    if isinstance(view.obj, bytes) and len(view.obj) == len(view):
+        return view.obj
+    return bytes(view)
+
+
 class CircuitInfo(ctypes.Structure):
     _fields_ = [
         ("input_size", c_uint64),
@@ -48,43 +160,517 @@ class CircuitInfo(ctypes.Structure):
     ]
 
 
+class Code(ctypes.Structure):
+    _fields_ = [
+        ("op", POINTER(c_uint8)),
+        ("dst", c_void_p),
+        ("a", c_void_p),
+        ("b", c_void_p),
+        ("c", c_void_p),
+        ("args", c_void_p),
+        ("num_args", c_uint64),
+        ("num_nodes", c_uint64),
+        ("addr_bytes", c_int),
+    ]
+
+
+class Circuit(ctypes.Structure):
+    """Leading (read-only) part of the C Circuit struct"""
+    _fields_ = [
+        ("info", CircuitInfo),
+        ("input_addr", POINTER(c_uint32)),
+        ("output_addr", POINTER(c_uint32)),
+        ("code", Code),
+    ]
+
+
+# opcodes of the decoded code (enum OP in fastcircuit.h)
+OP_XOR = 1
+OP_AND = 2
+OP_OR = 3
+OP_NOT = 4
+OP_RANDOM = 5
+# fused opcodes, see fastcircuit.h
+OP_XOR3 = 6
+OP_ANDXOR = 7
+OP_ANDNOT = 8
+OP_MUX = 9
+OP_XORN = 10
+
+OP_NAMES = dict(XOR=OP_XOR, AND=OP_AND, OR=OP_OR, NOT=OP_NOT, RANDOM=OP_RANDOM)
+
+# gates traced by fused opcodes, in order (XORN: XOR per operand after the first)
+FUSED_GATES = {
+    OP_XOR3: (OP_XOR, OP_XOR),
+    OP_ANDXOR: (OP_AND, OP_XOR),
+    OP_ANDNOT: (OP_NOT, OP_AND),
+    OP_MUX: (OP_XOR, OP_AND, OP_XOR),
+}
+
+
 class FastCircuit(object):
-    def __init__(self, fname):
-        self.circuit = lib.load_circuit(fname.encode())
-        assert self.circuit, f"error loading {fname}"
-        self.info = CircuitInfo.from_address(self.circuit)
+    """
+    circuit: serialized circuit, either a file (memory-mapped while loading)
+    or in memory: bytes, or the (header, opcodes) pair of RawSerializer.serialize
+    """
+    def __init__(self, circuit):
+        if isinstance(circuit, (str, Path)):
+            self.circuit = lib.load_circuit(str(circuit).encode())
+            assert self.circuit, f"error loading {circuit}"
+        else:
+            if isinstance(circuit, tuple):
+                header, opcodes = circuit
+                circuit = b"".join(header) + b"".join(opcodes)
+            data = bytes(circuit)
+            self.circuit = lib.load_circuit_bytes(data, len(data))
+            assert self.circuit, "error loading circuit"
+            circuit = data
+        # tags of the nodes (RegionRuns, see wboxkit.regions), None if not serialized
+        self.regions = read_region_table(circuit)
+        self.struct = Circuit.from_address(self.circuit)
+        self.info = self.struct.info
+        self.max_batch = max_batch()
+        # opcodes traced by the default context (None: all)
+        self.trace_nodes = None
+
+    @property
+    def input_addr(self):
+        return self.struct.input_addr[:self.info.input_size]
+
+    @property
+    def output_addr(self):
+        return self.struct.output_addr[:self.info.output_size]
+
+    @property
+    def num_nodes(self):
+        """Number of gates, i.e. nodes in a full trace
+        (more than num_opcodes if the circuit has fused opcodes)"""
+        return self.struct.code.num_nodes
+
+    def decoded(self):
+        """Decoded opcodes as lists (op, dst, a, b, c), unused operands are 0
+        (for XORN, c is the number of operands beyond a and b, see operands)"""
+        code = self.struct.code
+        n = self.info.num_opcodes
+        addr = POINTER(c_uint16 if code.addr_bytes == 2 else c_uint32)
+        dst, a, b, c = (ctypes.cast(arr, addr) for arr in (code.dst, code.a, code.b, code.c))
+        return code.op[:n], dst[:n], a[:n], b[:n], c[:n]
+
+    def operands(self):
+        """Operand addresses of each opcode (as tuples), in order"""
+        code = self.struct.code
+        addr = POINTER(c_uint16 if code.addr_bytes == 2 else c_uint32)
+        args = ctypes.cast(code.args, addr)[:code.num_args]
+        res = []
+        k = 0
+        for op, _, a, b, c in zip(*self.decoded()):
+            if op == OP_RANDOM:
+                res.append(())
+            elif op == OP_NOT:
+                res.append((a,))
+            elif op in (OP_XOR3, OP_ANDXOR, OP_MUX):
+                res.append((a, b, c))
+            elif op == OP_XORN:
+                res.append((a, b, *args[k:k+c]))
+                k += c
+            else:
+                res.append((a, b))
+        return res
+
+    def node_gates(self):
+        """Gate type (OP_XOR, ..., OP_RANDOM) of each trace node"""
+        res = []
+        for op, args in zip(self.decoded()[0], self.operands()):
+            if op == OP_XORN:
+                res.extend([OP_XOR] * (len(args) - 1))
+            else:
+                res.extend(FUSED_GATES.get(op, (op,)))
+        return res
+
+    def output_nodes(self):
+        """Trace nodes of opcode results (the last gate of each opcode),
+        i.e. all nodes but the intermediates of fused opcodes"""
+        res = []
+        node = -1
+        for op, args in zip(self.decoded()[0], self.operands()):
+            if op == OP_XORN:
+                node += len(args) - 1
+            else:
+                node += len(FUSED_GATES.get(op, (op,)))
+            res.append(node)
+        return res
+
+    def locality(self, batch=None, window=1024, cache_sizes=(32 << 10, 1 << 20)):
+        """Locality of the interpreter's memory accesses (operands, then destination)
+        at the given batch size (default: max_batch), in cache lines of 64 bytes:
+        reuse distance of an access = distinct lines accessed since the previous access
+        to the same line, working set = distinct lines accessed per window of opcodes.
+        hits[size]: fraction of accesses hitting in a fully associative LRU cache of that size (bytes).
+        Compare serializations (see Serializer.alloc_strategy) before timing them.
+        """
+        batch = batch or self.max_batch
+        # words per cell of the engine running the batch
+        words = 1
+        while words * 64 < batch:
+            words *= 2
+        cell_bytes = 8 * words
+        cells_per_line = max(1, 64 // cell_bytes)
+        lines_per_cell = max(1, cell_bytes // 64)
+
+        # cells accessed by each opcode
+        cells = [args + (dst,) for dst, args in zip(self.decoded()[1], self.operands())]
+        accesses = []
+        for opcode_cells in cells:
+            for cell in opcode_cells:
+                line = cell // cells_per_line * lines_per_cell
+                accesses.extend(range(line, line + lines_per_cell))
 
-    def compute_one(self, input, trace_filename=None):
+        # Fenwick tree over access times, marking the last access of each line
+        n = len(accesses)
+        tree = [0] * (n + 1)
+        last = {}
+        distances = []
+        for t, line in enumerate(accesses):
+            prev = last.get(line)
+            if prev is not None:
+                # marks in (prev, t) = distinct lines accessed in between
+                d = 0
+                i = t
+                while i > 0:
+                    d += tree[i]
+                    i &= i - 1
+                i = prev + 1
+                while i > 0:
+                    d -= tree[i]
+                    i &= i - 1
+                distances.append(d)
+                i = prev + 1
+                while i <= n:
+                    tree[i] -= 1
+                    i += i & -i
+            last[line] = t
+            i = t + 1
+            while i <= n:
+                tree[i] += 1
+                i += i & -i
+
+        working_set = []
+        for start in range(0, len(cells), window):
+            touched = set()
+            for opcode_cells in cells[start:start+window]:
+                touched.update(cell // cells_per_line for cell in opcode_cells)
+            working_set.append(len(touched) * 64 * lines_per_cell)
+
+        distances.sort()
+        def percentile(p):
+            return distances[min(len(distances) - 1, len(distances) * p // 100)] if distances else 0
+        return dict(
+            memory_bytes=self.info.memory * cell_bytes,
+            accesses=n,
+            cold=n - len(distances),
+            reuse_distance=dict(
+                mean=sum(distances) / max(1, len(distances)),
+                p50=percentile(50), p90=percentile(90), p99=percentile(99),
+            ),
+            working_set_bytes=dict(
+                mean=sum(working_set) / max(1, len(working_set)),
+                max=max(working_set, default=0),
+            ),
+            hits={
+                size: bisect_left(distances, size // 64) / max(1, n)
+                for size in cache_sizes
+            },
+        )
+
+    def new_context(self):
+        return Context(self)
+
+    def select_nodes(self, ranges=None, ops=None, stride=1, fused_outputs=False, regions=None):
+        """Indices of trace nodes matching the filters (for set_trace_filter).
+        Nodes are gates: a fused opcode has a node for each of its gates.
+        ranges: list of (start, stop) node index ranges (default: all)
+        ops: gate types to keep, e.g. ("AND", "OR") (default: all)
+        stride: keep every stride-th of the matching nodes
+        fused_outputs: keep only the results of fused opcodes, not their intermediates
+        regions: region patterns, e.g. ("r1:sb",) (see wboxkit.regions.match_region,
+            the circuit must be serialized with its region table)
+        """
+        assert stride >= 1
+        n = self.num_nodes
+        if ranges is None:
+            ranges = [(0, n)]
+        selected = set()
+        for start, stop in ranges:
+            selected.update(range(max(0, start), min(n, stop)))
+        if regions is not None:
+            assert self.regions is not None, "the circuit has no region table"
+            in_regions = set()
+            for start, stop in self.regions.select(regions):
+                in_regions.update(range(start, stop))
+            selected &= in_regions
+        if ops is not None:
+            ops = {OP_NAMES[op.upper()] if isinstance(op, str) else op for op in ops}
+            gates = self.node_gates()
+            selected = {i for i in selected if gates[i] in ops}
+        if fused_outputs:
+            selected.intersection_update(self.output_nodes())
+        return sorted(selected)[::stride]
+
+    def set_trace_filter(self, nodes=None, context=None):
+        """Trace only the nodes with given indices (see select_nodes),
+        in the default context or the given one. None traces all nodes.
+        The j-th traced node is then the node trace_nodes[j].
+        """
+        target = self if context is None else context
+        if nodes is None:
+            select = None
+        else:
+            nodes = sorted(set(nodes))
+            select = bytearray(self.num_nodes)
+            for i in nodes:
+                select[i] = 1
+            select = bytes(select)
+        if context is None:
+            ret = lib.circuit_set_trace_filter(self.circuit, select)
+        else:
+            ret = lib.context_set_trace_filter(context.context, select)
+        assert ret
+        target.trace_nodes = nodes
+
+    def num_traced(self, context=None):
+        """Number of nodes in a trace"""
+        nodes = (self if context is None else context).trace_nodes
+        return self.num_nodes if nodes is None else len(nodes)
+
+    def set_seed(self, seed, batch_index=0, context=None):
+        """Seed the randomness of the next computations (in the context)
+        with the stream (seed, batch_index), independently of other batches.
+        By default, contexts use the global seed (see set_seed)."""
+        if context is None:
+            lib.circuit_set_seed(self.circuit, seed, batch_index)
+        else:
+            lib.context_set_seed(context.context, seed, batch_index)
+
+    def compute_one(self, input, trace_filename=None, context=None):
+        """Compute one input (bytes or a buffer, as in batch_buffers),
+        returns the output as bytes"""
         if trace_filename is not None:
             trace_filename = trace_filename.encode()
-        output = ctypes.create_string_buffer( int((self.info.output_size + 7)//8) )
-        ret = lib.circuit_compute(self.circuit, input, output, trace_filename, 1)
+        input, output, batch, result = self.batch_buffers(input)
+        assert batch == 1, "compute_one takes a single input (see compute_batch)"
+        if context is None:
+            ret = lib.circuit_compute(self.circuit, input, output, trace_filename, 1)
+        else:
+            ret = lib.context_compute(context.context, input, output, trace_filename, 1)
         assert ret
-        return output.raw
+        return bytes(result())
 
-    def compute_batch(self, inputs, trace_filename=None):
+    def batch_buffers(self, inputs, output=None):
+        """Arguments for the C side: (input, output, batch size, result).
+        inputs: list of byte strings, or a contiguous buffer
+            (bytes, bytearray, memoryview, numpy array, ...) of N inputs
+        output: writable buffer for N outputs
+        result() returns the list of outputs for a list of inputs without an output buffer,
+        otherwise the output buffer (by default, a new bytearray).
+        """
+        bytes_per_input = (self.info.input_size + 7)//8
+        bytes_per_output = (self.info.output_size + 7)//8
+        if isinstance(inputs, (list, tuple)):
+            batch = len(inputs)
+            input = b"".join(inputs)
+        else:
+            view = memoryview(inputs).cast("B")
+            assert len(view) % bytes_per_input == 0, "input buffer is not a multiple of the input size"
+            batch = len(view) // bytes_per_input
+            input = c_buffer(view)
+
+        if output is None and isinstance(inputs, (list, tuple)):
+            output = ctypes.create_string_buffer(int(bytes_per_output * batch))
+            return input, output, batch, lambda: chunks(output.raw, bytes_per_output)
+
+        if output is None:
+            output = bytearray(bytes_per_output * batch)
+        view = memoryview(output).cast("B")
+        assert not view.readonly, "output buffer must be writable"
+        assert len(view) >= bytes_per_output * batch, "output buffer is too small"
+        return input, c_buffer(view), batch, lambda: output
+
+    def split_batches(self, inputs, output, batch_size):
+        """Split inputs (and output) into batches for compute_batch,
+        returns list of (inputs, output) and the result (see batch_buffers)"""
+        if isinstance(inputs, (list, tuple)) and output is None:
+            return [(chunk, None) for chunk in chunks(inputs, batch_size)], None
+
+        bytes_per_input = (self.info.input_size + 7)//8
+        bytes_per_output = (self.info.output_size + 7)//8
+        if isinstance(inputs, (list, tuple)):
+            inputs = b"".join(inputs)
+        inputs = memoryview(inputs).cast("B")
+        assert len(inputs) % bytes_per_input == 0, "input buffer is not a multiple of the input size"
+        n = len(inputs) // bytes_per_input
+        if output is None:
+            output = bytearray(bytes_per_output * n)
+        outputs = memoryview(output).cast("B")
+        assert len(outputs) >= bytes_per_output * n, "output buffer is too small"
+        batches = [
+            (
+                inputs[i * bytes_per_input:(i + batch_size) * bytes_per_input],
+                outputs[i * bytes_per_output:(i + batch_size) * bytes_per_output],
+            )
+            for i in range(0, n, batch_size)
+        ]
+        return batches, output
+
+    def compute_batch(self, inputs, trace_filename=None, context=None, output=None):
+        """Compute a batch of inputs (see batch_buffers for inputs/output),
+        returns the list of outputs, or the output buffer if inputs are given as a buffer
+        or output is given."""
         if trace_filename is not None:
             trace_filename = trace_filename.encode()
-        bytes_per_output = (self.info.output_size + 7)//8
-        output = ctypes.create_string_buffer(
-            int(bytes_per_output * len(inputs))
-        )
-        input = b"".join(inputs)
-        ret = lib.circuit_compute(self.circuit, input, output, trace_filename, len(inputs))
+        input, out, batch, result = self.batch_buffers(inputs, output)
+        if context is None:
+            ret = lib.circuit_compute(self.circuit, input, out, trace_filename, batch)
+        else:
+            ret = lib.context_compute(context.context, input, out, trace_filename, batch)
         assert ret
-        return chunks(output.raw, bytes_per_output)
+        return result()
 
-    def compute_batches(self, inputs, trace_filename_format=None):
+    def compute_batch_trace(self, inputs, trace=None, context=None, output=None):
+        """Same as compute_batch, but the trace is captured in memory.
+        trace: writable buffer (bytearray, numpy array, ...)
+            of num_traced() * trace_item_bytes(batch size) bytes,
+            by default a new numpy array is allocated.
+        Returns (outputs, trace).
+
+        The trace has the layout of trace files: for a numpy array
+        of shape (num_traced(), trace_item_bytes), np.unpackbits(trace, axis=1)
+        has node values of the i-th input in column i.
+        """
+        input, out, batch, result = self.batch_buffers(inputs, output)
+        item_bytes = trace_item_bytes(batch)
+        num_nodes = self.num_traced(context)
+        if trace is None:
+            import numpy as np
+            trace = np.empty((num_nodes, item_bytes), dtype=np.uint8)
+        trace_size = num_nodes * item_bytes
+        trace_buf = (ctypes.c_char * trace_size).from_buffer(trace)
+
+        if context is None:
+            ret = lib.circuit_compute_mem(self.circuit, input, out, trace_buf, batch)
+        else:
+            ret = lib.context_compute_mem(context.context, input, out, trace_buf, batch)
+        assert ret
+        return result(), trace
+
+    def compute_batch_stream(self, inputs, callback, context=None, output=None):
+        """Same as compute_batch, but the trace is passed to callback(data)
+        while the circuit is computed, in blocks of whole nodes
+        (trace_item_bytes(batch size) bytes per node, as in trace files),
+        see set_trace_buffer_size.
+        The C code releases the GIL, so a consumer can run in another thread.
+        """
+        error = []
+        delivered = 0
+
+        def trace_callback(data, size, arg):
+            nonlocal delivered
+            try:
+                callback(ctypes.string_at(data, size))
+                delivered += size
+                return 1
+            except BaseException as err:
+                error.append(err)
+                return 0
+
+        trace_callback = TRACE_CALLBACK(trace_callback)
+
+        input, out, batch, result = self.batch_buffers(inputs, output)
+        if context is None:
+            ret = lib.circuit_compute_stream(self.circuit, input, out, trace_callback, None, batch)
+        else:
+            ret = lib.context_compute_stream(context.context, input, out, trace_callback, None, batch)
+        if error:
+            raise error[0]
+        assert ret
+        # an exception raised on entering the callback (e.g. KeyboardInterrupt) is only
+        # reported by ctypes, with an undefined return value: the block may be lost
+        if delivered != self.num_traced(context) * trace_item_bytes(batch):
+            raise RuntimeError("trace blocks were lost (interrupted callback?)")
+        return result()
+
+    def compute_batches(self, inputs, trace_filename_format=None, batch_size=DEFAULT_BATCH, seed=None, output=None):
+        """Compute inputs in batches of batch_size
+        (trace files and random streams depend on it, self.max_batch is the fastest).
+        If seed is given, the i-th batch uses the random stream (seed, i),
+        see set_seed.
+        Inputs and output can be buffers, as in compute_batch
+        (then batches are views into them, without copies).
+        """
+        assert 1 <= batch_size <= MAX_BATCH
+        batches, result = self.split_batches(inputs, output, batch_size)
         outputs = []
-        for i, chunk in enumerate(chunks(inputs, 64)):
+        for i, (chunk, out) in enumerate(batches):
             trace_filename = trace_filename_format % i if trace_filename_format else None
-            outputs += self.compute_batch(chunk, trace_filename)
-        return outputs
+            if seed is not None:
+                self.set_seed(seed, i)
+            res = self.compute_batch(chunk, trace_filename, output=out)
+            if result is None:
+                outputs += res
+        return outputs if result is None else result
+
+    def compute_parallel(self, inputs, n_threads=None, trace_filename_format=None, batch_size=DEFAULT_BATCH, seed=None, output=None):
+        """Same as compute_batches, but batches are spread over a thread pool.
+        Each thread uses its own execution context (the circuit is shared).
+        With a seed, results do not depend on the number of threads.
+        """
+        if n_threads is None:
+            n_threads = os.cpu_count() or 1
+        assert n_threads >= 1
+        assert 1 <= batch_size <= MAX_BATCH
+
+        contexts = Queue()
+        for _ in range(n_threads):
+            context = self.new_context()
+            if self.trace_nodes is not None:
+                self.set_trace_filter(self.trace_nodes, context=context)
+            contexts.put(context)
+
+        def work(task):
+            i, (chunk, out) = task
+            trace_filename = trace_filename_format % i if trace_filename_format else None
+            context = contexts.get()
+            try:
+                if seed is not None:
+                    self.set_seed(seed, i, context=context)
+                return self.compute_batch(chunk, trace_filename, context=context, output=out)
+            finally:
+                contexts.put(context)
+
+        batches, result = self.split_batches(inputs, output, batch_size)
+        outputs = []
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            for res in pool.map(work, enumerate(batches)):
+                if result is None:
+                    outputs += res
+        return outputs if result is None else result
 
     def __del__(self):
         lib.free_circuit(self.circuit)
 
 
+class Context(object):
+    """Execution context (memory and randomness state) of a FastCircuit,
+    one per thread for parallel computations."""
+    def __init__(self, circuit):
+        self.circuit = circuit  # keep the circuit alive
+        self.context = lib.new_context(circuit.circuit)
+        assert self.context, "error creating context"
+        self.trace_nodes = None
+
+    def __del__(self):
+        lib.free_context(self.context)
+
+
 if __name__ == '__main__':
     print("input_size", FastCircuit("./circuits/test.bin").info.input_size)
     print("output_size", FastCircuit("./circuits/test.bin").info.output_size)
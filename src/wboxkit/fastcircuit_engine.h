@@ -0,0 +1,109 @@
+/*
+Interpreter loop template, included by fastcircuit.c once per engine.
+
+Expects:
+    ENGINE_NAME  - name of the generated function
+    ENGINE_VEC   - type holding one wire for all lanes (WORD or a vector of WORDs)
+    ENGINE_ATTRS - function attributes (e.g. target instruction set)
+
+The loop is specialized for 16- and 32-bit addresses
+(inlined with a constant address size).
+Every gate is traced, including the intermediates of fused opcodes.
+*/
+
+#define ENGINE_CAT_(a, b) a ## b
+#define ENGINE_CAT(a, b) ENGINE_CAT_(a, b)
+#define ENGINE_LOOP ENGINE_CAT(ENGINE_NAME, _loop)
+#define ENGINE_ADDR(arr, i) (A == 2 ? ((const ADDR16 *)(arr))[i] : ((const ADDR32 *)(arr))[i])
+#define ENGINE_TRACE(value) do { \
+        if (trace && !trace_node(trace, node, &(value), trace_item_bytes)) \
+            return 0; \
+        node++; \
+    } while (0)
+
+ENGINE_ATTRS
+static inline __attribute__ ((always_inline))
+int ENGINE_LOOP(Context *X, const WORD *notmask, TraceSink *trace, int trace_item_bytes, const int A) {
+    Circuit *C = X->circuit;
+    ENGINE_VEC *ram = (ENGINE_VEC *)X->ram;
+    ENGINE_VEC NOTMASK;
+    memcpy(&NOTMASK, notmask, sizeof(ENGINE_VEC));
+
+    const Code code = C->code;
+    const uint64_t n = C->info.num_opcodes;
+    // trace node of the current gate, next XORN operand
+    uint64_t node = 0, k = 0;
+    for(uint64_t i = 0; i < n; i++) {
+        ADDR dst = ENGINE_ADDR(code.dst, i);
+        ENGINE_VEC t, u;
+        switch (code.op[i]) {
+        case XOR:
+            ram[dst] = ram[ENGINE_ADDR(code.a, i)] ^ ram[ENGINE_ADDR(code.b, i)];
+            break;
+        case AND:
+            ram[dst] = ram[ENGINE_ADDR(code.a, i)] & ram[ENGINE_ADDR(code.b, i)];
+            break;
+        case OR:
+            ram[dst] = ram[ENGINE_ADDR(code.a, i)] | ram[ENGINE_ADDR(code.b, i)];
+            break;
+        case NOT:
+            ram[dst] = NOTMASK ^ ram[ENGINE_ADDR(code.a, i)];
+            break;
+        case RANDOM:
+            fill_random(X, (WORD *)(ram + dst), sizeof(ENGINE_VEC) / sizeof(WORD));
+            break;
+        // fused opcodes: operands are read before dst is written (it may be one of them)
+        case XOR3:
+            t = ram[ENGINE_ADDR(code.a, i)] ^ ram[ENGINE_ADDR(code.b, i)];
+            ENGINE_TRACE(t);
+            ram[dst] = t ^ ram[ENGINE_ADDR(code.c, i)];
+            break;
+        case ANDXOR:
+            t = ram[ENGINE_ADDR(code.b, i)] & ram[ENGINE_ADDR(code.c, i)];
+            ENGINE_TRACE(t);
+            ram[dst] = ram[ENGINE_ADDR(code.a, i)] ^ t;
+            break;
+        case ANDNOT:
+            t = NOTMASK ^ ram[ENGINE_ADDR(code.a, i)];
+            ENGINE_TRACE(t);
+            ram[dst] = t & ram[ENGINE_ADDR(code.b, i)];
+            break;
+        case MUX:
+            t = ram[ENGINE_ADDR(code.a, i)] ^ ram[ENGINE_ADDR(code.b, i)];
+            ENGINE_TRACE(t);
+            u = ram[ENGINE_ADDR(code.c, i)] & t;
+            ENGINE_TRACE(u);
+            ram[dst] = ram[ENGINE_ADDR(code.a, i)] ^ u;
+            break;
+        case XORN:
+            t = ram[ENGINE_ADDR(code.a, i)] ^ ram[ENGINE_ADDR(code.b, i)];
+            for (ADDR j = ENGINE_ADDR(code.c, i); j > 0; j--) {
+                ENGINE_TRACE(t);
+                t ^= ram[ENGINE_ADDR(code.args, k)];
+                k++;
+            }
+            ram[dst] = t;
+            break;
+        }
+
+        ENGINE_TRACE(ram[dst]);
+    }
+    return 1;
+}
+
+ENGINE_ATTRS
+static int ENGINE_NAME(Context *X, const WORD *notmask, TraceSink *trace, int trace_item_bytes) {
+    if (X->circuit->code.addr_bytes == 2)
+        return ENGINE_LOOP(X, notmask, trace, trace_item_bytes, 2);
+    else
+        return ENGINE_LOOP(X, notmask, trace, trace_item_bytes, 4);
+}
+
+#undef ENGINE_CAT_
+#undef ENGINE_CAT
+#undef ENGINE_LOOP
+#undef ENGINE_ADDR
+#undef ENGINE_TRACE
+#undef ENGINE_NAME
+#undef ENGINE_VEC
+#undef ENGINE_ATTRS
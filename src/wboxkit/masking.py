@@ -6,8 +6,10 @@ import logging
 
 from circkit.transformers.core import CircuitTransformer
 from circkit.array import Array
+from circkit.location import Location
 
 from wboxkit.containers import Rect
+from wboxkit.regions import KeepRegions, at_location
 
 
 log = logging.getLogger(__name__)
@@ -17,7 +19,13 @@ def xorlist(lst):
     return reduce(xor, lst, 0)
 
 
-class MaskingTransformer(CircuitTransformer):
+class MaskingTransformer(KeepRegions, CircuitTransformer):
+    """
+    Gadgets keep the region of the node they mask, extended by the gadget
+    (e.g. "r1:sb:s0:ISW_AND", see wboxkit.regions), input encodings are
+    in region "ISW_encode" (DumShuf: "DumShuf_shuffle"), the prng initialization
+    in "ISW_prng" and output decodings add "ISW_decode".
+    """
     START_FROM_VARS = True  # ensure all INPUTS are processed first
 
     def __init__(self, prng=None, n_shares=2, encode_input=True, decode_output=True):
@@ -33,6 +41,20 @@ class MaskingTransformer(CircuitTransformer):
         self.encode_input = encode_input
         self.decode_output = decode_output
 
+    def region_token(self, node, gadget=None):
+        """Region of the gadget masking the node (by default, named after its operation)"""
+        if gadget is None:
+            gadget = node.operation._name
+        return "%s_%s" % (type(self).__name__, gadget)
+
+    def gadget_location(self, gadget, node=None):
+        """Context creating nodes in the gadget's region (of the node if given)"""
+        location = Location(getattr(node, "location", ()))
+        return at_location(
+            self.target_circuit,
+            location + (self.region_token(node, gadget),),
+        )
+
     def rand(self):
         if self.prng is None:
             return self.target_circuit.RND()()
@@ -67,10 +89,12 @@ class MaskingTransformer(CircuitTransformer):
                 inputs.append(new_node)
 
             if self.prng is not None:
-                self.prng.set_state(inputs)
+                with self.gadget_location("prng"):
+                    self.prng.set_state(inputs)
 
-            for old_node, new_node in zip(circuit.inputs, inputs):
-                self.result[old_node] = self.encode(new_node)
+            with self.gadget_location("encode"):
+                for old_node, new_node in zip(circuit.inputs, inputs):
+                    self.result[old_node] = self.encode(new_node)
         else:
             inputs = []
             for node in circuit.inputs:
@@ -83,17 +107,40 @@ class MaskingTransformer(CircuitTransformer):
                 inputs.extend(shares)
 
             if self.prng is not None:
-                self.prng.set_state(inputs)
+                with self.gadget_location("prng"):
+                    self.prng.set_state(inputs)
 
     def visit_INPUT(self, node):
         return self.result[node]
 
     def make_output(self, node, result):
         if self.decode_output:
-            result = self.decode(result)
+            with self.gadget_location("decode", node):
+                result = self.decode(result)
         super().make_output(node, result)
 
 
+def gadget_names():
+    """Prefixes of the gadget regions (see MaskingTransformer.region_token):
+    the names of the masking transformers, including subclasses defined elsewhere"""
+    names = set()
+    classes = [MaskingTransformer]
+    while classes:
+        cls = classes.pop()
+        names.add(cls.__name__)
+        classes.extend(cls.__subclasses__())
+    return names
+
+
+def in_gadget(node, names=None):
+    """Whether the node was created in a gadget region of a masking transformer
+    (names: see gadget_names)"""
+    if names is None:
+        names = gadget_names()
+    location = getattr(node, "location", None) or ()
+    return any(str(token).split("_", 1)[0] in names for token in location)
+
+
 class ISW(MaskingTransformer):
     """Private Circuits [ISW03]"""
     NAME_SUFFIX = "_ISW"
@@ -326,25 +373,27 @@ class DumShuf(MaskingTransformer):
                 new_node = super(MaskingTransformer, self).visit_generic(node)
                 inputs.append(new_node)
 
-            self.prng.set_state(inputs)
-
-            targets = []
-            shuf = []
-            for old_node, new_node in zip(circuit.inputs, inputs):
-                targets.append((self.result, old_node))
-                shuf.append(self.encode(new_node))
-
-            for old_node in circuit:
-                if old_node.is_AND():
-                    targets.append((self.refresh, old_node))
-                    shuf.append(self.encode(0))
+            with self.gadget_location("prng"):
+                self.prng.set_state(inputs)
 
-            self.flags = self.create_shuffle()
-            shuf = list(map(Array, Rect.from_rect(shuf).transpose()))
-            shuf = self.shuffle(shuf, flags=self.flags)
-            shuf = list(map(Array, Rect.from_rect(shuf).transpose()))
-            for (target, node), shares in zip(targets, shuf):
-                target[node] = shares
+            with self.gadget_location("shuffle"):
+                targets = []
+                shuf = []
+                for old_node, new_node in zip(circuit.inputs, inputs):
+                    targets.append((self.result, old_node))
+                    shuf.append(self.encode(new_node))
+
+                for old_node in circuit:
+                    if old_node.is_AND():
+                        targets.append((self.refresh, old_node))
+                        shuf.append(self.encode(0))
+
+                self.flags = self.create_shuffle()
+                shuf = list(map(Array, Rect.from_rect(shuf).transpose()))
+                shuf = self.shuffle(shuf, flags=self.flags)
+                shuf = list(map(Array, Rect.from_rect(shuf).transpose()))
+                for (target, node), shares in zip(targets, shuf):
+                    target[node] = shares
 
         else:
             raise NotImplementedError()
@@ -353,16 +402,17 @@ class DumShuf(MaskingTransformer):
         super().visit_all(circuit)
 
         if self.decode_output:
-            shuf = []
-            for node in circuit.outputs:
-                shuf.append(self.result[node])
+            with self.gadget_location("unshuffle"):
+                shuf = []
+                for node in circuit.outputs:
+                    shuf.append(self.result[node])
 
-            shuf = list(map(Array, Rect.from_rect(shuf).transpose()))
-            shuf = self.unshuffle(shuf, flags=self.flags)
-            shuf = list(map(Array, Rect.from_rect(shuf).transpose()))
+                shuf = list(map(Array, Rect.from_rect(shuf).transpose()))
+                shuf = self.unshuffle(shuf, flags=self.flags)
+                shuf = list(map(Array, Rect.from_rect(shuf).transpose()))
 
-            for node, shares in zip(circuit.outputs, shuf):
-                self.result[node] = shares
+                for node, shares in zip(circuit.outputs, shuf):
+                    self.result[node] = shares
 
     def encode(self, s):
         # here we create dummy slots
@@ -0,0 +1,329 @@
+import heapq
+from collections import Counter, defaultdict
+from functools import wraps
+from itertools import combinations
+
+from circkit.transformers.core import CircuitTransformer
+
+from wboxkit.masking import gadget_names, in_gadget
+from wboxkit.regions import KeepRegions
+
+
+def optimize(circuit, keep_masking=True, use_or=True):
+    """
+    Optimization pipeline to run before serialization:
+    constant folding, common subexpressions and NOT absorption (see Simplifier),
+    then, unless keep_masking, XOR network reduction (see XorReducer)
+    and another simplification.
+    The XOR network reduction creates new partial sums of wires,
+    which in a masked circuit may sum the shares of a secret
+    (and so compute the unmasked value): keep_masking must be set for masked circuits.
+    With keep_masking, the gates of masking gadgets (see masking.in_gadget)
+    are also left as they are by the simplification.
+    Without use_or, no OR gates are introduced (masking transformers
+    only support XOR/AND/NOT, so that an unmasked circuit can be optimized before masking).
+    A pass is kept only if it removes gates (absorbed NOT gates may have to be
+    created again for several wires), so that the given circuit may be returned.
+    """
+    passes = [Simplifier(use_or=use_or, keep_gadgets=keep_masking)]
+    if not keep_masking:
+        passes += [XorReducer(), Simplifier(use_or=use_or)]
+    for transformer in passes:
+        new = transformer.transform(circuit)
+        new.in_place_remove_unused_nodes()
+        if len(new) < len(circuit):
+            circuit = new
+    return circuit
+
+
+def unless_gadget(method):
+    """Visit the gates of masking gadgets with visit_generic (see Simplifier.keep_gadgets)"""
+    @wraps(method)
+    def visit(self, node, *args):
+        if self.keep_gadgets and in_gadget(node, self.gadget_names):
+            return self.visit_generic(node, *args)
+        return method(self, node, *args)
+    return visit
+
+
+class Simplifier(KeepRegions, CircuitTransformer):
+    """
+    Copy of the circuit with constants propagated, equal gates merged
+    (operands of commutative gates are sorted, so that x ^ y and y ^ x are one gate)
+    and NOT gates absorbed: wires are kept as (node, inverted) pairs
+    (or constants 0/1) and a NOT gate is created only where the complement is needed,
+    i.e. for an operand of AND/OR used both ways, or an inverted output.
+    XOR passes inversions through (~x ^ y = ~(x ^ y)),
+    AND/OR of two inverted wires become OR/AND (~x & ~y = ~(x | y)),
+    unless use_or is not set (then ~x & ~y keeps its NOT gates).
+    With keep_gadgets, the gates in regions of masking gadgets are copied as they are.
+    Unused nodes are left to in_place_remove_unused_nodes.
+    """
+    START_FROM_VARS = True
+
+    def __init__(self, use_or=True, keep_gadgets=False):
+        self.use_or = use_or
+        self.keep_gadgets = keep_gadgets
+
+    def before_transform(self, circuit, **kwargs):
+        super().before_transform(circuit, **kwargs)
+        self.gates = {}
+        self.inverted = {}
+        self.gadget_names = gadget_names() if self.keep_gadgets else None
+
+    def visit_generic(self, node, *args):
+        return super().visit_generic(node, *map(self.materialize, args)), 0
+
+    def visit_INPUT(self, node):
+        return super().visit_generic(node), 0
+
+    def visit_CONST(self, node):
+        return int(node.operation.value) & 1
+
+    @unless_gadget
+    def visit_NOT(self, node, x):
+        return flip(x, 1)
+
+    @unless_gadget
+    def visit_XOR(self, node, x, y):
+        if isinstance(x, int):
+            return flip(y, x)
+        if isinstance(y, int):
+            return flip(x, y)
+        (a, ia), (b, ib) = x, y
+        if a is b:
+            return ia ^ ib
+        return self.gate("XOR", a, b), ia ^ ib
+
+    @unless_gadget
+    def visit_AND(self, node, x, y):
+        if isinstance(x, int):
+            return y if x else 0
+        if isinstance(y, int):
+            return x if y else 0
+        (a, ia), (b, ib) = x, y
+        if a is b:
+            return x if ia == ib else 0
+        if ia and ib and self.use_or:
+            return self.gate("OR", a, b), 1
+        return self.gate("AND", self.materialize(x), self.materialize(y)), 0
+
+    @unless_gadget
+    def visit_OR(self, node, x, y):
+        if isinstance(x, int):
+            return 1 if x else y
+        if isinstance(y, int):
+            return 1 if y else x
+        (a, ia), (b, ib) = x, y
+        if a is b:
+            return x if ia == ib else 1
+        if ia and ib:
+            return self.gate("AND", a, b), 1
+        return self.gate("OR", self.materialize(x), self.materialize(y)), 0
+
+    def gate(self, name, a, b):
+        if a.id > b.id:
+            a, b = b, a
+        key = name, a.id, b.id
+        if key not in self.gates:
+            self.gates[key] = getattr(self.target_circuit, name)()(a, b)
+        return self.gates[key]
+
+    def materialize(self, x):
+        """Node of the wire x"""
+        if isinstance(x, int):
+            return self.target_circuit.add_const(x)
+        node, inverted = x
+        if not inverted:
+            return node
+        if node.id not in self.inverted:
+            self.inverted[node.id] = self.target_circuit.NOT()(node)
+        return self.inverted[node.id]
+
+    def make_output(self, node, result):
+        return super().make_output(node, self.materialize(result))
+
+
+def flip(x, inverted):
+    if isinstance(x, int):
+        return x ^ inverted
+    return x[0], x[1] ^ inverted
+
+
+def paar(rows, next_term=None):
+    """
+    Greedy XOR count reduction of a linear map [Paar97]:
+    rows are sets of terms (ints) to XOR, while a pair of terms
+    occurs in several rows, it is replaced by a new term in all of them
+    (the most frequent pair first, ties: the smallest one).
+    Returns the new terms (term -> pair of terms, numbered from next_term,
+    by default after the given terms) and the rows (modified in place).
+    """
+    if next_term is None:
+        next_term = max((max(row) for row in rows if row), default=-1) + 1
+    # pair counts are updated as rows change, the heap has outdated entries
+    count = Counter()
+    for row in rows:
+        count.update(combinations(sorted(row), 2))
+    heap = [(-n, pair) for pair, n in count.items() if n >= 2]
+    heapq.heapify(heap)
+    rows_of = defaultdict(set)
+    for i, row in enumerate(rows):
+        for term in row:
+            rows_of[term].add(i)
+
+    pairs = {}
+    while heap:
+        n, pair = heapq.heappop(heap)
+        if -n != count[pair]:
+            continue
+        a, b = pair
+        pairs[next_term] = pair
+        for i in rows_of[a] & rows_of[b]:
+            row = rows[i]
+            row -= {a, b}
+            rows_of[a].discard(i)
+            rows_of[b].discard(i)
+            count[pair] -= 1
+            for term in row:
+                for old in ((min(a, term), max(a, term)), (min(b, term), max(b, term))):
+                    count[old] -= 1
+                    if count[old] >= 2:
+                        heapq.heappush(heap, (-count[old], old))
+                new = term, next_term
+                count[new] += 1
+                if count[new] >= 2:
+                    heapq.heappush(heap, (-count[new], new))
+            row.add(next_term)
+            rows_of[next_term].add(i)
+        next_term += 1
+    return pairs, rows
+
+
+class XorReducer(KeepRegions, CircuitTransformer):
+    """
+    Copy of the circuit with XOR trees recomputed with fewer gates
+    (e.g. MixColumns, where each output bit is computed separately).
+    XOR gates used only by one XOR gate are internal to a tree,
+    whose root is the value needed elsewhere (by another gate, several XOR gates or as output)
+    and whose leaves are the non-XOR gates and other roots it sums.
+    The roots sharing leaves are recomputed together by paar(),
+    if this takes fewer XOR gates than their trees (the roots keep their values).
+    After the transform, self.xors holds the number of XOR gates before and after.
+    Creates new intermediate sums: not for masked circuits (see optimize).
+    """
+    START_FROM_VARS = True
+
+    def visit_all(self, circuit):
+        self.plan(circuit)
+        super().visit_all(circuit)
+
+    def plan(self, circuit):
+        def is_xor(node):
+            return node.operation._name == "XOR"
+
+        def is_root(node):
+            return (
+                node.is_OUTPUT()
+                or len(node.outgoing) != 1
+                or not is_xor(node.outgoing[0])
+            )
+
+        # leaves of trees (as indexes), with cancellation (x ^ x = 0)
+        leaf_index = {}
+        sums = {}
+        size = {}
+        for node in circuit:
+            if not is_xor(node):
+                continue
+            acc = set()
+            n = 1
+            for sub in node.incoming:
+                if is_xor(sub) and not is_root(sub):
+                    acc ^= sums.pop(sub)
+                    n += size.pop(sub)
+                else:
+                    acc ^= {leaf_index.setdefault(sub, len(leaf_index))}
+            sums[node] = acc
+            size[node] = n
+
+        # roots sharing leaves are reduced together (union-find over leaves)
+        parent = list(range(len(leaf_index)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for acc in sums.values():
+            acc = list(acc)
+            for i in acc[1:]:
+                parent[find(i)] = find(acc[0])
+        groups = {}
+        for root, acc in sums.items():
+            key = find(min(acc)) if acc else None
+            groups.setdefault(key, []).append(root)
+
+        self.leaves = {i: leaf for leaf, i in leaf_index.items()}
+        self.rows = {}
+        self.pairs = {}
+        self.internal = set()
+        before = after = 0
+        for roots in groups.values():
+            rows = [set(sums[root]) for root in roots]
+            pairs, rows = paar(rows, next_term=len(leaf_index) + len(self.pairs))
+            old = sum(size[root] for root in roots)
+            new = len(pairs) + sum(max(len(row) - 1, 0) for row in rows)
+            before += old
+            if new >= old:
+                after += old
+                continue
+            after += new
+            self.pairs.update(pairs)
+            for root, row in zip(roots, rows):
+                self.rows[root] = row
+                stack = [root]
+                while stack:
+                    for sub in stack.pop().incoming:
+                        if is_xor(sub) and not is_root(sub):
+                            self.internal.add(sub)
+                            stack.append(sub)
+        self.xors = before, after
+
+    def before_transform(self, circuit, **kwargs):
+        super().before_transform(circuit, **kwargs)
+        self.terms = {}
+
+    def visit_XOR(self, node, x, y):
+        if node in self.internal:
+            return None
+        if node not in self.rows:
+            return super().visit_generic(node, x, y)
+        value = None
+        for term in sorted(self.rows[node]):
+            value = self.term(term) if value is None else value ^ self.term(term)
+        if value is None:
+            # the tree cancels out
+            value = self.target_circuit.add_const(0)
+        return value
+
+    def term(self, term):
+        # pairs only refer to terms numbered before them
+        stack = [term]
+        while stack:
+            t = stack[-1]
+            if t in self.terms:
+                stack.pop()
+            elif t not in self.pairs:
+                self.terms[t] = self.result[self.leaves[t]]
+                stack.pop()
+            else:
+                missing = [sub for sub in self.pairs[t] if sub not in self.terms]
+                if missing:
+                    stack.extend(missing)
+                else:
+                    a, b = self.pairs[t]
+                    self.terms[t] = self.terms[a] ^ self.terms[b]
+                    stack.pop()
+        return self.terms[term]
@@ -0,0 +1,235 @@
+"""
+Regions of a circuit: nodes are tagged by their builders with circkit locations
+(circuit.with_location, e.g. "r1:sb:s3" for the 4th S-box of the first AES round,
+extended by masking transformers with their gadget, e.g. "r1:sb:s3:ISW_AND").
+
+RawSerializer(regions=True) stores the region table after the opcodes
+(flag REGION_TABLE, see fastcircuit.h): the runs of consecutive trace nodes
+with the same tag, so that traces can be restricted to regions
+(FastCircuit.select_nodes) and attacks to windows in them (Reader).
+
+Table layout (little-endian):
+    number of runs, number of tags, number of nodes (uint64)
+    first node of each run (uint64)
+    tag of each run (uint32 index)
+    tags: length (uint32) and utf-8
+"""
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from fnmatch import fnmatchcase
+from struct import Struct
+
+from circkit.location import Location
+
+# flag in the top byte of CircuitInfo.memory (see fastcircuit.h)
+REGION_TABLE = 0x40
+
+TABLE_HEADER = Struct("<3Q")
+TAG_LENGTH = Struct("<I")
+CIRCUIT_INFO = Struct("<5Q")
+MEMORY_BITS = 56
+
+
+def region(nodes, token):
+    """Context tagging the nodes created inside with the token
+    (appended to the current location of the circuit of the given nodes,
+    does nothing if none of them is a circuit node, e.g. constants)"""
+    for node in nodes:
+        circuit = getattr(node, "circuit", None)
+        if circuit is not None:
+            return circuit.with_location(token)
+    return nullcontext()
+
+
+@contextmanager
+def at_location(circuit, location):
+    """Context creating nodes in the circuit at the given location (a tuple of tokens)"""
+    prev = circuit.location
+    circuit.location = location
+    try:
+        yield
+    finally:
+        circuit.location = prev
+
+
+class KeepRegions(object):
+    """
+    Transformer mixin (before CircuitTransformer) creating the nodes of each visit
+    at the location of the visited node, extended by region_token(node) if any,
+    so that the regions of the source circuit survive the transform.
+    """
+    def visit(self, node, *args):
+        location = getattr(node, "location", None)
+        token = self.region_token(node)
+        if token:
+            location = Location(location or ()) + (token,)
+        if not location:
+            return super().visit(node, *args)
+        with at_location(self.target_circuit, location):
+            return super().visit(node, *args)
+
+    def region_token(self, node):
+        return None
+
+
+def match_region(tag, pattern):
+    """Whether the tag is in the region: its first tokens match the tokens
+    of the pattern (fnmatch), e.g. "r1:sb" and "*:sb:s0" match "r1:sb:s0:ISW_AND"
+    """
+    tokens = tag.split(":")
+    patterns = pattern.split(":")
+    if len(tokens) < len(patterns):
+        return False
+    return all(fnmatchcase(t, p) for t, p in zip(tokens, patterns))
+
+
+class RegionRuns(object):
+    """Runs of consecutive trace nodes with the same tag, as (start, stop, tag)"""
+    def __init__(self, runs=(), num_nodes=None):
+        self.runs = list(runs)
+        if num_nodes is None:
+            num_nodes = self.runs[-1][1] if self.runs else 0
+        self.num_nodes = num_nodes
+
+    def __iter__(self):
+        return iter(self.runs)
+
+    def __len__(self):
+        return len(self.runs)
+
+    def __repr__(self):
+        return "<RegionRuns: %d runs, %d nodes>" % (len(self.runs), self.num_nodes)
+
+    def tags(self):
+        """Distinct tags, in order of appearance"""
+        return list(dict.fromkeys(tag for _, _, tag in self.runs))
+
+    def select(self, patterns):
+        """(start, stop) ranges of the nodes in the regions matching any of the patterns,
+        adjacent ranges merged"""
+        ranges = []
+        for start, stop, tag in self.runs:
+            if not any(match_region(tag, pattern) for pattern in patterns):
+                continue
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = ranges[-1][0], stop
+            else:
+                ranges.append((start, stop))
+        return ranges
+
+    def filtered(self, nodes):
+        """Runs over the positions of traces recorded with a trace filter
+        (nodes: sorted node indices, see FastCircuit.set_trace_filter)"""
+        runs = []
+        for start, stop, tag in self.runs:
+            start, stop = bisect_left(nodes, start), bisect_left(nodes, stop)
+            if start == stop:
+                continue
+            if runs and runs[-1][2] == tag:
+                runs[-1] = runs[-1][0], stop, tag
+            else:
+                runs.append((start, stop, tag))
+        return RegionRuns(runs, num_nodes=len(nodes))
+
+    def pack(self):
+        tags = {}
+        for _, _, tag in self.runs:
+            tags.setdefault(tag, len(tags))
+        n = len(self.runs)
+        data = [
+            TABLE_HEADER.pack(n, len(tags), self.num_nodes),
+            Struct("<%dQ" % n).pack(*(start for start, _, _ in self.runs)),
+            Struct("<%dI" % n).pack(*(tags[tag] for _, _, tag in self.runs)),
+        ]
+        for tag in tags:
+            tag = tag.encode()
+            data.append(TAG_LENGTH.pack(len(tag)))
+            data.append(tag)
+        return b"".join(data)
+
+    @classmethod
+    def unpack(cls, data, pos=0):
+        n, n_tags, num_nodes = TABLE_HEADER.unpack_from(data, pos)
+        pos += TABLE_HEADER.size
+        assert len(data) - pos >= 12 * n, "truncated region table"
+        starts = Struct("<%dQ" % n).unpack_from(data, pos)
+        pos += 8 * n
+        tag_ids = Struct("<%dI" % n).unpack_from(data, pos)
+        pos += 4 * n
+        tags = []
+        for _ in range(n_tags):
+            length, = TAG_LENGTH.unpack_from(data, pos)
+            pos += TAG_LENGTH.size
+            assert pos + length <= len(data), "truncated region table"
+            tags.append(bytes(data[pos:pos + length]).decode())
+            pos += length
+        stops = starts[1:] + (num_nodes,)
+        return cls(
+            [(start, stop, tags[i]) for start, stop, i in zip(starts, stops, tag_ids)],
+            num_nodes=num_nodes,
+        )
+
+    def to_file(self, filename):
+        with open(filename, "wb") as f:
+            f.write(self.pack())
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename, "rb") as f:
+            return cls.unpack(f.read())
+
+
+class RegionRunsBuilder(object):
+    """Collects the tags of the trace nodes in order (see RawSerializer.regions)"""
+    def __init__(self):
+        self.starts = []
+        self.tags = []
+        self.num_nodes = 0
+        self.last_location = self.last_tag = None
+
+    def add(self, node):
+        location = getattr(node, "location", None)
+        if location is not self.last_location:
+            # nodes created in the same context share their location
+            self.last_location = location
+            tag = str(location) if location else ""
+            if tag != self.last_tag:
+                self.last_tag = tag
+                self.starts.append(self.num_nodes)
+                self.tags.append(tag)
+        self.num_nodes += 1
+
+    def runs(self):
+        stops = self.starts[1:] + [self.num_nodes]
+        return RegionRuns(zip(self.starts, stops, self.tags), num_nodes=self.num_nodes)
+
+
+def read_region_table(circuit):
+    """Region table (RegionRuns) of a serialized circuit, None if it has none
+    (circuit: file name, bytes or the (header, opcodes) pair of RawSerializer.serialize)"""
+    if isinstance(circuit, tuple):
+        header, opcodes = circuit
+        circuit = b"".join(header) + b"".join(opcodes)
+    if isinstance(circuit, (bytes, bytearray, memoryview)):
+        data = memoryview(circuit)
+        info = CIRCUIT_INFO.unpack_from(data)
+        start = table_offset(info)
+        return None if start is None else RegionRuns.unpack(data, start)
+
+    with open(circuit, "rb") as f:
+        info = CIRCUIT_INFO.unpack(f.read(CIRCUIT_INFO.size))
+        start = table_offset(info)
+        if start is None:
+            return None
+        f.seek(start)
+        return RegionRuns.unpack(f.read())
+
+
+def table_offset(info):
+    input_size, output_size, _, opcodes_size, memory = info
+    flags = memory >> MEMORY_BITS
+    if not flags & REGION_TABLE:
+        return None
+    # the other bits hold the address size (0 means 2)
+    addr_bytes = (flags & 0x3f) or 2
+    return CIRCUIT_INFO.size + addr_bytes * (input_size + output_size) + opcodes_size
@@ -1,3 +1,4 @@
+import heapq
 from collections import defaultdict
 from circkit.transformers import Transformer
 
@@ -9,11 +10,21 @@ class Serializer(Transformer):
     """
     reuse_memory = True
     ignore_ops = ()
+    # which free memory cell a new wire gets:
+    #   "lifo": the last freed one (hot in cache, but scattered over the memory)
+    #   "lowest": the lowest free address (keeps the working set packed at the start of the memory)
+    #   "operand": as lifo, but the cells of operands used for the last time are freed first,
+    #              so that the gate overwrites one of them (requires not serializing frees)
+    alloc_strategy = "lifo"
 
     def __init__(self, **kwargs):
         for k in kwargs:
             assert hasattr(self, k), "unknown option %s" % k
         self.__dict__.update(kwargs)
+        assert self.alloc_strategy in ("lifo", "lowest", "operand"), \
+            "unknown allocation strategy %s" % self.alloc_strategy
+        assert self.alloc_strategy != "operand" or "free" in self.ignore_ops, \
+            "frees can not be serialized before the gate"
 
     def before_transform(self, circuit):
         super().before_transform(circuit)
@@ -32,10 +43,23 @@ class Serializer(Transformer):
         return self.header, self.code
 
     def alloc(self, bit):
+        self.bit_id[bit] = self.new_cell()
+
+    def new_cell(self):
         if not self.free:
-            self.free.append(self.ram_size)
             self.ram_size += 1
-        self.bit_id[bit] = self.free.pop()
+            return self.ram_size - 1
+        elif self.alloc_strategy == "lowest":
+            # free cells form a min-heap
+            return heapq.heappop(self.free)
+        else:
+            return self.free.pop()
+
+    def release(self, addr):
+        if self.alloc_strategy == "lowest":
+            heapq.heappush(self.free, addr)
+        else:
+            self.free.append(addr)
 
     def visit_INPUT(self, bit):
         self.alloc(bit)
@@ -43,14 +67,23 @@ class Serializer(Transformer):
             self.serialize_input(bit)
 
     def visit_generic(self, bit, *args):
-        self.alloc(bit)
-        if bit.operation._name not in self.ignore_ops:
-            self.serialize_bit(bit)
-
+        last_used = []
         for arg in bit.incoming:
             self.n_used[arg] += 1
             assert self.n_used[arg] <= len(arg.outgoing)
             if self.n_used[arg] == len(arg.outgoing):
+                last_used.append(arg)
+
+        if self.alloc_strategy == "operand":
+            # gates read their operands before writing the result
+            for arg in last_used:
+                self.on_free(arg)
+        self.alloc(bit)
+        if bit.operation._name not in self.ignore_ops:
+            self.serialize_bit(bit)
+
+        if self.alloc_strategy != "operand":
+            for arg in last_used:
                 self.on_free(arg)
 
     def make_output(self, bit, result):
@@ -60,25 +93,40 @@ class Serializer(Transformer):
     def on_free(self, bit):
         if self.reuse_memory:
             assert bit in self.bit_id, "double free?"
-            self.free.append(self.bit_id[bit])
+            self.release(self.bit_id[bit])
 
         if "free" not in self.ignore_ops:
             self.serialize_free(bit)
 
 
-from struct import pack, unpack
+from io import BytesIO
+from struct import Struct, pack, unpack
+
+from wboxkit.regions import REGION_TABLE, RegionRunsBuilder
+from wboxkit.symbols import SymbolWriter
 FORMATS = {1: "B", 2: "H", 4: "I", 8: "Q"} # uint8, uint16, uint32, uint64
 
 class RawSerializer(Serializer):
     """
     Basic raw serialization. Not optimal, ops can be encoded by fewer bits, etc.
+
+    Opcodes are streamed: they are packed into a block buffer which is written out
+    when full, and the header (known at the end only) is patched in afterwards,
+    so that serialize_to_file needs memory for the live wires only.
     """
     # these options can be overriden by initialization
     bytes_op = 1
     bytes_input = 1
     bytes_output = 1
-    bytes_addr = 2
+    # 2 or 4 (the C side supports both), None: 2 if the circuit fits in 2^16 memory cells
+    bytes_addr = None
     endian = "<"
+    # size of the buffer of packed opcodes
+    block_size = 1 << 20
+    # flags stored with the address size (see fastcircuit.h)
+    memory_flags = 0
+    # store the region table (tags of the nodes, see wboxkit.regions) after the opcodes
+    regions = False
 
     # preserve BitOP ordering?
     # opmap = lambda op: op
@@ -89,15 +137,30 @@ class RawSerializer(Serializer):
         OR=3,
         NOT=4,
         RANDOM=5,
+        RND=5,  # circkit's name of RANDOM
+        # fused opcodes (see fastcircuit.h)
+        XOR3=6,
+        ANDXOR=7,
+        ANDNOT=8,
+        MUX=9,
+        XORN=10,
     ).__getitem__
     ignore_ops = ("free",)
 
+    # merge runs of adjacent gates into fused opcodes (traces are unchanged)
+    fuse = True
+    # largest XORN (its size is stored as an address)
+    max_xor_inputs = 2**16 - 1
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.format_op = FORMATS[self.bytes_op]
         self.format_input = FORMATS[self.bytes_input]
         self.format_output = FORMATS[self.bytes_output]
-        self.format_addr = FORMATS[self.bytes_addr]
+        self.out = None
+        self.header_pos = None
+        # file object of the symbol table (see wboxkit.symbols), if any
+        self.symbols_out = None
 
     def pack(self, format, *args):
         if not args:
@@ -115,13 +178,160 @@ class RawSerializer(Serializer):
             return
         return super().on_free(bit)
 
+    def serialize_opcodes(self, circuit):
+        """
+        Transform the circuit, writing opcodes to self.out.
+        Addresses are packed as they are produced, before the memory size is known:
+        with automatic address size, the circuit is serialized again
+        with 4-byte addresses if it runs out of 2^16 memory cells.
+        """
+        start = self.out.tell()
+        if self.symbols_out is not None:
+            symbols_start = self.symbols_out.tell()
+        self.addr_bytes = self.bytes_addr or 2
+        while True:
+            try:
+                return super().serialize(circuit)
+            except AddressOverflow:
+                self.addr_bytes = 4
+                self.out.seek(start)
+                self.out.truncate()
+                if self.symbols_out is not None:
+                    self.symbols_out.seek(symbols_start)
+                    self.symbols_out.truncate()
+
+    def overflow(self):
+        if self.bytes_addr is None and self.addr_bytes == 2:
+            raise AddressOverflow()
+        raise AssertionError(
+            "circuit needs more than %d memory cells, too many for %d-byte addresses"
+            % (2**(8 * self.addr_bytes), self.addr_bytes)
+        )
+
+    def before_transform(self, circuit):
+        super().before_transform(circuit)
+        # instructions not packed yet (the last ones, for fusion)
+        # and the bits they compute
+        self.code_bits = []
+
+        self.format_addr = FORMATS[self.addr_bytes]
+        self.structs = {}
+        self.block = bytearray(self.block_size)
+        self.block_pos = 0
+        self.num_opcodes = 0
+        self.opcodes_size = 0
+        self.symbols = None
+        if self.symbols_out is not None:
+            self.symbols = SymbolWriter(self.symbols_out)
+        self.region_runs = RegionRunsBuilder() if self.regions else None
+        self.output_ids = {id(ybit) for ybit in circuit.outputs}
+        if self.header_pos is not None:
+            # placeholder, see after_transform
+            self.out.write(bytes(
+                8 * 5 + self.addr_bytes * (circuit.n_inputs + circuit.n_outputs)
+            ))
+
+    def visit_all(self, circuit):
+        """
+        Serializer.visit_INPUT/visit_generic inlined, with state
+        keyed by id() (nodes hash in Python) and dropped when wires die.
+        Dead wires go through on_free (keeping bit_id of all wires)
+        unless their cells are just released: with reuse_memory,
+        frees not serialized and on_free not overridden.
+        Subclasses overriding visit_INPUT, visit_generic or serialize_bit
+        get the generic visit instead (same output, slower).
+        """
+        cls = type(self)
+        if (cls.visit_INPUT is not Serializer.visit_INPUT
+                or cls.visit_generic is not Serializer.visit_generic
+                or cls.serialize_bit is not RawSerializer.serialize_bit):
+            return super().visit_all(circuit)
+
+        ignore_ops = set(self.ignore_ops)
+        outputs = self.output_ids
+        plain_free = (
+            self.reuse_memory
+            and "free" in ignore_ops
+            and type(self).on_free is RawSerializer.on_free
+        )
+        on_free = self.on_free
+        release = self.release
+        new_cell = self.new_cell
+        operand_first = self.alloc_strategy == "operand"
+        max_cells = 2**(8 * self.addr_bytes)
+        symbols = self.symbols
+        region_runs = self.region_runs
+        addr = {}
+        uses = {}
+        for bit in circuit:
+            name = bit.operation._name
+            args = []
+            dead = []
+            for arg in bit.incoming:
+                key = id(arg)
+                args.append(addr[key])
+                uses[key] -= 1
+                if not uses[key] and key not in outputs:
+                    dead.append((key, arg))
+
+            if operand_first:
+                # gates read their operands before writing the result
+                for key, arg in dead:
+                    if plain_free:
+                        release(addr[key])
+                    else:
+                        on_free(arg)
+            dst = new_cell()
+            if dst >= max_cells:
+                self.overflow()
+            key = id(bit)
+            addr[key] = dst
+            uses[key] = len(bit.outgoing)
+            if not plain_free or name == "INPUT" or key in outputs:
+                self.bit_id[bit] = dst
+            if name != "INPUT" and name not in ignore_ops:
+                self.serialize_gate(bit, (self.opmap(name), dst, *args))
+                # gates are traced in this order, also when fused
+                if symbols is not None:
+                    symbols.add(bit)
+                if region_runs is not None:
+                    region_runs.add(bit)
+
+            for key, arg in dead:
+                if not operand_first:
+                    if plain_free:
+                        release(addr[key])
+                    else:
+                        on_free(arg)
+                del addr[key]
+                del uses[key]
+        # outputs are serialized by the header
+        self.result = dict.fromkeys(circuit.outputs)
+
     def after_transform(self, *args, **kwargs):
+        while self.code:
+            self.emit(self.code.pop(0))
+        self.code_bits = []
+        self.flush()
+        self.block = self.structs = None
+        memory_flags = self.memory_flags
+        if self.region_runs is not None:
+            self.out.write(self.region_runs.runs().pack())
+            self.region_runs = None
+            memory_flags |= REGION_TABLE
+        if self.symbols is not None:
+            self.symbols.close()
+            self.symbols = None
+
+        memory = self.ram_size
+        # the top byte of memory holds the address size (0 means 2) and flags
+        memory |= ((self.addr_bytes if self.addr_bytes != 2 else 0) | memory_flags) << 56
         self.info = (
             self.source_circuit.n_inputs,
             self.source_circuit.n_outputs,
-            len(self.code),
-            sum(map(len, self.code)),
-            self.ram_size,
+            self.num_opcodes,
+            self.opcodes_size,
+            memory,
         )
         self.input_addr = [
             self.bit_id[xbit]
@@ -146,6 +356,12 @@ class RawSerializer(Serializer):
             self.pack(self.format_addr, *self.output_addr)
         )
 
+        if self.header_pos is not None:
+            end = self.out.tell()
+            self.out.seek(self.header_pos)
+            self.out.write(b"".join(self.header))
+            self.out.seek(end)
+
         super().after_transform(*args, **kwargs)
 
     def serialize_input(self, bit):
@@ -156,59 +372,212 @@ class RawSerializer(Serializer):
         # information is saved in the header, so no need to do anything here
         pass
 
+    def alloc(self, bit):
+        super().alloc(bit)
+        if self.bit_id[bit] >= 2**(8 * self.addr_bytes):
+            self.overflow()
+
     def serialize_bit(self, bit):
-        for arg in bit.incoming:
-            assert isinstance(arg, type(bit)), "Not implemented serialization of non-Bit arguments"
+        """Serialize the gate computing the bit (generic visit, see visit_all),
+        operands are in bit_id"""
+        incoming = [self.bit_id[arg] for arg in bit.incoming]
+        self.serialize_gate(bit, (self.opmap(bit.operation._name), self.bit_id[bit], *incoming))
+        if self.symbols is not None:
+            self.symbols.add(bit)
+        if self.region_runs is not None:
+            self.region_runs.add(bit)
+
+    def serialize_gate(self, bit, instr):
+        """Fuse (see fuse_gate) and pack the instruction (op, dst, *args) of the bit"""
+        if self.fuse:
+            instr = self.fuse_gate(bit, instr)
+            self.code.append(instr)
+            self.code_bits.append(bit)
+            # fusion looks back 2 instructions at most
+            if len(self.code) > 2:
+                self.emit(self.code.pop(0))
+                self.code_bits.pop(0)
+        else:
+            self.emit(instr)
+
+    def emit(self, instr):
+        """Pack the instruction (op, dst, *args) into the block buffer"""
+        fmt = self.structs.get(len(instr))
+        if fmt is None:
+            fmt = self.structs[len(instr)] = Struct(
+                self.endian + self.format_op + self.format_addr * (len(instr) - 1)
+            )
+        self.reserve(fmt.size)
+        fmt.pack_into(self.block, self.block_pos, *instr)
+        self.block_pos += fmt.size
+        self.num_opcodes += 1
+        self.opcodes_size += fmt.size
+
+    def reserve(self, size):
+        """Make room for size bytes in the block buffer"""
+        if self.block_pos + size > len(self.block):
+            self.flush()
+            if size > len(self.block):
+                self.block = bytearray(size)
+
+    def flush(self):
+        self.out.write(memoryview(self.block)[:self.block_pos])
+        self.block_pos = 0
+
+    def fusable(self, bit):
+        # the only use of the bit is by the next gate, so it needs no memory cell
+        return len(bit.outgoing) == 1 and id(bit) not in self.output_ids
+
+    def fuse_gate(self, bit, instr):
+        """
+        Fuse the gate with the previous instruction(s) if it is their only user:
+        x ^ y ^ z (XOR3, XORN), x ^ (y & z) (ANDXOR), ~x & y (ANDNOT)
+        and x ^ (s & (x ^ y)) (MUX).
+        Gates are only fused in the serialization order,
+        so that the fused opcodes trace the same values in the same order.
+        """
+        name = bit.operation._name
+        if name not in ("XOR", "AND") or not self.code_bits:
+            return instr
+        t = self.code_bits[-1]
+        if t not in bit.incoming or not self.fusable(t):
+            return instr
+        op, dst, *args = instr
+        other = args[1] if bit.incoming[0] is t else args[0]
+        prev_op, _, *prev_args = self.code[-1]
+        opmap = self.opmap
+
+        if name == "AND":
+            if prev_op != opmap("NOT"):
+                return instr
+            fused = (opmap("ANDNOT"), dst, *prev_args, other)
+        elif prev_op == opmap("XOR"):
+            fused = (opmap("XOR3"), dst, *prev_args, other)
+        elif prev_op == opmap("XOR3"):
+            fused = (opmap("XORN"), dst, 4, *prev_args, other)
+        elif prev_op == opmap("XORN") and prev_args[0] < self.max_xor_inputs:
+            fused = (opmap("XORN"), dst, prev_args[0] + 1, *prev_args[1:], other)
+        elif prev_op == opmap("AND"):
+            fused = (opmap("ANDXOR"), dst, other, *prev_args)
+            mux = self.fuse_mux(bit, t, other)
+            if mux:
+                self.code.pop()
+                self.code_bits.pop()
+                fused = (opmap("MUX"), dst, *mux)
+        else:
+            return instr
+
+        self.code.pop()
+        self.code_bits.pop()
+        return fused
+
+    def fuse_mux(self, bit, t, x_addr):
+        """Operands (x, y, s) if bit = x ^ t, t = s & u, u = x ^ y
+        where u is the previous instruction, only used by t
+        (addresses are taken from the instructions, cells of dead wires are forgotten)"""
+        if len(self.code_bits) < 2:
+            return
+        u = self.code_bits[-2]
+        if self.code[-2][0] != self.opmap("XOR") or not self.fusable(u):
+            return
+        if u not in t.incoming:
+            return
+        _, _, t_arg0, t_arg1 = self.code[-1]
+        _, _, u_arg0, u_arg1 = self.code[-2]
+        s_addr = t_arg1 if t.incoming[0] is u else t_arg0
+        x = bit.incoming[1] if bit.incoming[0] is t else bit.incoming[0]
+        if x is u.incoming[0]:
+            y_addr = u_arg1
+        elif x is u.incoming[1]:
+            y_addr = u_arg0
+        else:
+            return
+        return x_addr, y_addr, s_addr
 
-        res = (
-            self.pack(self.format_op, self.opmap(bit.operation._name))
-          + self.pack(self.format_addr, self.bit_id[bit])
-        )
-        if bit.incoming:
-            incoming = [self.bit_id[bit] for bit in bit.incoming]
-            res += self.pack(self.format_addr, *incoming)
-        self.code.append(res)
-
-    def serialize_to_file(self, circuit, filename):
-        header, opcodes = self.serialize(circuit)
-        header_data = b"".join(header)
-        opcodes_data = b"".join(opcodes)
+    def serialize(self, circuit):
+        """Serialized circuit as (header, opcodes) lists of bytes (to be joined),
+        the opcodes are packed into one bytes object (not one per gate)"""
+        self.out = BytesIO()
+        self.header_pos = None
+        try:
+            self.serialize_opcodes(circuit)
+            return self.header, [self.out.getvalue()]
+        finally:
+            self.out = None
+
+    def serialize_to_stream(self, circuit, f, symbols=None):
+        """Write the serialized circuit to a seekable binary file object,
+        and its symbol table to the symbols one if given (see wboxkit.symbols)"""
+        self.out = f
+        self.header_pos = f.tell()
+        self.symbols_out = symbols
+        try:
+            self.serialize_opcodes(circuit)
+        finally:
+            self.out = self.header_pos = self.symbols_out = None
+
+    def serialize_to_file(self, circuit, filename, symbols_filename=None):
+        """Write the serialized circuit to a file, and if symbols_filename is given,
+        the symbol table mapping trace positions to its gates (see wboxkit.symbols)"""
         with open(filename, "wb") as f:
-            f.write(header_data)
-            f.write(opcodes_data)
-
-
-# class CompactRawSerializer(RawSerializer):
-#     """
-#     Compact raw serialization. opcode byte contains part of the destination address.
-#     """
-#     opmap = {
-#         OP.XOR: 0,
-#         OP.AND: 1,
-#         OP.OR: 2,
-#         OP.NOT: 3,
-#     }.__getitem__
-#     op_bits = 2
-#     free_bits = 6
-
-#     def serialize_bit(self, bit):
-#         for arg in bit.args:
-#             assert isinstance(arg, type(bit)), "Not implemented serialization of non-Bit arguments"
-
-#         dst = self.bit_id[bit]
-#         dst_hi  = dst >> 8
-#         if dst_hi >= (1 << self.free_bits):
-#             raise ValueError("Too much RAM usage for compact serializer!")
-#         dst_lo = dst & 0xff
-
-#         byte1 = self.opmap(bit.op) | (dst_hi << self.op_bits)
-#         byte2 = dst_lo
-
-#         res = (
-#             self.pack(self.format_op, byte1)
-#           + self.pack(self.format_op, byte2)
-#         )
-#         if bit.args:
-#             args = [self.bit_id[bit] for bit in bit.args]
-#             res += self.pack(self.format_addr, *args)
-#         self.code.append(res)
+            if symbols_filename is None:
+                self.serialize_to_stream(circuit, f)
+                return
+            with open(symbols_filename, "wb") as fs:
+                self.serialize_to_stream(circuit, f, symbols=fs)
+
+
+def varint(value):
+    """LEB128 encoding of a non-negative integer"""
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+VARINTS = [varint(value) for value in range(1 << 14)]
+
+
+class CompactRawSerializer(RawSerializer):
+    """
+    Compact raw serialization: opcodes are LEB128 varints.
+    The first one holds the op in its low 4 bits and, above them,
+    the delta of the destination from the previous destination;
+    operands follow as deltas from the destination
+    (deltas are zigzag encoded, the number of XORN operands is stored as is).
+    Cells in use are close to each other with the lifo allocation,
+    so that most fields take one byte (usually 3 bytes for a binary gate instead of 7).
+    The C side decodes it to the same code as RawSerializer's.
+    """
+    memory_flags = 0x80  # COMPACT_OPCODES
+
+    def before_transform(self, circuit):
+        super().before_transform(circuit)
+        self.prev_dst = 0
+
+    def emit(self, instr):
+        op, dst, *args = instr
+        assert op < 16
+        fields = [(zigzag(dst - self.prev_dst) << 4) | op]
+        self.prev_dst = dst
+        if op == self.opmap("XORN"):
+            fields.append(args.pop(0))
+        fields.extend(zigzag(addr - dst) for addr in args)
+        data = b"".join(
+            VARINTS[value] if value < len(VARINTS) else varint(value)
+            for value in fields
+        )
+        self.reserve(len(data))
+        self.block[self.block_pos:self.block_pos + len(data)] = data
+        self.block_pos += len(data)
+        self.num_opcodes += 1
+        self.opcodes_size += len(data)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+class AddressOverflow(Exception):
+    pass
@@ -0,0 +1,147 @@
+"""
+Symbol table of a serialized circuit: a sidecar file describing its gates
+in trace order (the i-th record is the i-th node of a full trace),
+written by RawSerializer (see serialize_to_file) and read by SymbolTable
+without loading it, to resolve trace positions to gates.
+
+Layout (little-endian):
+    header: magic, number of records, number of strings (uint64)
+    records: node id, op, operand ids (2), tag (uint32)
+        op and tag index the strings, missing operands are NONE
+    string offsets: start of each string and end of the last one (uint64)
+    strings: utf-8
+"""
+import mmap
+from struct import Struct
+
+MAGIC = b"WBSYMTAB"
+HEADER = Struct("<8sQQ")
+RECORD = Struct("<5I")
+OFFSET = Struct("<Q")
+NONE = 2**32 - 1
+
+
+class SymbolWriter(object):
+    """
+    Streams the records of the gates to a seekable binary file object,
+    the header (known at the end only) is patched in by close().
+    Ops and tags (node locations) are stored once in the string table.
+    """
+    # records buffered before writing
+    block_records = 1 << 16
+
+    def __init__(self, f):
+        self.out = f
+        self.start = f.tell()
+        self.strings = {"": 0}
+        self.num_records = 0
+        self.block = []
+        f.write(bytes(HEADER.size))
+
+    def string(self, s):
+        index = self.strings.get(s)
+        if index is None:
+            index = self.strings[s] = len(self.strings)
+        return index
+
+    def add(self, node):
+        args = [arg.id for arg in node.incoming]
+        assert len(args) <= 2, "gates with more than 2 operands are not supported"
+        args += [NONE] * (2 - len(args))
+        location = getattr(node, "location", None)
+        self.block.append(RECORD.pack(
+            node.id,
+            self.string(node.operation._name),
+            *args,
+            self.string(str(location) if location else ""),
+        ))
+        self.num_records += 1
+        if len(self.block) >= self.block_records:
+            self.flush()
+
+    def flush(self):
+        self.out.write(b"".join(self.block))
+        self.block = []
+
+    def close(self):
+        self.flush()
+        strings = [s.encode() for s in self.strings]
+        offset = 0
+        offsets = []
+        for s in strings:
+            offsets.append(OFFSET.pack(offset))
+            offset += len(s)
+        offsets.append(OFFSET.pack(offset))
+        self.out.write(b"".join(offsets))
+        self.out.write(b"".join(strings))
+
+        end = self.out.tell()
+        self.out.seek(self.start)
+        self.out.write(HEADER.pack(MAGIC, self.num_records, len(strings)))
+        self.out.seek(end)
+
+
+class Symbol(tuple):
+    """Record of a gate: (node id, op, operand ids, tag)"""
+    __slots__ = ()
+
+    id = property(lambda self: self[0])
+    op = property(lambda self: self[1])
+    args = property(lambda self: self[2])
+    tag = property(lambda self: self[3])
+
+    def __str__(self):
+        s = "#%d = %s(%s)" % (
+            self.id, self.op, ", ".join("#%d" % arg for arg in self.args),
+        )
+        if self.tag:
+            s += " @ " + self.tag
+        return s
+
+
+class SymbolTable(object):
+    """
+    Memory-mapped symbol table (see SymbolWriter), table[i] is the Symbol
+    of the i-th node of full traces. Traces recorded with a filter
+    have their own positions: nodes = read_trace_index(...) maps them
+    to the positions of full traces (see wboxkit.tracing).
+    """
+    def __init__(self, filename, nodes=None):
+        with open(filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.num_records, self.num_strings = HEADER.unpack_from(self.map)
+        assert magic == MAGIC, "not a symbol table: %s" % filename
+        self.offsets_pos = HEADER.size + RECORD.size * self.num_records
+        self.strings_pos = self.offsets_pos + OFFSET.size * (self.num_strings + 1)
+        assert len(self.map) >= self.strings_pos, "truncated symbol table"
+        self.strings = {}
+        self.nodes = nodes
+
+    def __len__(self):
+        return self.num_records if self.nodes is None else len(self.nodes)
+
+    def __getitem__(self, i):
+        if self.nodes is not None:
+            i = self.nodes[i]
+        if not 0 <= i < self.num_records:
+            raise IndexError("node %d not in the symbol table" % i)
+        node_id, op, arg0, arg1, tag = RECORD.unpack_from(
+            self.map, HEADER.size + RECORD.size * i,
+        )
+        args = tuple(arg for arg in (arg0, arg1) if arg != NONE)
+        return Symbol((node_id, self.string(op), args, self.string(tag)))
+
+    def string(self, index):
+        s = self.strings.get(index)
+        if s is None:
+            assert index < self.num_strings, "corrupted symbol table"
+            pos = self.offsets_pos + OFFSET.size * index
+            start, = OFFSET.unpack_from(self.map, pos)
+            end, = OFFSET.unpack_from(self.map, pos + OFFSET.size)
+            s = self.strings[index] = bytes(
+                self.map[self.strings_pos + start:self.strings_pos + end]
+            ).decode()
+        return s
+
+    def close(self):
+        self.map.close()
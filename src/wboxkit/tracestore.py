@@ -0,0 +1,149 @@
+"""
+Trace store: the traces of a campaign in one file, in the node-major layout
+produced by the circuit (see FastCircuit.compute_batch_stream),
+so that neither the tracer nor the attacks transpose them
+(unlike per-trace files, see wboxkit.tracing.trace_split_batch).
+
+Layout (little-endian):
+    header: magic, number of traces, number of nodes,
+        plaintext bytes, ciphertext bytes (uint64)
+    plaintexts, ciphertexts (contiguous)
+    rows: the values of each node over all traces
+        (bit i: trace i, packed MSB first, zero-padded to full bytes)
+"""
+import mmap
+import os
+from struct import Struct
+
+from wboxkit.fastcircuit import DEFAULT_BATCH, chunks, copy_bit_rows, trace_item_bytes
+
+MAGIC = b"WBTRACES"
+HEADER = Struct("<8s4Q")
+FILENAME = "traces.wbt"
+
+
+class TraceStore(object):
+    """Memory-mapped trace store (read-only, or writable for TraceStoreWriter)"""
+    def __init__(self, filename, writable=False):
+        mode, access = ("r+b", mmap.ACCESS_WRITE) if writable else ("rb", mmap.ACCESS_READ)
+        with open(filename, mode) as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=access)
+        magic, self.ntraces, self.num_nodes, self.pt_bytes, self.ct_bytes = HEADER.unpack_from(self.map)
+        assert magic == MAGIC, "not a trace store: %s" % filename
+        self.row_bytes = (self.ntraces + 7) // 8
+        self.pts_pos = HEADER.size
+        self.cts_pos = self.pts_pos + self.ntraces * self.pt_bytes
+        self.rows_pos = self.cts_pos + self.ntraces * self.ct_bytes
+        size = self.rows_pos + self.num_nodes * self.row_bytes
+        assert len(self.map) >= size, "truncated trace store: %s" % filename
+
+    def plaintexts(self):
+        return chunks(self.map[self.pts_pos:self.cts_pos], self.pt_bytes)
+
+    def ciphertexts(self):
+        return chunks(self.map[self.cts_pos:self.rows_pos], self.ct_bytes)
+
+    def rows(self, start, stop):
+        """Rows of the nodes start..stop-1 (row_bytes each), as bytes"""
+        stop = min(stop, self.num_nodes)
+        if start >= stop:
+            return b""
+        return self.map[self.rows_pos + start * self.row_bytes:self.rows_pos + stop * self.row_bytes]
+
+    def close(self):
+        self.map.close()
+
+
+class TraceStoreWriter(TraceStore):
+    """
+    Writable trace store (see create), batches are written in place
+    from the streamed traces of the circuit (the rows of a batch are bit ranges
+    of the rows of the store). Several processes can write batches
+    to the same store, if they do not share bytes of the rows
+    (batches starting at multiples of 8).
+    """
+    def __init__(self, filename):
+        super().__init__(filename, writable=True)
+
+    @classmethod
+    def create(cls, filename, ntraces, num_nodes, pt_bytes, ct_bytes):
+        """New store of ntraces traces of num_nodes nodes (zero-filled)"""
+        assert ntraces >= 1
+        with open(filename, "wb") as f:
+            f.write(HEADER.pack(MAGIC, ntraces, num_nodes, pt_bytes, ct_bytes))
+            f.truncate(
+                HEADER.size
+                + ntraces * (pt_bytes + ct_bytes)
+                + num_nodes * ((ntraces + 7) // 8)
+            )
+        return cls(filename)
+
+    @classmethod
+    def grow(cls, filename, ntraces, block_nodes=1 << 16):
+        """Extend the store to ntraces traces (the new ones zero-filled),
+        the file is replaced once the old traces are copied"""
+        old = TraceStore(filename)
+        assert ntraces >= old.ntraces
+        tmp = str(filename) + ".tmp"
+        new = cls.create(tmp, ntraces, old.num_nodes, old.pt_bytes, old.ct_bytes)
+        pt_size = old.ntraces * old.pt_bytes
+        ct_size = old.ntraces * old.ct_bytes
+        new.map[new.pts_pos:new.pts_pos + pt_size] = old.map[old.pts_pos:old.pts_pos + pt_size]
+        new.map[new.cts_pos:new.cts_pos + ct_size] = old.map[old.cts_pos:old.cts_pos + ct_size]
+        for start in range(0, old.num_nodes, block_nodes):
+            copy_bit_rows(
+                old.rows(start, start + block_nodes),
+                new.map, new.rows_pos + start * new.row_bytes,
+                old.row_bytes, new.row_bytes, 0, old.ntraces,
+            )
+        old.close()
+        new.close()
+        os.replace(tmp, filename)
+
+    def set_texts(self, start, pts, cts):
+        """Plaintexts and ciphertexts of the traces start, start+1, ..."""
+        assert start + len(pts) <= self.ntraces and len(pts) == len(cts)
+        pos = self.pts_pos + start * self.pt_bytes
+        self.map[pos:pos + len(pts) * self.pt_bytes] = b"".join(pts)
+        pos = self.cts_pos + start * self.ct_bytes
+        self.map[pos:pos + len(cts) * self.ct_bytes] = b"".join(cts)
+
+    def batch_callback(self, start, batch):
+        """Callback for FastCircuit.compute_batch_stream storing the traces
+        of a batch of inputs as the traces start, start+1, ..."""
+        assert start + batch <= self.ntraces
+        item_bytes = trace_item_bytes(batch)
+        position = 0
+
+        def callback(data):
+            nonlocal position
+            n = len(data) // item_bytes
+            assert position + n <= self.num_nodes, "more nodes than in the store"
+            copy_bit_rows(
+                data, self.map, self.rows_pos + position * self.row_bytes,
+                item_bytes, self.row_bytes, start, batch,
+            )
+            position += n
+        return callback
+
+    def record(self, circuit, inputs, batch_size=DEFAULT_BATCH, start=0, seed=None, context=None):
+        """Trace the circuit (FastCircuit) on the inputs (as the traces start, start+1, ...),
+        in its default context or the given one, returns the outputs.
+        If seed is given, the batch starting at the trace t uses the random stream (seed, t),
+        see FastCircuit.set_seed."""
+        assert circuit.num_traced(context) == self.num_nodes, "the circuit traces another number of nodes"
+        outputs = []
+        for chunk in chunks(inputs, batch_size):
+            if seed is not None:
+                circuit.set_seed(seed, start, context=context)
+            cts = circuit.compute_batch_stream(
+                chunk, self.batch_callback(start, len(chunk)), context=context,
+            )
+            self.set_texts(start, chunk, cts)
+            outputs += cts
+            start += len(chunk)
+        return outputs
+
+    def close(self):
+        self.map.flush()
+        super().close()
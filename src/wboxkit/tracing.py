@@ -1,47 +1,62 @@
 import os, sys
+from array import array
+
+from wboxkit.fastcircuit import MAX_BATCH, trace_item_bytes, transpose_bits, unpack_bits
+
+# nodes transposed at once by trace_split_batch (multiple of 8)
+SPLIT_BLOCK_NODES = 1 << 16
+
+
+def write_trace_index(filename, nodes):
+    """Save indices of traced nodes (gates, uint64 little-endian),
+    the sidecar of traces recorded with a trace filter"""
+    nodes = array("Q", nodes)
+    if sys.byteorder != "little":
+        nodes.byteswap()
+    with open(filename, "wb") as f:
+        nodes.tofile(f)
+
+
+def read_trace_index(filename):
+    nodes = array("Q")
+    with open(filename, "rb") as f:
+        nodes.frombytes(f.read())
+    if sys.byteorder != "little":
+        nodes.byteswap()
+    return nodes.tolist()
 
 
 def trace_split_batch(filename, make_output_filename=None, ntraces=64, packed=True):
     """Split batched trace into byte-packed independent traces
-    Not very efficient now.
+    (or with one byte per node if not packed)
     """
     if make_output_filename is None:
         make_output_filename = lambda i: filename + ".%02d" % i
-    assert 0 <= ntraces <= 64
+    assert 1 <= ntraces <= MAX_BATCH
     sz = os.stat(filename).st_size
-    bytes_per_node = (ntraces + 7) // 8
+    bytes_per_node = trace_item_bytes(ntraces)
 
     assert sz % bytes_per_node == 0, "incorrect traces size (%d traces -> %d bytes per node * ? nodes = %d bytes trace file?)" % (ntraces, bytes_per_node, sz)
-    num_nodes = sz // bytes_per_node
 
-    traces = bytearray(ntraces)
     fos = [open(make_output_filename(i), "wb") for i in range(ntraces)]
-    bits = 0
     with open(filename, "rb") as f:
-        for inode in range(num_nodes):
-            block = bytearray(f.read(bytes_per_node))
-            for i in range(ntraces):
-                bit = (block[i >> 3] >> (7 - i & 7)) & 1
-                traces[i] = (traces[i] << 1) | bit
-
-            bits += 1
-
+        # node-major blocks -> trace-major blocks (zero-padded to full bytes)
+        while True:
+            data = f.read(SPLIT_BLOCK_NODES * bytes_per_node)
+            if not data:
+                break
+            n = len(data) // bytes_per_node
+            rows = transpose_bits(data, n, bytes_per_node * 8)
+            row_bytes = (n + 7) // 8
             if packed:
-                if inode == num_nodes - 1:
-                    for i in range(ntraces):
-                        traces[i] = traces[i] << (8 - bits)
-                    bits = 8
-
-                if bits == 8:
-                    for i in range(ntraces):
-                        fos[i].write(traces[i:i+1])
-                        traces[i] = 0
-                    bits = 0
+                rows = memoryview(rows)
+                for i in range(ntraces):
+                    fos[i].write(rows[i*row_bytes:(i+1)*row_bytes])
             else:
+                # one byte per node (the padding bits are dropped)
+                rows = memoryview(unpack_bits(rows))
                 for i in range(ntraces):
-                    fos[i].write(traces[i:i+1])
-                    traces[i] = 0
-                bits = 0
+                    fos[i].write(rows[i*row_bytes*8:i*row_bytes*8 + n])
 
     for fo in fos:
         fo.close()
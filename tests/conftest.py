@@ -0,0 +1,144 @@
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+# run against the source tree (libfastcircuit.so built in place,
+# e.g. python setup.py build_ext --inplace)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from circkit.boolean import OptBooleanCircuit as BooleanCircuit
+from binteger import Bin
+
+from wboxkit.ciphers.aes import BitAES
+
+
+def aes(rounds=1):
+    C = BooleanCircuit(name="AES")
+    pt = C.add_inputs(128)
+    ct, _ = BitAES(pt, Bin(b"abcdefghABCDEFGH").tuple, rounds=rounds)
+    C.add_output(ct)
+    C.in_place_remove_unused_nodes()
+    return C
+
+
+def fusable_patterns(seed=1, n_gates=400, kinds=range(6)):
+    """Random circuit built from the patterns of the fused opcodes:
+    a^(b&c), ~a&b, a^(c&(a^b)), XOR chains, (a|b)^c, b&(a^c)
+    (kinds: indices of the patterns to use)"""
+    r = random.Random(seed)
+    C = BooleanCircuit(name="patterns")
+    xs = list(C.add_inputs(24))
+    for _ in range(n_gates):
+        k = r.choice(kinds)
+        a, b, c = r.sample(xs, 3)
+        if k == 0:
+            v = a ^ (b & c)
+        elif k == 1:
+            v = ~a & b
+        elif k == 2:
+            v = a ^ (c & (a ^ b))
+        elif k == 3:
+            v = a
+            for y in r.sample(xs, r.randrange(2, 8)):
+                v = v ^ y
+        elif k == 4:
+            v = (a | b) ^ c
+        else:
+            v = b & (a ^ c)
+        xs.append(v)
+    C.add_output(xs[-20:] + [xs[30]])
+    C.in_place_remove_unused_nodes()
+    return C
+
+
+def wide_circuit(n_gates=70000):
+    """Circuit of n_gates gates over 16 inputs, needing n_gates memory cells
+    without memory reuse"""
+    C = BooleanCircuit(name="wide")
+    xs = list(C.add_inputs(16))
+    for i in range(n_gates):
+        xs.append(xs[-1] ^ xs[-16] if i % 3 else xs[-2] & xs[-9])
+    C.add_output(xs[-16:])
+    return C
+
+
+def random_inputs(circuit, n, seed=1):
+    r = random.Random(seed)
+    n_bytes = (circuit.n_inputs + 7) // 8
+    return [bytes(r.getrandbits(8) for _ in range(n_bytes)) for _ in range(n)]
+
+
+def stream_trace(fc, inputs, context=None):
+    """Outputs and the node-major trace of a batch (as bytes)"""
+    blocks = []
+    outputs = fc.compute_batch_stream(inputs, blocks.append, context=context)
+    return outputs, b"".join(blocks)
+
+
+@pytest.fixture(scope="session")
+def aes_circuit():
+    return aes()
+
+
+class RandomBooleanCircuit(BooleanCircuit):
+    """OptBooleanCircuit without the node cache, which would merge
+    all RND() nodes into one (every mask the same bit)"""
+    CACHE_NODES = False
+
+
+@pytest.fixture(scope="session")
+def masked_aes():
+    """ISW masked AES (one round), with independent RANDOM gates"""
+    from wboxkit.masking import ISW
+    C = ISW(order=1).transform(aes(), circuit_class=RandomBooleanCircuit)
+    C.in_place_remove_unused_nodes()
+    assert sum(node.operation._name == "RND" for node in C) > 500
+    return C
+
+
+def trace_columns(trace, batch):
+    """Per-input traces (bits as bytes 0/1) of a node-major batch trace"""
+    from wboxkit.fastcircuit import trace_item_bytes, unpack_bits
+    row_bits = trace_item_bytes(batch) * 8
+    bits = unpack_bits(trace)
+    return [bits[i::row_bits] for i in range(batch)]
+
+
+def interpret(fc, bits):
+    """Reference evaluation of the decoded code of a FastCircuit (without RANDOM)
+    on input bits, returns the output bits and the trace (all nodes)"""
+    from wboxkit.fastcircuit import (
+        OP_XOR, OP_AND, OP_OR, OP_NOT, OP_XOR3, OP_ANDXOR, OP_ANDNOT, OP_MUX, OP_XORN,
+    )
+    mem = dict(zip(fc.input_addr, bits))
+    trace = []
+    for op, dst, args in zip(fc.decoded()[0], fc.decoded()[1], fc.operands()):
+        v = [mem[addr] for addr in args]
+        if op == OP_XOR:
+            nodes = [v[0] ^ v[1]]
+        elif op == OP_AND:
+            nodes = [v[0] & v[1]]
+        elif op == OP_OR:
+            nodes = [v[0] | v[1]]
+        elif op == OP_NOT:
+            nodes = [v[0] ^ 1]
+        elif op == OP_XOR3:
+            nodes = [v[0] ^ v[1], v[0] ^ v[1] ^ v[2]]
+        elif op == OP_ANDXOR:
+            nodes = [v[1] & v[2], v[0] ^ (v[1] & v[2])]
+        elif op == OP_ANDNOT:
+            nodes = [v[0] ^ 1, (v[0] ^ 1) & v[1]]
+        elif op == OP_MUX:
+            d = v[0] ^ v[1]
+            nodes = [d, v[2] & d, v[0] ^ (v[2] & d)]
+        elif op == OP_XORN:
+            nodes = [v[0] ^ v[1]]
+            for x in v[2:]:
+                nodes.append(nodes[-1] ^ x)
+        else:
+            raise ValueError("unexpected opcode %d" % op)
+        mem[dst] = nodes[-1]
+        trace.extend(nodes)
+    return [mem[addr] for addr in fc.output_addr], trace
@@ -0,0 +1,77 @@
+import random
+
+import pytest
+
+from wboxkit.fastcircuit import FastCircuit, copy_bit_rows, transpose_bits, unpack_bits
+from wboxkit.serialize import RawSerializer
+from wboxkit.tracing import trace_split_batch
+
+from conftest import random_inputs, stream_trace, trace_columns
+
+
+def get_bit(data, i):
+    return data[i // 8] >> (7 - i % 8) & 1
+
+
+def pack(bits):
+    """Bits packed MSB first (zero-padded)"""
+    data = bytearray((len(bits) + 7) // 8)
+    for i, bit in enumerate(bits):
+        data[i // 8] |= bit << (7 - i % 8)
+    return bytes(data)
+
+
+def random_bytes(r, n):
+    return bytes(r.getrandbits(8) for _ in range(n))
+
+
+@pytest.mark.parametrize("rows, cols", [(1, 1), (3, 5), (64, 64), (65, 130), (200, 8), (8, 512), (1000, 37)])
+def test_transpose_bits(rows, cols):
+    r = random.Random(rows * cols)
+    row_bytes = (cols + 7) // 8
+    data = random_bytes(r, rows * row_bytes)
+    expected = b"".join(
+        pack([get_bit(data, i * row_bytes * 8 + j) for i in range(rows)])
+        for j in range(cols)
+    )
+    assert transpose_bits(data, rows, cols) == expected
+    if cols % 8 == 0:
+        assert transpose_bits(expected, cols, rows)[:len(data)] == data
+
+
+def test_unpack_bits():
+    data = random_bytes(random.Random(1), 100)
+    bits = [get_bit(data, i) for i in range(800)]
+    assert unpack_bits(data) == bytes(bits)
+    assert unpack_bits(data, 13) == bytes(bits[:13])
+
+
+@pytest.mark.parametrize("offset, nbits", [(0, 64), (3, 5), (8, 64), (13, 100), (250, 6)])
+def test_copy_bit_rows(offset, nbits):
+    r = random.Random(offset)
+    rows, in_stride, out_stride = 9, (nbits + 7) // 8 + 2, 40
+    data = random_bytes(r, rows * in_stride)
+    out = bytearray(random_bytes(r, 8 + rows * out_stride))
+    expected = bytearray(out)
+    for i in range(rows):
+        row = [get_bit(expected, (8 + i * out_stride) * 8 + j) for j in range(out_stride * 8)]
+        row[offset:offset + nbits] = [get_bit(data, i * in_stride * 8 + j) for j in range(nbits)]
+        expected[8 + i * out_stride:8 + (i + 1) * out_stride] = pack(row)
+    copy_bit_rows(data, out, 8, in_stride, out_stride, offset, nbits)
+    assert out == expected
+
+
+@pytest.mark.parametrize("batch", [5, 64, 100, 512])
+def test_trace_split_batch(aes_circuit, tmp_path, batch):
+    fc = FastCircuit(RawSerializer().serialize(aes_circuit))
+    inputs = random_inputs(aes_circuit, batch)
+    _, trace = stream_trace(fc, inputs)
+    columns = trace_columns(trace, batch)
+
+    filename = tmp_path / "trace.bin"
+    filename.write_bytes(trace)
+    trace_split_batch(str(filename), ntraces=batch)
+    trace_split_batch(str(filename), lambda i: str(tmp_path / ("%03d.unpacked" % i)), ntraces=batch, packed=False)
+    for i in range(batch):
+        assert (tmp_path / ("trace.bin.%02d" % i)).read_bytes() == pack(columns[i])
+        assert (tmp_path / ("%03d.unpacked" % i)).read_bytes() == columns[i]
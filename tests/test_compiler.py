@@ -0,0 +1,56 @@
+import pytest
+
+from wboxkit.compiler import CompiledCircuit
+from wboxkit.fastcircuit import FastCircuit, set_seed
+from wboxkit.serialize import RawSerializer
+
+from conftest import RandomBooleanCircuit, fusable_patterns, random_inputs, stream_trace
+
+LANES = [64, 128, 256, 512]
+
+
+@pytest.fixture(scope="module")
+def cache_dir(tmp_path_factory):
+    return tmp_path_factory.mktemp("cache")
+
+
+def check_compiled(circuit, lanes, cache_dir, seed=None, **kw):
+    fc = FastCircuit(RawSerializer().serialize(circuit))
+    compiled = CompiledCircuit(circuit, lanes=lanes, cache_dir=cache_dir, **kw)
+    assert compiled.max_batch == lanes
+    inputs = random_inputs(circuit, lanes)
+    for batch in (lanes, lanes - 3, 1):
+        if seed is not None:
+            set_seed(seed)
+        expected = stream_trace(fc, inputs[:batch])
+        if seed is not None:
+            set_seed(seed)
+        assert stream_trace(compiled, inputs[:batch]) == expected
+    return compiled
+
+
+@pytest.mark.parametrize("lanes", LANES)
+def test_compiled_fused(lanes, cache_dir):
+    check_compiled(fusable_patterns(), lanes, cache_dir)
+
+
+@pytest.mark.parametrize("lanes", LANES)
+def test_compiled_chunks(lanes, cache_dir):
+    check_compiled(fusable_patterns(2), lanes, cache_dir, chunk_size=100)
+
+
+@pytest.fixture(scope="module")
+def masked_patterns():
+    from wboxkit.masking import ISW
+    # ISW masks AND, XOR and NOT gates
+    circuit = fusable_patterns(n_gates=150, kinds=(0, 1, 2, 3, 5))
+    C = ISW(order=1).transform(circuit, circuit_class=RandomBooleanCircuit)
+    C.in_place_remove_unused_nodes()
+    assert sum(node.operation._name == "RND" for node in C) > 100
+    return C
+
+
+@pytest.mark.parametrize("lanes", LANES)
+def test_compiled_random(lanes, cache_dir, masked_patterns):
+    compiled = check_compiled(masked_patterns, lanes, cache_dir, seed=3, chunk_size=500)
+    assert compiled.info.num_opcodes > 500
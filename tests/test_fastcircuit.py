@@ -0,0 +1,216 @@
+import pytest
+from binteger import Bin
+
+from wboxkit.fastcircuit import FastCircuit, MAX_BATCH, OP_AND, engine_name, max_batch, set_seed
+from wboxkit.serialize import RawSerializer
+
+from conftest import fusable_patterns, interpret, random_inputs, stream_trace, trace_columns, wide_circuit
+
+BATCH_SIZES = [1, 7, 8, 63, 64, 65, 128, 129, 200, 256, 257, 511, MAX_BATCH]
+
+
+@pytest.fixture(scope="module")
+def fc(aes_circuit):
+    return FastCircuit(RawSerializer().serialize(aes_circuit))
+
+
+@pytest.fixture(scope="module")
+def reference(fc, aes_circuit):
+    """Outputs and traces of the inputs computed one by one"""
+    inputs = random_inputs(aes_circuit, MAX_BATCH)
+    outputs, traces = [], []
+    for x in inputs:
+        (y,), trace = stream_trace(fc, [x])
+        outputs.append(y)
+        traces.append(trace_columns(trace, 1)[0])
+    return inputs, outputs, traces
+
+
+def test_engines():
+    assert 64 <= max_batch() <= MAX_BATCH
+    for batch in BATCH_SIZES:
+        assert engine_name(batch)
+
+
+@pytest.mark.parametrize("batch", BATCH_SIZES)
+def test_batch_sizes(fc, reference, batch):
+    inputs, outputs, traces = reference
+    res, trace = stream_trace(fc, inputs[:batch])
+    assert res == outputs[:batch]
+    assert trace_columns(trace, batch) == traces[:batch]
+
+
+def test_batch_sizes_random(masked_aes):
+    fc = FastCircuit(RawSerializer().serialize(masked_aes))
+    inputs = random_inputs(masked_aes, MAX_BATCH)
+    expected = [fc.compute_one(x) for x in inputs]
+    for batch in BATCH_SIZES:
+        set_seed(batch)
+        assert fc.compute_batches(inputs, batch_size=batch) == expected
+
+
+@pytest.mark.parametrize("fuse", [False, True])
+def test_decoded(fuse):
+    circuit = fusable_patterns()
+    fc = FastCircuit(RawSerializer(fuse=fuse).serialize(circuit))
+    ops, dst, a, b, c = fc.decoded()
+    assert len(ops) == len(fc.operands()) == fc.info.num_opcodes
+    assert len(fc.node_gates()) == fc.num_nodes
+    assert fc.output_nodes()[-1] == fc.num_nodes - 1
+    for x in random_inputs(circuit, 20):
+        outputs, trace = interpret(fc, Bin(x).tuple[:circuit.n_inputs])
+        y, batch_trace = stream_trace(fc, [x])
+        assert outputs == list(Bin(y[0]).tuple[:circuit.n_outputs])
+        assert bytes(trace) == trace_columns(batch_trace, 1)[0]
+
+
+def test_addr32():
+    circuit = wide_circuit()
+    short = FastCircuit(RawSerializer().serialize(circuit))
+    assert short.struct.code.addr_bytes == 2
+    serializer = RawSerializer(reuse_memory=False)
+    wide = FastCircuit(serializer.serialize(circuit))
+    assert serializer.ram_size > 2**16
+    assert wide.struct.code.addr_bytes == 4
+
+    inputs = random_inputs(circuit, 100)
+    assert stream_trace(wide, inputs) == stream_trace(short, inputs)
+    for x in inputs[:3]:
+        y = Bin(wide.compute_one(x)).tuple[:circuit.n_outputs]
+        assert list(y) == list(circuit.evaluate(Bin(x).tuple))
+
+    with pytest.raises(AssertionError):
+        RawSerializer(reuse_memory=False, bytes_addr=2).serialize(circuit)
+
+
+def test_addr32_forced(aes_circuit):
+    short = FastCircuit(RawSerializer().serialize(aes_circuit))
+    wide = FastCircuit(RawSerializer(bytes_addr=4).serialize(aes_circuit))
+    assert wide.struct.code.addr_bytes == 4
+    assert wide.decoded() == short.decoded()
+    inputs = random_inputs(aes_circuit, 100)
+    assert stream_trace(wide, inputs) == stream_trace(short, inputs)
+
+
+def test_random_streams(masked_aes, tmp_path):
+    fc = FastCircuit(RawSerializer().serialize(masked_aes))
+    inputs = random_inputs(masked_aes, 300)
+    expected = [fc.compute_one(x) for x in inputs]
+
+    def traces(name, n_threads, seed=7):
+        path = tmp_path / name
+        path.mkdir()
+        fmt = str(path / "%04d.bin")
+        if n_threads is None:
+            outputs = fc.compute_batches(inputs, fmt, batch_size=64, seed=seed)
+        else:
+            outputs = fc.compute_parallel(inputs, n_threads, fmt, batch_size=64, seed=seed)
+        assert outputs == expected
+        return [p.read_bytes() for p in sorted(path.iterdir())]
+
+    serial = traces("serial", None)
+    assert len(serial) == 5
+    assert traces("threads1", 1) == serial
+    assert traces("threads3", 3) == serial
+    assert traces("seed8", 3, seed=8) != serial
+
+    # a batch only depends on its stream (seed, index)
+    context = fc.new_context()
+    fc.set_seed(7, 3, context=context)
+    fc.compute_batch(inputs[192:256], str(tmp_path / "batch3.bin"), context=context)
+    assert (tmp_path / "batch3.bin").read_bytes() == serial[3]
+
+
+def test_trace_filter(aes_circuit):
+    fc = FastCircuit(RawSerializer().serialize(aes_circuit))
+    inputs = random_inputs(aes_circuit, 100)
+    outputs, full = stream_trace(fc, inputs)
+    item_bytes = len(full) // fc.num_nodes
+    gates = fc.node_gates()
+    for kw in [dict(ops=("AND",)), dict(ranges=[(10, 200), (1000, 1100)], stride=3), dict(ranges=[(5, 6)])]:
+        nodes = fc.select_nodes(**kw)
+        assert nodes
+        if "ops" in kw:
+            assert {gates[i] for i in nodes} == {OP_AND}
+        context = fc.new_context()
+        fc.set_trace_filter(nodes, context=context)
+        assert fc.num_traced(context) == len(nodes)
+        assert stream_trace(fc, inputs, context=context) == (
+            outputs,
+            b"".join(full[i * item_bytes:(i + 1) * item_bytes] for i in nodes),
+        )
+    assert fc.num_traced() == fc.num_nodes
+
+
+def test_buffers(fc, reference):
+    inputs, outputs, traces = reference
+    inputs, outputs = inputs[:100], outputs[:100]
+    joined = b"".join(inputs)
+    for x, y in zip(inputs[:5], outputs):
+        for buf in (x, bytearray(x), memoryview(x), memoryview(bytearray(b"." + x))[1:]):
+            assert fc.compute_one(buf) == y
+    with pytest.raises(AssertionError, match="single input"):
+        fc.compute_one(joined[:32])
+
+    assert fc.compute_batch(inputs) == outputs
+    for buf in (joined, bytearray(joined), memoryview(joined)):
+        assert fc.compute_batch(buf) == b"".join(outputs)
+    output = bytearray(16 * 101)
+    assert fc.compute_batch(inputs, output=output) is output
+    assert output[:-16] == b"".join(outputs) and output[-16:] == bytes(16)
+    with pytest.raises(AssertionError, match="too small"):
+        fc.compute_batch(inputs, output=bytearray(16 * 99))
+    with pytest.raises(AssertionError, match="writable"):
+        fc.compute_batch(inputs, output=bytes(16 * 100))
+    with pytest.raises(AssertionError, match="multiple of the input size"):
+        fc.compute_batch(joined[:-1])
+
+    for batch_size in (1, 33, 64):
+        output = bytearray(16 * 100)
+        assert fc.compute_batches(memoryview(joined), batch_size=batch_size, output=output) is output
+        assert output == b"".join(outputs)
+        assert fc.compute_batches(bytearray(joined), batch_size=batch_size) == b"".join(outputs)
+        assert fc.compute_parallel(joined, n_threads=2, batch_size=batch_size) == b"".join(outputs)
+
+
+def test_buffers_numpy(fc, reference):
+    np = pytest.importorskip("numpy")
+    inputs, outputs, traces = reference
+    inputs, outputs = inputs[:100], outputs[:100]
+    array = np.frombuffer(b"".join(inputs), dtype=np.uint8).reshape(100, 16)
+    assert fc.compute_one(array[3]) == outputs[3]
+    output = np.zeros((100, 16), dtype=np.uint8)
+    assert fc.compute_batch(array, output=output) is output
+    assert output.tobytes() == b"".join(outputs)
+    # the buffer is not copied
+    output[:] = 0
+    fc.compute_batches(array, batch_size=30, output=output)
+    assert output.tobytes() == b"".join(outputs)
+    # strided views are not contiguous
+    with pytest.raises((TypeError, ValueError)):
+        fc.compute_batch(array[::2])
+
+
+def test_compute_mem(fc, reference):
+    np = pytest.importorskip("numpy")
+    inputs, outputs, traces = reference
+    for batch in (1, 63, 64, 200):
+        expected = stream_trace(fc, inputs[:batch])
+        res, trace = fc.compute_batch_trace(inputs[:batch])
+        assert trace.shape == (fc.num_nodes, len(expected[1]) // fc.num_nodes)
+        assert (res, trace.tobytes()) == expected
+        columns = np.unpackbits(trace, axis=1)[:, :batch].T
+        assert [bytes(column) for column in columns] == traces[:batch]
+
+        buf = bytearray(len(expected[1]))
+        output = bytearray(16 * batch)
+        res, trace = fc.compute_batch_trace(b"".join(inputs[:batch]), trace=buf, output=output)
+        assert res is output and trace is buf
+        assert (bytes(output), bytes(buf)) == (b"".join(expected[0]), expected[1])
+
+    context = fc.new_context()
+    nodes = fc.select_nodes(ops=("AND",))
+    fc.set_trace_filter(nodes, context=context)
+    res, trace = fc.compute_batch_trace(inputs[:64], context=context)
+    assert (res, trace.tobytes()) == stream_trace(fc, inputs[:64], context=context)
+    assert trace.shape == (len(nodes), 8)
@@ -0,0 +1,61 @@
+from collections import Counter
+
+import pytest
+
+from wboxkit.fastcircuit import FastCircuit
+from wboxkit.masking import gadget_names, in_gadget
+from wboxkit.optimize import Simplifier, optimize
+from wboxkit.serialize import RawSerializer
+
+from conftest import random_inputs
+
+
+def outputs(circuit, inputs):
+    return FastCircuit(RawSerializer().serialize(circuit)).compute_batch(inputs)
+
+
+def gates(circuit):
+    return Counter(node.operation._name for node in circuit)
+
+
+def gadget_gates(circuit):
+    names = gadget_names()
+    return Counter(
+        (str(node.location), node.operation._name)
+        for node in circuit if not node.is_INPUT() and in_gadget(node, names)
+    )
+
+
+@pytest.mark.parametrize("use_or", [True, False])
+def test_optimize_aes(aes_circuit, use_or):
+    inputs = random_inputs(aes_circuit, 100)
+    expected = outputs(aes_circuit, inputs)
+    for keep_masking in (True, False):
+        optimized = optimize(aes_circuit, keep_masking=keep_masking, use_or=use_or)
+        assert outputs(optimized, inputs) == expected
+        assert len(optimized) <= len(aes_circuit)
+        if not use_or:
+            assert gates(optimized)["OR"] == 0
+    assert len(optimize(aes_circuit, keep_masking=False)) < len(aes_circuit)
+
+
+@pytest.mark.parametrize("keep_masking", [True, False])
+@pytest.mark.parametrize("use_or", [True, False])
+def test_optimize_masked(masked_aes, keep_masking, use_or):
+    circuit = masked_aes
+    inputs = random_inputs(circuit, 100)
+    optimized = optimize(circuit, keep_masking=keep_masking, use_or=use_or)
+    assert outputs(optimized, inputs) == outputs(circuit, inputs)
+    if keep_masking:
+        assert gadget_gates(optimized) == gadget_gates(circuit)
+
+
+def test_simplifier_keeps_gadgets(masked_aes):
+    circuit = masked_aes
+    assert gadget_gates(circuit)
+    kept = Simplifier(keep_gadgets=True).transform(circuit)
+    kept.in_place_remove_unused_nodes()
+    assert gadget_gates(kept) == gadget_gates(circuit)
+    simplified = Simplifier().transform(circuit)
+    simplified.in_place_remove_unused_nodes()
+    assert gadget_gates(simplified) != gadget_gates(circuit)
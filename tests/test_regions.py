@@ -0,0 +1,184 @@
+import argparse
+import sys
+
+import pytest
+
+from wboxkit.attacks import trace
+from wboxkit.attacks.reader import Reader
+from wboxkit.fastcircuit import FastCircuit
+from wboxkit.regions import (
+    CIRCUIT_INFO, REGION_TABLE, MEMORY_BITS, RegionRuns, match_region, read_region_table,
+)
+from wboxkit.serialize import RawSerializer, CompactRawSerializer
+
+from conftest import random_inputs
+
+COMPACT_OPCODES = 0x80
+
+
+def node_tags(circuit):
+    """Tags of the trace nodes of a circuit, in order"""
+    return [
+        str(node.location) if node.location else ""
+        for node in circuit if not node.is_INPUT()
+    ]
+
+
+def expand(runs):
+    return [tag for start, stop, tag in runs for _ in range(start, stop)]
+
+
+@pytest.fixture(scope="module")
+def circuit_file(masked_aes, tmp_path_factory):
+    path = tmp_path_factory.mktemp("regions") / "masked.bin"
+    RawSerializer(regions=True).serialize_to_file(masked_aes, str(path))
+    return path
+
+
+def test_match_region():
+    assert match_region("r1:sb:s3:ISW_AND", "r1:sb")
+    assert match_region("r1:sb:s3:ISW_AND", "*:sb:s3")
+    assert match_region("r1:sb:s3", "r1:sb:s3")
+    assert not match_region("r1:sb:s3", "r1:sb:s3:ISW_AND")
+    assert not match_region("r1:sb:s13", "r1:sb:s1")
+    assert not match_region("r1:mc", "r1:sb")
+
+
+def test_pack_unpack():
+    runs = RegionRuns([(0, 3, "r1:ak"), (3, 10, "r1:sb:s0"), (10, 12, ""), (12, 20, "r1:ak")])
+    data = runs.pack()
+    for value in (RegionRuns.unpack(data), RegionRuns.unpack(b"xyz" + data, 3)):
+        assert value.runs == runs.runs
+        assert value.num_nodes == 20
+    assert value.tags() == ["r1:ak", "r1:sb:s0", ""]
+    assert RegionRuns.unpack(RegionRuns().pack()).runs == []
+    with pytest.raises(AssertionError, match="truncated"):
+        RegionRuns.unpack(data[:40])
+
+
+def test_select_filtered():
+    runs = RegionRuns([
+        (0, 3, "r1:ak"), (3, 10, "r1:sb:s0"), (10, 12, "r1:sb:s0:ISW_AND"),
+        (12, 15, "r1:sb:s1"), (15, 20, "r1:ak"),
+    ])
+    assert runs.select(["r1:sb:s0"]) == [(3, 12)]
+    assert runs.select(["r1:sb"]) == [(3, 15)]
+    assert runs.select(["r1:ak", "*:*:s1"]) == [(0, 3), (12, 20)]
+    assert runs.select(["r2"]) == []
+
+    nodes = [1, 2, 5, 11, 16, 19]
+    filtered = runs.filtered(nodes)
+    assert filtered.num_nodes == len(nodes)
+    assert filtered.runs == [(0, 2, "r1:ak"), (2, 3, "r1:sb:s0"), (3, 4, "r1:sb:s0:ISW_AND"), (4, 6, "r1:ak")]
+    assert expand(filtered) == [expand(runs)[i] for i in nodes]
+    # runs with the same tag are merged once the nodes between them are filtered out
+    assert runs.filtered([0, 17]).runs == [(0, 2, "r1:ak")]
+
+
+@pytest.mark.parametrize("cls", [RawSerializer, CompactRawSerializer])
+def test_serialized_regions(masked_aes, tmp_path, cls):
+    tags = node_tags(masked_aes)
+    assert any(tag.endswith(":ISW_AND") for tag in tags)
+    plain = FastCircuit(cls().serialize(masked_aes))
+    assert plain.regions is None
+
+    serialized = cls(regions=True).serialize(masked_aes)
+    path = tmp_path / "masked.bin"
+    cls(regions=True).serialize_to_file(masked_aes, str(path))
+    assert path.read_bytes() == b"".join(serialized[0]) + b"".join(serialized[1])
+    for circuit in (serialized, path.read_bytes(), str(path)):
+        assert expand(read_region_table(circuit)) == tags
+
+    fc = FastCircuit(str(path))
+    flags = CIRCUIT_INFO.unpack_from(path.read_bytes())[4] >> MEMORY_BITS
+    assert flags & REGION_TABLE
+    assert bool(flags & COMPACT_OPCODES) == (cls is CompactRawSerializer)
+    assert fc.regions.num_nodes == fc.num_nodes == len(tags)
+    assert expand(fc.regions) == tags
+    # the table does not change the code
+    assert fc.decoded() == plain.decoded()
+    inputs = random_inputs(masked_aes, 64)
+    assert fc.compute_batch(inputs) == plain.compute_batch(inputs)
+
+    nodes = fc.select_nodes(regions=["r1:sb:s5"])
+    assert nodes == [i for i, tag in enumerate(tags) if match_region(tag, "r1:sb:s5")]
+    assert nodes == fc.select_nodes(ranges=fc.regions.select(["r1:sb:s5"]))
+
+
+def run_trace(monkeypatch, circuit, traces_dir, *args):
+    traces_dir.mkdir(exist_ok=True)
+    monkeypatch.setattr(sys, "argv", ["wboxkit.trace", str(circuit), str(traces_dir), *map(str, args)])
+    trace.main()
+    return traces_dir / "masked"
+
+
+def reader_from_args(*args):
+    parser = argparse.ArgumentParser()
+    Reader.add_arguments(parser)
+    return Reader.from_args(parser.parse_args(list(map(str, args))))
+
+
+def test_trace_region(monkeypatch, tmp_path, circuit_file):
+    fc = FastCircuit(str(circuit_file))
+    full = run_trace(monkeypatch, circuit_file, tmp_path / "full", "-t", 64, "--seed", 3)
+    assert RegionRuns.from_file(full / trace.PATH_REGIONS).runs == fc.regions.runs
+
+    patterns = ["r1:sb:s5", "r1:sb:s9"]
+    part = run_trace(
+        monkeypatch, circuit_file, tmp_path / "part", "-t", 64, "--seed", 3,
+        *(arg for pattern in patterns for arg in ("--trace-region", pattern)),
+    )
+    nodes = fc.select_nodes(regions=patterns)
+    regions = RegionRuns.from_file(part / trace.PATH_REGIONS)
+    assert regions.runs == fc.regions.filtered(nodes).runs
+    assert all(any(match_region(tag, p) for p in patterns) for tag in regions.tags())
+
+    # the traced nodes are those of the full traces, in order
+    bits = len(nodes)
+    full_bits = fc.num_nodes
+    for i in range(0, 64, 16):
+        a = (full / (trace.PATH_FORMAT_TRACE % i)).read_bytes()
+        b = (part / (trace.PATH_FORMAT_TRACE % i)).read_bytes()
+        full_trace = [a[j // 8] >> (7 - j % 8) & 1 for j in range(full_bits)]
+        part_trace = [b[j // 8] >> (7 - j % 8) & 1 for j in range(bits)]
+        assert part_trace == [full_trace[j] for j in nodes]
+
+
+def test_trace_region_errors(monkeypatch, tmp_path, masked_aes):
+    path = tmp_path / "masked.bin"
+    RawSerializer().serialize_to_file(masked_aes, str(path))
+    with pytest.raises(SystemExit, match="no region table"):
+        run_trace(monkeypatch, path, tmp_path / "traces", "-t", 8, "--trace-region", "r1:sb")
+    traces = run_trace(monkeypatch, path, tmp_path / "traces", "-t", 8)
+    with pytest.raises(SystemExit, match="no region table"):
+        reader_from_args(str(traces), "-t", 8, "--region", "r1:sb")
+
+
+@pytest.mark.parametrize("source", ["files", "circuit"])
+def test_reader_region(monkeypatch, tmp_path, circuit_file, source):
+    fc = FastCircuit(str(circuit_file))
+    traces = run_trace(monkeypatch, circuit_file, tmp_path, "-t", 64, "--seed", 3)
+    if source == "files":
+        args = (traces,)
+    else:
+        args = ("--circuit", circuit_file, "--seed", 3)
+    args += ("-t", 64, "-w", 64, "-s", 16)
+    ranges = fc.regions.select(["r1:sb:s5"])
+    reader = reader_from_args(*args, "--region", "r1:sb:s5")
+    assert reader.byte_ranges == [(start // 8, -(-stop // 8)) for start, stop in ranges]
+
+    full = reader_from_args(*args)
+    vectors = {}
+    for window in full:
+        for i, v in enumerate(window):
+            vectors[full.offset * 8 + i] = v
+    windows = 0
+    for window in reader:
+        windows += 1
+        start = reader.offset * 8
+        assert any(a // 8 * 8 <= start and start + len(window) <= -(-b // 8) * 8 for a, b in ranges)
+        assert list(window) == [vectors[start + i] for i in range(len(window))]
+    assert windows == reader.num_windows > 1
+
+    with pytest.raises(SystemExit, match="no trace nodes"):
+        reader_from_args(*args, "--region", "r2")
@@ -0,0 +1,23 @@
+from wboxkit.fastcircuit import FastCircuit, set_seed
+from wboxkit.scheduling import LiveSetScheduler
+from wboxkit.serialize import RawSerializer
+
+from conftest import random_inputs
+
+
+def test_schedule_masked(masked_aes):
+    scheduler = LiveSetScheduler()
+    scheduled = scheduler.transform(masked_aes)
+    original = RawSerializer()
+    fc = FastCircuit(original.serialize(masked_aes))
+    serializer = RawSerializer()
+    fc_scheduled = FastCircuit(serializer.serialize(scheduled))
+
+    assert serializer.ram_size == min(scheduler.peaks.values())
+    assert serializer.ram_size <= original.ram_size == scheduler.peaks["original"]
+    assert sorted(fc_scheduled.node_gates()) == sorted(fc.node_gates())
+    inputs = random_inputs(masked_aes, 100)
+    set_seed(1)
+    expected = fc.compute_batch(inputs)
+    set_seed(1)
+    assert fc_scheduled.compute_batch(inputs) == expected
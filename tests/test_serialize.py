@@ -0,0 +1,120 @@
+from collections import Counter
+
+import pytest
+from binteger import Bin
+
+from wboxkit.fastcircuit import (
+    FastCircuit, set_seed,
+    OP_XOR3, OP_ANDXOR, OP_ANDNOT, OP_MUX, OP_XORN,
+)
+from wboxkit.serialize import RawSerializer, CompactRawSerializer
+
+from conftest import fusable_patterns, random_inputs, stream_trace, wide_circuit
+
+
+@pytest.fixture(scope="module", params=[1, 2])
+def patterns(request):
+    return fusable_patterns(request.param)
+
+
+@pytest.mark.parametrize("cls", [RawSerializer, CompactRawSerializer])
+def test_fused_patterns(patterns, cls):
+    plain = FastCircuit(cls(fuse=False).serialize(patterns))
+    fused = FastCircuit(cls().serialize(patterns))
+    ops = Counter(fused.decoded()[0])
+    for op in (OP_XOR3, OP_ANDXOR, OP_ANDNOT, OP_MUX, OP_XORN):
+        assert ops[op], "no opcode %d" % op
+    assert fused.info.num_opcodes < plain.info.num_opcodes
+    assert fused.num_nodes == plain.num_nodes == plain.info.num_opcodes
+    assert fused.node_gates() == plain.node_gates()
+
+    inputs = random_inputs(patterns, 100)
+    assert stream_trace(fused, inputs) == stream_trace(plain, inputs)
+    for x in inputs[:10]:
+        y = Bin(fused.compute_one(x)).tuple[:patterns.n_outputs]
+        assert list(y) == list(patterns.evaluate(Bin(x).tuple))
+
+
+def test_fused_trace_filter(patterns):
+    plain = FastCircuit(RawSerializer(fuse=False).serialize(patterns))
+    fused = FastCircuit(RawSerializer().serialize(patterns))
+    inputs = random_inputs(patterns, 70)
+    for kw in [dict(ops=("AND",)), dict(ranges=[(10, 200)], stride=3)]:
+        nodes = fused.select_nodes(**kw)
+        assert nodes == plain.select_nodes(**kw)
+        fused.set_trace_filter(nodes)
+        plain.set_trace_filter(nodes)
+        assert stream_trace(fused, inputs) == stream_trace(plain, inputs)
+
+
+def test_fused_masked(masked_aes):
+    plain = FastCircuit(RawSerializer(fuse=False).serialize(masked_aes))
+    fused = FastCircuit(RawSerializer().serialize(masked_aes))
+    inputs = random_inputs(masked_aes, 64)
+    set_seed(5)
+    expected = stream_trace(plain, inputs)
+    set_seed(5)
+    assert stream_trace(fused, inputs) == expected
+
+
+@pytest.mark.parametrize("kw", [dict(), dict(fuse=False), dict(bytes_addr=4), dict(alloc_strategy="lowest")])
+def test_compact(aes_circuit, tmp_path, kw):
+    raw = RawSerializer(**kw)
+    fc = FastCircuit(raw.serialize(aes_circuit))
+    compact = CompactRawSerializer(**kw)
+    filename = tmp_path / "compact.bin"
+    compact.serialize_to_file(aes_circuit, str(filename))
+    fc_compact = FastCircuit(filename)
+
+    assert compact.opcodes_size < raw.opcodes_size
+    assert fc_compact.decoded() == fc.decoded()
+    assert fc_compact.operands() == fc.operands()
+    inputs = random_inputs(aes_circuit, 100)
+    assert stream_trace(fc_compact, inputs) == stream_trace(fc, inputs)
+
+
+@pytest.mark.parametrize("cls", [RawSerializer, CompactRawSerializer])
+@pytest.mark.parametrize("alloc_strategy", ["lifo", "lowest", "operand"])
+def test_serialize_to_file(masked_aes, tmp_path, cls, alloc_strategy):
+    for kw in [dict(), dict(fuse=False), dict(regions=True)]:
+        header, opcodes = cls(alloc_strategy=alloc_strategy, **kw).serialize(masked_aes)
+        filename = tmp_path / "circuit.bin"
+        cls(alloc_strategy=alloc_strategy, **kw).serialize_to_file(masked_aes, str(filename))
+        assert filename.read_bytes() == b"".join(header) + b"".join(opcodes)
+
+
+class CountingSerializer(RawSerializer):
+    def serialize_bit(self, bit):
+        self.count[bit.operation._name] += 1
+        super().serialize_bit(bit)
+
+
+class GenericSerializer(RawSerializer):
+    def visit_generic(self, bit, *args):
+        self.count[bit.operation._name] += 1
+        return super().visit_generic(bit, *args)
+
+
+@pytest.mark.parametrize("cls", [CountingSerializer, GenericSerializer])
+@pytest.mark.parametrize("kw", [dict(), dict(fuse=False), dict(alloc_strategy="lowest"), dict(alloc_strategy="operand")])
+def test_serialize_hooks(masked_aes, tmp_path, cls, kw):
+    """Subclasses hooking the generic visit are called for every gate,
+    with the same output as the inlined visit"""
+    serializer = cls(**kw)
+    serializer.count = Counter()
+    serializer.serialize_to_file(masked_aes, str(tmp_path / "hook.bin"), str(tmp_path / "hook.sym"))
+    RawSerializer(**kw).serialize_to_file(masked_aes, str(tmp_path / "raw.bin"), str(tmp_path / "raw.sym"))
+    assert serializer.count == Counter(node.operation._name for node in masked_aes if not node.is_INPUT())
+    assert (tmp_path / "hook.bin").read_bytes() == (tmp_path / "raw.bin").read_bytes()
+    assert (tmp_path / "hook.sym").read_bytes() == (tmp_path / "raw.sym").read_bytes()
+
+
+def test_serialize_hooks_overflow():
+    """The generic visit switches to 4-byte addresses as well"""
+    circuit = wide_circuit()
+    serializer = CountingSerializer(reuse_memory=False)
+    serializer.count = Counter()
+    serialized = serializer.serialize(circuit)
+    assert serializer.ram_size > 2**16
+    assert serialized == RawSerializer(reuse_memory=False).serialize(circuit)
+    assert FastCircuit(serialized).struct.code.addr_bytes == 4
@@ -0,0 +1,112 @@
+import sys
+
+import pytest
+from binteger import Bin
+
+from wboxkit.attacks import exact
+from wboxkit.fastcircuit import FastCircuit
+from wboxkit.serialize import RawSerializer, CompactRawSerializer
+from wboxkit.symbols import SymbolTable
+
+from conftest import random_inputs, stream_trace, trace_columns
+
+
+def node_values(circuit, bits):
+    """Values of all nodes of the circuit on input bits, by node id"""
+    values = dict(zip((node.id for node in circuit.inputs), bits))
+    for node in circuit:
+        v = [values[arg.id] for arg in node.incoming]
+        name = node.operation._name
+        if name == "XOR":
+            values[node.id] = v[0] ^ v[1]
+        elif name == "AND":
+            values[node.id] = v[0] & v[1]
+        elif name == "OR":
+            values[node.id] = v[0] | v[1]
+        elif name == "NOT":
+            values[node.id] = v[0] ^ 1
+        else:
+            assert name == "INPUT", name
+    return values
+
+
+@pytest.fixture(scope="module")
+def aes_files(aes_circuit, tmp_path_factory):
+    path = tmp_path_factory.mktemp("symbols")
+    RawSerializer(regions=True).serialize_to_file(
+        aes_circuit, str(path / "aes.bin"), str(path / "aes.sym"),
+    )
+    return path / "aes.bin", path / "aes.sym"
+
+
+@pytest.mark.parametrize("cls", [RawSerializer, CompactRawSerializer])
+@pytest.mark.parametrize("kw", [dict(), dict(fuse=False), dict(bytes_addr=4)])
+def test_symbols_roundtrip(aes_circuit, tmp_path, cls, kw):
+    cls(**kw).serialize_to_file(
+        aes_circuit, str(tmp_path / "aes.bin"), str(tmp_path / "aes.sym"),
+    )
+    fc = FastCircuit(str(tmp_path / "aes.bin"))
+    table = SymbolTable(str(tmp_path / "aes.sym"))
+    gates = [node for node in aes_circuit if not node.is_INPUT()]
+    assert len(table) == len(gates) == fc.num_nodes
+    for i, node in enumerate(gates):
+        symbol = table[i]
+        assert symbol.id == node.id
+        assert symbol.op == node.operation._name
+        assert symbol.args == tuple(arg.id for arg in node.incoming)
+        assert symbol.tag == str(node.location)
+    with pytest.raises(IndexError):
+        table[len(gates)]
+
+    # trace positions hold the values of the nodes named by the table
+    inputs = random_inputs(aes_circuit, 8)
+    _, trace = stream_trace(fc, inputs)
+    for x, column in zip(inputs, trace_columns(trace, len(inputs))):
+        values = node_values(aes_circuit, Bin(x, aes_circuit.n_inputs).tuple)
+        assert list(column[:len(table)]) == [values[table[i].id] for i in range(len(table))]
+    table.close()
+
+
+def test_symbols_nodes(aes_files):
+    table = SymbolTable(str(aes_files[1]))
+    nodes = [5, 100, 2000]
+    filtered = SymbolTable(str(aes_files[1]), nodes=nodes)
+    assert len(filtered) == 3
+    assert [filtered[i] for i in range(3)] == [table[i] for i in nodes]
+    assert str(table[5]).startswith("#%d = %s(" % (table[5].id, table[5].op))
+    assert str(table[5]).endswith(" @ " + table[5].tag)
+
+
+def test_exact_print_symbols(monkeypatch, capsys, aes_files):
+    circuit, symbols = aes_files
+    monkeypatch.setattr(sys, "argv", [
+        "wboxkit.exact", "--circuit", str(circuit), "-t", "64",
+        "--symbols", str(symbols), "--region", "r1:sb:s5",
+    ])
+    exact.main()
+    out = capsys.readouterr().out
+    assert "MATCH (SINGLE):\nsbox #5,\nlin.mask" in out
+    assert "key 0x66='f'" in out
+    # the indexes of a match are followed by their gates
+    # (windows are byte-aligned, so they may start before S-Box #5)
+    lines = out.splitlines()
+    i = lines.index("sbox #5,")
+    assert lines[i + 4].startswith("indexes (1 total)")
+    position, symbol = lines[i + 5].split(None, 1)
+    table = SymbolTable(str(symbols))
+    assert symbol == str(table[int(position)])
+    assert symbol.endswith(" @ r1:sb:s5")
+
+
+def test_lda_print_symbols(monkeypatch, capsys, aes_files):
+    pytest.importorskip("sage.all")
+    from wboxkit.attacks import lda
+    circuit, symbols = aes_files
+    monkeypatch.setattr(sys, "argv", [
+        "wboxkit.lda", "--circuit", str(circuit),
+        "--symbols", str(symbols), "--region", "r1:sb:s5",
+    ])
+    lda.main()
+    out = capsys.readouterr().out
+    assert "key 0x66='f'" in out
+    assert " @ r1:sb:s5" in out
@@ -0,0 +1,128 @@
+import sys
+import threading
+
+import pytest
+
+from wboxkit.attacks import trace
+from wboxkit.attacks.reader import CircuitReader, Reader, StoreReader
+from wboxkit.fastcircuit import set_trace_buffer_size
+from wboxkit.serialize import RawSerializer
+
+
+@pytest.fixture(scope="module")
+def circuit_file(masked_aes, tmp_path_factory):
+    path = tmp_path_factory.mktemp("circuit") / "masked.bin"
+    RawSerializer().serialize_to_file(masked_aes, str(path))
+    return path
+
+
+def run_trace(monkeypatch, circuit, traces_dir, *args):
+    """Run wboxkit.trace, returns the directory of the trace set"""
+    traces_dir.mkdir(exist_ok=True)
+    monkeypatch.setattr(sys, "argv", ["wboxkit.trace", str(circuit), str(traces_dir), *map(str, args)])
+    trace.main()
+    return traces_dir / "masked"
+
+
+def windows(reader):
+    """Plaintexts, ciphertexts and the node vectors of all windows of a reader"""
+    return reader.pts, reader.cts, [list(vectors) for vectors in reader]
+
+
+def read_traces(path, ntraces):
+    """Windows of a trace set recorded by wboxkit.trace"""
+    cls = StoreReader if (path / trace.PATH_TRACE_STORE).exists() else Reader
+    return windows(cls(ntraces, 1024, dir=path))
+
+
+def test_store_vs_files(monkeypatch, tmp_path, circuit_file):
+    args = ("-t", 200, "-b", 64, "--seed", 3)
+    files = run_trace(monkeypatch, circuit_file, tmp_path / "files", *args)
+    store = run_trace(monkeypatch, circuit_file, tmp_path / "store", *args, "--store")
+    assert not (files / trace.PATH_TRACE_STORE).exists()
+
+    expected = windows(Reader(200, 1024, dir=files))
+    assert windows(StoreReader(200, 1024, dir=store)) == expected
+    reader = CircuitReader(circuit_file, 200, 1024, seed=3, batch_size=64)
+    assert windows(reader)[2] == expected[2]
+    assert (reader.pts, reader.cts) == expected[:2]
+
+
+@pytest.mark.parametrize("store", [False, True])
+def test_jobs(monkeypatch, tmp_path, circuit_file, store):
+    args = ("-t", 300, "-b", 64, "--seed", 3) + (("--store",) if store else ())
+    serial = run_trace(monkeypatch, circuit_file, tmp_path / "serial", *args)
+    jobs = run_trace(monkeypatch, circuit_file, tmp_path / "jobs", *args, "-j", 3)
+    assert read_traces(jobs, 300) == read_traces(serial, 300)
+
+
+def test_jobs_errors(monkeypatch, tmp_path, circuit_file):
+    with pytest.raises(SystemExit, match="--jobs must be at least 1"):
+        run_trace(monkeypatch, circuit_file, tmp_path / "zero", "-t", 8, "-j", 0)
+    with pytest.raises(SystemExit, match="batch size multiple of 8"):
+        run_trace(monkeypatch, circuit_file, tmp_path / "odd", "-t", 30, "-b", 7, "--store", "-j", 2)
+    # a single process can record any batch size
+    run_trace(monkeypatch, circuit_file, tmp_path / "odd", "-t", 30, "-b", 7, "--store")
+
+
+@pytest.mark.parametrize("store", [False, True])
+def test_resume(monkeypatch, tmp_path, circuit_file, store):
+    args = ("-t", 300, "-b", 64, "--seed", 3) + (("--store",) if store else ())
+    expected = read_traces(run_trace(monkeypatch, circuit_file, tmp_path / "full", *args), 300)
+
+    record = trace.BatchTracer.trace
+    recorded = []
+
+    def interrupted(self, start, pts):
+        if len(recorded) == 2:
+            raise KeyboardInterrupt()
+        record(self, start, pts)
+        recorded.append(start)
+
+    monkeypatch.setattr(trace.BatchTracer, "trace", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        run_trace(monkeypatch, circuit_file, tmp_path / "resumed", *args)
+    monkeypatch.setattr(trace.BatchTracer, "trace", record)
+    path = tmp_path / "resumed" / "masked"
+    assert trace.load_manifest(path / trace.PATH_MANIFEST)["done"] == [[0, 128]]
+
+    with pytest.raises(SystemExit, match="seed differs"):
+        run_trace(monkeypatch, circuit_file, tmp_path / "resumed", *args, "--resume", "--seed", 4)
+    with pytest.raises(SystemExit, match="batch differs"):
+        run_trace(monkeypatch, circuit_file, tmp_path / "resumed", *args, "--resume", "-b", 32)
+    run_trace(monkeypatch, circuit_file, tmp_path / "resumed", *args, "--resume")
+    assert trace.load_manifest(path / trace.PATH_MANIFEST)["done"] == [[0, 300]]
+    assert read_traces(path, 300) == expected
+
+    # appending to a trace set aligned to the batches gives the same traces
+    args = args[2:]
+    run_trace(monkeypatch, circuit_file, tmp_path / "appended", "-t", 192, *args)
+    run_trace(monkeypatch, circuit_file, tmp_path / "appended", "-t", 108, *args, "--append")
+    assert read_traces(tmp_path / "appended" / "masked", 300) == expected
+
+
+def test_circuit_reader_streams(monkeypatch, tmp_path, circuit_file):
+    store = run_trace(monkeypatch, circuit_file, tmp_path / "store", "-t", 300, "--seed", 5, "--store")
+    ranges = [(100, 900), (3000, 5000)]
+    expected = StoreReader(300, 512, step=256, dir=store)
+    expected.set_ranges(ranges)
+    expected = windows(expected)
+
+    set_trace_buffer_size(4096)
+    try:
+        reader = CircuitReader(circuit_file, 300, 512, step=256, seed=5)
+        reader.set_ranges(ranges)
+        it = iter(reader)
+        first = list(next(it))
+        # the windows are read while the batches are traced
+        assert None in reader.cts
+        assert [first] + [list(vectors) for vectors in it] == expected[2]
+        assert reader.cts == expected[1]
+        # stopping early stops the tracing threads
+        threads = threading.active_count()
+        for _ in reader:
+            assert threading.active_count() > threads
+            break
+        assert threading.active_count() == threads
+    finally:
+        set_trace_buffer_size(4 << 20)